@@ -0,0 +1,506 @@
+"""Routing structures of the connected components, that are calculated in worker processes.
+
+The worker processes are spawned fresh and import this module to run `preprocess_components`, so it depends only on
+numpy, networkx and optionally SciPy. Importing QGIS in every worker would be slow, and the interpreter that starts
+them may not be able to load the QGIS bindings at all. `BoundaryGraph` re-exports everything here.
+
+Attributes:
+    DEFAULT_WEIGHT_NAME (str): the graph attribute to be used as weight
+    CLOSURE_BLOCK_CELLS (int): size of the distance matrix blocks calculated at once for the metric closures with SciPy
+
+Notes:
+    begin                : 2020-06-01
+    git sha              : $Format:%H$
+
+    development          : 2019, Ivan Ivanov @ ITC, University of Twente
+    email                : ivan.ivanov@suricactus.com
+    copyright            : (C) 2019 by Ivan Ivanov
+
+License:
+MIT License
+
+Copyright (c) 2020 "its4land project", "ITC, University of Twente"
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import math
+import os
+import sys
+import time
+import typing
+
+from collections import OrderedDict
+from heapq import heappush, heappop
+
+if os.path.join(os.path.dirname(__file__) + '/lib') not in sys.path:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__) + '/lib'))
+
+import numpy as np
+import networkx as nx
+from networkx.algorithms.approximation.steinertree import MetricClosure
+from typing import Collection, Dict, List, Optional, Tuple, Union
+
+try:
+    from scipy.sparse import csr_matrix, csgraph
+except ImportError:
+    csr_matrix = None
+    csgraph = None
+
+if typing.TYPE_CHECKING:
+    from qgis.core import QgsFeedback
+    from .BoundaryGraph import ComponentIndex
+
+DEFAULT_WEIGHT_NAME = 'weight'
+CLOSURE_BLOCK_CELLS = 2 ** 22
+
+EdgeKey = Union[int, Tuple[int, int]]
+
+
+class BoundaryDelineationError(Exception):
+    pass
+
+class NoSuitableGraphError(BoundaryDelineationError):
+    def __init__(self, expression: str = None, message: str = None):
+        self.expression = expression
+        self.message = message
+
+
+class ComponentArrays:
+    """The lines of one connected component as plain arrays, picklable, so it can be sent to a worker process.
+
+    Attributes:
+        label (int): component label
+        revision (int): the graph revision
+        weight (str): weight name
+        nodes (np.ndarray): node ids
+        edges (np.ndarray): edge indices
+        edge_nodes (np.ndarray): (m, 2) array with the node ids of each edge
+        edge_keys (List[EdgeKey]): line key of each edge
+        weights (np.ndarray): weight of each edge
+    """
+
+    def __init__(self, label: int, revision: int, weight: str, nodes: np.ndarray, edges: np.ndarray, edge_nodes: np.ndarray,
+                 edge_keys: List[EdgeKey], weights: np.ndarray) -> None:
+        self.label = label
+        self.revision = revision
+        self.weight = weight
+        self.nodes = nodes
+        self.edges = edges
+        self.edge_nodes = edge_nodes
+        self.edge_keys = edge_keys
+        self.weights = weights
+
+    @classmethod
+    def from_component(cls, components: 'ComponentIndex', label: int, weight: str = None) -> 'ComponentArrays':
+        graph = components.graph
+        edges = components.edges(label).copy()
+
+        return cls(label, graph.revision, weight or DEFAULT_WEIGHT_NAME, components.nodes(label).copy(), edges, graph.edge_nodes[edges],
+                   graph.edge_keys(edges.tolist()), graph.weights(weight)[edges])
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def to_networkx(self) -> nx.MultiGraph:
+        """Get the networkx graph of the component, like `ComponentIndex.subgraph` but with only the weight attribute."""
+        G = nx.MultiGraph()
+        G.add_nodes_from(self.nodes.tolist())
+        G.add_edges_from((u, v, key, {self.weight: cost}) for (u, v), key, cost in zip(self.edge_nodes.tolist(), self.edge_keys, self.weights.tolist()))
+
+        return G
+
+
+class ContractionHierarchy:
+    """Contraction hierarchy of one connected component, for exact shortest paths with tiny searches.
+
+    The nodes are contracted one by one, least important first (edge difference with lazy updates).
+    Contracting a node connects its remaining neighbours with shortcuts, unless a witness search finds
+    a path that is not longer without the node. Every shortest path then has an equally long path that
+    first goes only to more important nodes and then only to less important ones, so a query is two
+    upward searches, which settle a few hundred nodes even in large components.
+
+    The hierarchy belongs to one graph revision and one weight, it is rebuilt for the components that
+    change (see `ComponentIndex.apply_change`).
+
+    Attributes:
+        weight (str): weight name
+        revision (int): the graph revision it was built for
+        shortcuts (int): number of shortcut edges
+        build_time (float): build time in seconds
+    """
+
+    # the witness searches give up after settling this many nodes, a missing witness only adds a shortcut
+    WITNESS_SETTLED_LIMIT = 1000
+    # approximate bytes per upward edge and per unpacking entry
+    EDGE_BYTES = 150
+
+    def __init__(self, weight: str, revision: int) -> None:
+        self.weight = weight
+        self.revision = revision
+        self.shortcuts = 0
+        self.build_time = 0.0
+        self._up: Dict[int, List[Tuple[int, float]]] = {}
+        # how the edge between two nodes (smaller id first) is unpacked, edge index or -(middle node + 1) for shortcuts
+        self._via: Dict[Tuple[int, int], int] = {}
+        self._spaces: 'OrderedDict[int, Tuple[Dict[int, float], Dict[int, int]]]' = OrderedDict()
+
+    @classmethod
+    def build(cls, component: ComponentArrays, feedback: 'QgsFeedback' = None) -> Optional['ContractionHierarchy']:
+        """Build the hierarchy of a connected component.
+
+        Args:
+            component (ComponentArrays): the component
+            feedback (QgsFeedback, optional): cancellation
+
+        Returns:
+            Optional[ContractionHierarchy]: the hierarchy, None if canceled
+        """
+        started = time.perf_counter()
+        hierarchy = cls(component.weight, component.revision)
+        adjacency: Dict[int, Dict[int, Tuple[float, int]]] = {node: {} for node in component.nodes.tolist()}
+
+        # parallel lines collapse to the cheapest one, closed lines are never on a shortest path
+        for (u, v), edge, cost in zip(component.edge_nodes.tolist(), component.edges.tolist(), component.weights.tolist()):
+            if u != v and cost < adjacency[u].get(v, (math.inf, -1))[0]:
+                adjacency[u][v] = (cost, edge)
+                adjacency[v][u] = (cost, edge)
+
+        deleted_neighbors: Dict[int, int] = {node: 0 for node in adjacency}
+        queue = [(hierarchy._priority(adjacency, node, deleted_neighbors)[0], node) for node in adjacency]
+        queue.sort()
+        contracted = 0
+
+        while queue:
+            (_priority, node) = heappop(queue)
+            (current, shortcuts) = hierarchy._priority(adjacency, node, deleted_neighbors)
+
+            # lazy updates, the priority is recalculated only when the node gets to the top
+            if queue and current > queue[0][0]:
+                heappush(queue, (current, node))
+                continue
+
+            hierarchy._contract(adjacency, node, shortcuts, deleted_neighbors)
+            contracted += 1
+
+            if feedback and contracted % 1000 == 0 and feedback.isCanceled():
+                return None
+
+        hierarchy.build_time = time.perf_counter() - started
+
+        return hierarchy
+
+    def _shortcuts(self, adjacency: Dict[int, Dict[int, Tuple[float, int]]], node: int) -> List[Tuple[int, int, float]]:
+        """Get the shortcuts needed between the neighbours of a node, if it was contracted now."""
+        neighbors = adjacency[node]
+        targets = list(neighbors.keys())
+        shortcuts = []
+
+        for idx, source in enumerate(targets[:-1]):
+            source_cost = neighbors[source][0]
+            others = targets[idx + 1:]
+            limit = source_cost + max(neighbors[target][0] for target in others)
+            dist = self._witness_search(adjacency, source, node, limit, others)
+
+            for target in others:
+                cost = source_cost + neighbors[target][0]
+
+                if dist.get(target, math.inf) > cost:
+                    shortcuts.append((source, target, cost))
+
+        return shortcuts
+
+    def _witness_search(self, adjacency: Dict[int, Dict[int, Tuple[float, int]]], source: int, excluded: int, limit: float,
+                        targets: Collection[int]) -> Dict[int, float]:
+        dist: Dict[int, float] = {}
+        seen = {source: 0.0}
+        fringe = [(0.0, source)]
+        remaining = len(targets)
+
+        while fringe and remaining and len(dist) < self.WITNESS_SETTLED_LIMIT:
+            (d, v) = heappop(fringe)
+
+            if v in dist:
+                continue
+
+            if d > limit:
+                break
+
+            dist[v] = d
+
+            if v in targets:
+                remaining -= 1
+
+            for u, (cost, _via) in adjacency[v].items():
+                vu_dist = d + cost
+
+                if u != excluded and u not in dist and vu_dist < seen.get(u, math.inf):
+                    seen[u] = vu_dist
+                    heappush(fringe, (vu_dist, u))
+
+        return dist
+
+    def _priority(self, adjacency: Dict[int, Dict[int, Tuple[float, int]]], node: int,
+                  deleted_neighbors: Dict[int, int]) -> Tuple[int, List[Tuple[int, int, float]]]:
+        """Get the edge difference plus the contracted neighbours of a node, and the shortcuts of the node."""
+        shortcuts = self._shortcuts(adjacency, node)
+
+        return (len(shortcuts) - len(adjacency[node]) + deleted_neighbors[node], shortcuts)
+
+    def _contract(self, adjacency: Dict[int, Dict[int, Tuple[float, int]]], node: int, shortcuts: List[Tuple[int, int, float]],
+                  deleted_neighbors: Dict[int, int]) -> None:
+        neighbors = adjacency.pop(node)
+
+        # all the remaining neighbours are contracted later, so they are higher in the hierarchy
+        self._up[node] = [(target, cost) for target, (cost, _via) in neighbors.items()]
+
+        for target, (_cost, via) in neighbors.items():
+            del adjacency[target][node]
+            deleted_neighbors[target] += 1
+            self._via[(min(node, target), max(node, target))] = via
+
+        for (source, target, cost) in shortcuts:
+            if cost < adjacency[source].get(target, (math.inf, -1))[0]:
+                adjacency[source][target] = (cost, -(node + 1))
+                adjacency[target][source] = (cost, -(node + 1))
+                self.shortcuts += 1
+
+    def search_space(self, source: int) -> Tuple[Dict[int, float], Dict[int, int]]:
+        """Get the upward search from a node, the last few are kept for the next queries.
+
+        Args:
+            source (int): node id
+
+        Returns:
+            Tuple[Dict[int, float], Dict[int, int]]: the distance and the previous node of every node reached upwards
+        """
+        space = self._spaces.get(source)
+
+        if space is not None:
+            self._spaces.move_to_end(source)
+            return space
+
+        dist: Dict[int, float] = {}
+        pred: Dict[int, int] = {}
+        seen = {source: 0.0}
+        seen_pred = {source: -1}
+        fringe = [(0.0, source)]
+
+        while fringe:
+            (d, v) = heappop(fringe)
+
+            if v in dist:
+                continue
+
+            dist[v] = d
+            pred[v] = seen_pred[v]
+
+            for u, cost in self._up.get(v, ()):
+                vu_dist = d + cost
+
+                if vu_dist < seen.get(u, math.inf):
+                    seen[u] = vu_dist
+                    seen_pred[u] = v
+                    heappush(fringe, (vu_dist, u))
+
+        self._spaces[source] = (dist, pred)
+
+        while len(self._spaces) > 64:
+            self._spaces.popitem(last=False)
+
+        return (dist, pred)
+
+    def distance(self, source: int, target: int) -> Tuple[float, int]:
+        """Get the shortest distance between two nodes.
+
+        Args:
+            source (int): node id
+            target (int): node id
+
+        Returns:
+            Tuple[float, int]: the distance and the node where the upward searches meet, (inf, -1) if not connected
+        """
+        (source_dist, _pred) = self.search_space(source)
+        (target_dist, _pred) = self.search_space(target)
+
+        if len(source_dist) > len(target_dist):
+            (source_dist, target_dist) = (target_dist, source_dist)
+
+        return min(((d + target_dist[v], v) for v, d in source_dist.items() if v in target_dist), default=(math.inf, -1))
+
+    def path_edges(self, source: int, target: int) -> List[int]:
+        """Get the edges of the shortest path between two nodes.
+
+        Args:
+            source (int): node id
+            target (int): node id
+
+        Raises:
+            NoSuitableGraphError: the nodes are not connected
+
+        Returns:
+            List[int]: edge indices
+        """
+        (_distance, meet) = self.distance(source, target)
+
+        if meet == -1:
+            raise NoSuitableGraphError()
+
+        edges: List[int] = []
+
+        for end in (source, target):
+            (_dist, pred) = self.search_space(end)
+            node = meet
+
+            while pred[node] != -1:
+                edges.extend(self._unpack(pred[node], node))
+                node = pred[node]
+
+        return edges
+
+    def _unpack(self, u: int, v: int) -> List[int]:
+        edges = []
+        stack = [(u, v)]
+
+        while stack:
+            (a, b) = stack.pop()
+            via = self._via[(min(a, b), max(a, b))]
+
+            if via >= 0:
+                edges.append(via)
+            else:
+                middle = -via - 1
+                stack.append((a, middle))
+                stack.append((middle, b))
+
+        return edges
+
+    def nbytes(self) -> int:
+        return (sum(len(edges) for edges in self._up.values()) + len(self._via)) * self.EDGE_BYTES
+
+
+def _symmetric_matrix(node_count: int, edge_nodes: np.ndarray, edges: np.ndarray, weights: np.ndarray) -> Tuple['csr_matrix', np.ndarray]:
+    """Build the symmetric CSR matrix of an undirected multigraph for `scipy.sparse.csgraph`.
+
+    Closed lines are dropped and only the cheapest of the parallel lines is kept, with the smallest
+    edge index on ties. The zero weights are kept as explicit entries, csgraph takes them as edges.
+
+    Args:
+        node_count (int): number of nodes
+        edge_nodes (np.ndarray): (m, 2) array with the node ids of each edge
+        edges (np.ndarray): edge index of each edge
+        weights (np.ndarray): weight of each edge
+
+    Returns:
+        Tuple[csr_matrix, np.ndarray]: the matrix and the edge index of each of its entries
+    """
+    u = np.concatenate((edge_nodes[:, 0], edge_nodes[:, 1])).astype(np.int64)
+    v = np.concatenate((edge_nodes[:, 1], edge_nodes[:, 0])).astype(np.int64)
+    w = np.concatenate((weights, weights)).astype(np.float64)
+    e = np.concatenate((edges, edges)).astype(np.int64)
+    kept = u != v
+    (u, v, w, e) = (u[kept], v[kept], w[kept], e[kept])
+
+    order = np.lexsort((e, w, v, u))
+    (u, v, w, e) = (u[order], v[order], w[order], e[order])
+    first = np.ones(len(u), dtype=bool)
+    first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    (u, v, w, e) = (u[first], v[first], w[first], e[first])
+
+    indptr = np.searchsorted(u, np.arange(node_count + 1))
+    matrix = csr_matrix((w, v, indptr), shape=(node_count, node_count))
+
+    return matrix, e
+
+
+def metric_closure(component: ComponentArrays, G: nx.MultiGraph = None) -> MetricClosure:
+    """Calculate the metric closure of a component with networkx.
+
+    Args:
+        component (ComponentArrays): the component
+        G (nx.MultiGraph, optional): the networkx graph of the component, built from `component` if None
+
+    Raises:
+        nx.NetworkXError: the component is not connected
+
+    Returns:
+        MetricClosure: the metric closure
+    """
+    return MetricClosure(G if G is not None else component.to_networkx(), weight=component.weight)
+
+
+def scipy_metric_closure(component: ComponentArrays, G: nx.MultiGraph = None, block_cells: int = CLOSURE_BLOCK_CELLS) -> MetricClosure:
+    """Calculate the metric closure of a component with one `scipy.sparse.csgraph` Dijkstra per row block.
+
+    Negative weights are left to `metric_closure`, csgraph rejects them.
+
+    Args:
+        component (ComponentArrays): the component
+        G (nx.MultiGraph, optional): the networkx graph of the component, built from `component` if None
+        block_cells (int, optional): size of the distance matrix blocks calculated at once
+
+    Raises:
+        nx.NetworkXError: the component is not connected
+
+    Returns:
+        MetricClosure: the metric closure
+    """
+    if np.any(component.weights < 0):
+        return metric_closure(component, G)
+
+    node_count = len(component.nodes)
+    local_edge_nodes = np.searchsorted(component.nodes, component.edge_nodes)
+    (matrix, _edges) = _symmetric_matrix(node_count, local_edge_nodes, component.edges, component.weights)
+    predecessor = np.empty((node_count, node_count), dtype=np.int16 if node_count < 2 ** 15 else np.int32)
+    rows = max(block_cells // max(node_count, 1), 1)
+
+    for start in range(0, node_count, rows):
+        (dist, pred) = csgraph.dijkstra(matrix, indices=np.arange(start, min(start + rows, node_count)), return_predecessors=True)
+
+        if np.isinf(dist).any():
+            raise nx.NetworkXError("G is not a connected graph. metric_closure is not defined.")
+
+        pred[pred < 0] = -1
+        predecessor[start:start + rows] = pred
+
+    # `MetricClosure` indexes the nodes in the order of G, which are the sorted component nodes in both cases
+    return MetricClosure(G if G is not None else component.to_networkx(), weight=component.weight, predecessor=predecessor)
+
+
+def preprocess_components(jobs: List[Tuple[ComponentArrays, bool, bool]],
+                          use_scipy: bool = True) -> List[Tuple[int, Optional[MetricClosure], Optional[ContractionHierarchy]]]:
+    """Calculate the metric closures and build the contraction hierarchies of some components, in a worker process.
+
+    Args:
+        jobs (List[Tuple[ComponentArrays, bool, bool]]): the components, whether the closure and whether the hierarchy is needed
+        use_scipy (bool, optional): calculate the closures with SciPy if it is installed, like the SciPy routing backend
+
+    Returns:
+        List[Tuple[int, Optional[MetricClosure], Optional[ContractionHierarchy]]]: the component label, closure and hierarchy of each job
+    """
+    closure_func = scipy_metric_closure if use_scipy and csgraph is not None else metric_closure
+    results = []
+
+    for (component, closure, hierarchy) in jobs:
+        results.append((
+            component.label,
+            closure_func(component) if closure else None,
+            ContractionHierarchy.build(component) if hierarchy else None,
+        ))
+
+    return results
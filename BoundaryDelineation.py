@@ -1,13 +1,26 @@
 """Main file boundary delineation.
 
 Attributes:
+    ALTERNATIVE_PATHS_COUNT (int): number of the cheapest paths between two selected vertices the user can cycle through
     API_KEY (str): ITS4LAND API key
     API_URL (str): its4land API url
     BOUNDARY_ATTR_NAME (str): default boundary weight attribute, that comes from the extraction algorithm
     DEFAULT_SELECTION_MODE (SelectionMode): the default values that is preselected as candidate selection mode
-    MODE_VERTICES_EXTENT_LIMIT (int): the maximum number of vertices in the current map extent, when the NODES mode can be enabled
-    MODE_VERTICES_LIMIT (int): the maximum number of vertices in the whole map, when the NODES mode graph can be precalculated
-    PRECALCULATE_METRIC_CLOSURES (bool): should precalculate vertices graphs, or delay it until immediate need
+    POLYGONIZE_REGION_GROW_LIMIT (int): how many times the region around the edits can grow, before the whole segments layer is polygonized again
+    PRECALCULATE_CONTRACTION_HIERARCHIES (bool): should build the contraction hierarchies of the vertices graph in the same background task,
+        before the metric closures
+    PRECALCULATE_METRIC_CLOSURES (bool): should precalculate the metric closures of the vertices graph in a background task,
+        until they are ready the selections are searched around the selected vertices
+    PRECALCULATE_PROCESSES (int): number of worker processes for the precalculation, one CPU is left for QGIS
+    ROUTING_CACHE_BYTES (int): memory budget for the metric closures and contraction hierarchies of all the weights, the least recently used are evicted
+    SHORTEST_PATH_TREES_CACHE_BYTES (int): memory budget for the shortest path trees that are kept between NODES mode selections
+    STEINER_QUERY_LOG_FILENAME (str): CSV file in the temporary directory, where the time and method of every NODES mode selection is appended,
+        only if `STEINER_QUERY_LOG_SETTING` is enabled
+    STEINER_QUERY_LOG_SETTING (str): boolean QSettings key, that enables the `STEINER_QUERY_LOG_FILENAME` file
+    TILED_GRAPH_MAX_MARGIN (int): how many tiles around the selected vertices can be loaded, before giving up on connecting them
+    VERTICES_GRAPH_MEMORY_BYTES (int): memory budget of the NODES mode graph, bigger segment layers are loaded in tiles around the selection
+    VERTICES_NODE_GRID (float): cell size of the grid the segment ends are snapped to in the NODES mode graph, in layer units,
+        vertices in the same cell are the same node
     SelectBehaviour (TYPE): Default select behaviour
 
 Notes:
@@ -57,16 +70,15 @@ from typing import Optional, Collection
 if os.path.join(os.path.dirname(__file__) + '/lib') not in sys.path:
     sys.path.insert(0, os.path.join(os.path.dirname(__file__) + '/lib'))
 
-import networkx as nx
-import processing
+import numpy as np
 
 from PyQt5.QtCore import QSettings, QTranslator, Qt, QVariant, QCoreApplication
 from PyQt5.QtWidgets import QAction, QToolBar, QMessageBox
 from PyQt5.QtGui import QIcon
 
 from qgis.core import QgsProject, QgsCoordinateReferenceSystem, QgsLayerTree, QgsLayerTreeNode, QgsPointXY, QgsVectorLayer, \
-    QgsRasterLayer, QgsMapLayer, QgsWkbTypes, QgsVectorFileWriter, QgsCoordinateTransform, QgsField, QgsDefaultValue, QgsRectangle, QgsFeatureIterator, \
-    QgsFeature, QgsGeometry, QgsTolerance, QgsMapSettings, QgsUnitTypes
+    QgsRasterLayer, QgsMapLayer, QgsWkbTypes, QgsVectorFileWriter, QgsCoordinateTransform, QgsField, QgsRectangle, QgsFeatureIterator, \
+    QgsFeature, QgsFeatureRequest, QgsGeometry, QgsTolerance, QgsMapSettings, QgsApplication
 from qgis.gui import QgisInterface, QgsMapTool
 from qgis.utils import iface
 from qgis.utils import *
@@ -78,15 +90,27 @@ from .Its4landAPI import Its4landAPI
 from .BoundaryDelineationDock import BoundaryDelineationDock
 from .MapSelectionTool import MapSelectionTool
 from . import utils
-from .utils import PLUGIN_DIR, APP_NAME, SelectionModes, processing_cursor, __, show_info, get_group, reproject
-from .BoundaryGraph import NoSuitableGraphError, prepare_graph_from_lines, prepare_subgraphs, calculate_subgraphs_metric_closures, \
-    find_steiner_tree, DEFAULT_WEIGHT_NAME
+from .utils import PLUGIN_DIR, APP_NAME, SelectionModes, ProcessingTask, TaskScheduler, processing_cursor, __, show_info, get_group
+from .BoundaryGraph import NoSuitableGraphError, WeightExpressionError, CompactGraph, ContractedGraph, TiledGraph, WeightExpression, ShortestPathTreeCache, \
+    ComponentIndex, read_layer_lines, update_graph_from_lines, prepare_weights, numeric_fields_names, prepare_components, \
+    MetricClosuresTask, AlternativePathsTask, RoutingCache, SteinerQueryLog, find_steiner_tree, grid_key, DEFAULT_WEIGHT_NAME
+from .BoundaryPreprocessing import SegmentsSource, SimplifiedSegments, SegmentsGraphs, stream_segments, build_segments_graphs, write_vertices_layer, \
+    polygonize_segments, reproject_segments, needs_reprojection, working_crs, VERTEX_NODE_FIELD, VERTEX_DEGREE_FIELD, VERTEX_COMPONENT_FIELD
 
 BOUNDARY_ATTR_NAME = 'boundary'
-PRECALCULATE_METRIC_CLOSURES = False
+ALTERNATIVE_PATHS_COUNT = 5
+PRECALCULATE_METRIC_CLOSURES = True
+PRECALCULATE_CONTRACTION_HIERARCHIES = True
+PRECALCULATE_PROCESSES = max((os.cpu_count() or 1) - 1, 1)
 DEFAULT_SELECTION_MODE = SelectionModes.ENCLOSING
-MODE_VERTICES_EXTENT_LIMIT = 300
-MODE_VERTICES_LIMIT = 1000
+SHORTEST_PATH_TREES_CACHE_BYTES = 128 * 1024 * 1024
+ROUTING_CACHE_BYTES = 512 * 1024 * 1024
+STEINER_QUERY_LOG_FILENAME = 'steiner_queries.csv'
+STEINER_QUERY_LOG_SETTING = 'BoundaryDelineation/steinerQueryLog'
+VERTICES_GRAPH_MEMORY_BYTES = 512 * 1024 * 1024
+VERTICES_NODE_GRID = 1e-6
+TILED_GRAPH_MAX_MARGIN = 8
+POLYGONIZE_REGION_GROW_LIMIT = 5
 
 SelectBehaviour = int
 
@@ -129,7 +153,14 @@ class BoundaryDelineation:
         self.verticesLayer: Optional[QgsVectorLayer] = None
         self.candidatesLayer: Optional[QgsVectorLayer] = None
         self.finalLayer: Optional[QgsVectorLayer] = None
+        # the feature id of the vertex of each graph node, -1 for the nodes without a vertex
+        self.verticesFids: Optional[np.ndarray] = None
         self.finalLayerPolygons: Optional[QgsVectorLayer] = None
+        # the segments reprojected to the metric working CRS, kept until the segments layer changes
+        self.workingSegmentsLayer: Optional[QgsVectorLayer] = None
+        self.workingSegmentsSource: Optional[QgsVectorLayer] = None
+        # from the project CRS to the CRS of the simplified segments and the layers derived from them
+        self.workingTransform: Optional[QgsCoordinateTransform] = None
 
         self.actions: typing.List[QAction] = []
         self.canvas = self.iface.mapCanvas()
@@ -145,9 +176,21 @@ class BoundaryDelineation:
         self.dockWidget: Optional[BoundaryDelineationDock] = None
         self.edgesWeightField = DEFAULT_WEIGHT_NAME
         self.lengthAttributeName = 'BD_LEN'
-        self.metricClosureGraphs: typing.Dict[str, typing.Any] = {}
-        self.graph: Optional[nx.MultiGraph] = None
-        self.subgraphs: Optional[Collection[nx.Graph]] = None
+        self.routingCache = RoutingCache(ROUTING_CACHE_BYTES)
+        self.graph: Optional[CompactGraph] = None
+        self.routingGraph: Optional[ContractedGraph] = None
+        self.tiledGraph: Optional[TiledGraph] = None
+        self.weightExpressions: typing.Dict[str, WeightExpression] = {}
+        self.components: Optional[ComponentIndex] = None
+        self.firstStepScheduler: Optional[TaskScheduler] = None
+        self.metricClosuresTask: Optional[MetricClosuresTask] = None
+        self.alternativePathsTask: Optional[AlternativePathsTask] = None
+        self.alternativePaths: typing.List[typing.List[typing.Any]] = []
+        self.alternativePathIndex = 0
+        self.shortestPathTrees = ShortestPathTreeCache(SHORTEST_PATH_TREES_CACHE_BYTES)
+        # the query timings can be kept in the temporary directory, to tune the exact Steiner tree thresholds
+        steinerQueriesPath = utils.get_tmp_path(STEINER_QUERY_LOG_FILENAME) if QSettings().value(STEINER_QUERY_LOG_SETTING, False, type=bool) else None
+        self.steinerQueries = SteinerQueryLog(path=steinerQueriesPath)
         self.simplifiedSegmentsNumericFields: Optional[typing.Dict[str, typing.Any]] = None
 
         self.mapSelectionTool = MapSelectionTool(self.canvas)
@@ -204,7 +247,6 @@ class BoundaryDelineation:
         self.dockWidget.closingPlugin.connect(self.onClosePlugin)
 
         self.canvas.mapToolSet.connect(self.onMapToolSet)
-        self.canvas.extentsChanged.connect(self.onExtentsChanged)
 
 
     def unload(self) -> None:
@@ -221,9 +263,9 @@ class BoundaryDelineation:
         # self.layerTree.willRemoveChildren.disconnect(self.onLayerTreeWillRemoveChildren)
 
         self.toggleMapSelectionTool(False)
+        self.cancelFirstStep()
 
         self.canvas.mapToolSet.disconnect(self.onMapToolSet)
-        self.canvas.extentsChanged.disconnect(self.onExtentsChanged)
 
         if self.dockWidget:
             self.iface.removeDockWidget(self.dockWidget)
@@ -310,11 +352,38 @@ class BoundaryDelineation:
         if mergedLinesLayer.featureCount() == 0:
             return
 
-        self.simplifiedSegmentsLayer.startEditing()
+        newLines = list(mergedLinesLayer.getFeatures())
 
-        assert self.simplifiedSegmentsLayer.isEditable(), 'Unable to begin editing'
+        # only the segments touched by the new lines have to be split, the rest of the layer stays as it is
+        touchedIds = set()
+        editsExtent = QgsRectangle()
+        editsExtent.setMinimal()
 
-        for f in mergedLinesLayer.getFeatures():
+        for line in newLines:
+            geom = line.geometry()
+            editsExtent.combineExtentWith(geom.boundingBox())
+
+            for f in self.simplifiedSegmentsLayer.getFeatures(QgsFeatureRequest().setFilterRect(geom.boundingBox())):
+                if f.geometry().intersects(geom):
+                    touchedIds.add(f.id())
+                    editsExtent.combineExtentWith(f.geometry().boundingBox())
+
+        # the graph around the edits has to be loaded before the edits, so it can be updated in place
+        if self.tiledGraph:
+            self.loadTiledVerticesGraph(editsExtent)
+
+        newFeatures = []
+
+        if touchedIds:
+            touchedLayer = self.simplifiedSegmentsLayer.materialize(QgsFeatureRequest().setFilterFids(list(touchedIds)))
+
+            for f in utils.split_with_lines(touchedLayer, mergedLinesLayer).getFeatures():
+                newFeature = QgsFeature(self.simplifiedSegmentsLayer.fields())
+                newFeature.setGeometry(f.geometry())
+                newFeature.setAttributes(f.attributes())
+                newFeatures.append(newFeature)
+
+        for f in newLines:
             newFeature = QgsFeature(self.simplifiedSegmentsLayer.fields())
             newFeature.setGeometry(f.geometry())
 
@@ -326,31 +395,25 @@ class BoundaryDelineation:
             # # make the line visible, otherwise there is no value for such values in the QML style
             # newFeature.setAttribute(BOUNDARY_ATTR_NAME, 1)
 
-            assert self.simplifiedSegmentsLayer.addFeature(newFeature), 'Unable to add new feature'
+            newFeatures.append(newFeature)
+
+        provider = self.simplifiedSegmentsLayer.dataProvider()
 
-        assert self.simplifiedSegmentsLayer.commitChanges(), 'Unable to commit newly added features'
+        assert provider.deleteFeatures(list(touchedIds)), 'Unable to delete the splitted features'
 
-        newSimplifiedLayer = utils.split_with_lines(self.simplifiedSegmentsLayer, mergedLinesLayer)
+        (isAdded, addedFeatures) = provider.addFeatures(newFeatures)
 
-        utils.add_layer(mergedLinesLayer)
+        assert isAdded, 'Unable to add new feature'
 
-        print(str(mergedLinesLayer.featureCount()))
-        print(str(self.simplifiedSegmentsLayer.featureCount()))
-        print(str(newSimplifiedLayer.featureCount()))
-        # print('old:' + str(self.simplifiedSegmentsLayer.featureCount()) + ',' + self.simplifiedSegmentsLayer.id() + ',' + self.simplifiedSegmentsLayer.source())
-        # print('new:' + str(newSimplifiedLayer.featureCount()) + ',' + newSimplifiedLayer.id() + ',' + newSimplifiedLayer.source())
+        self.simplifiedSegmentsLayer.updateExtents()
+        self.simplifiedSegmentsLayer.triggerRepaint()
 
-        self.setSimplifiedSegmentsLayer(newSimplifiedLayer)
-        # print('\n\n\n')
-        # utils.set_data_source(self.simplifiedSegmentsLayer, newSimplifiedLayer.source())
-        # self.simplifiedSegmentsLayer.setDataSource(newSimplifiedLayer.source(), self.simplifiedSegmentsLayer.name(), self.simplifiedSegmentsLayer.dataProvider().name())
-        # print('\n\n\n')
-        # print('ups:' + str(self.simplifiedSegmentsLayer.featureCount()) + ',' + self.simplifiedSegmentsLayer.id() + ',' + self.simplifiedSegmentsLayer.source())
+        # update the supporting layers only around the edits
+        self.updateVerticesGraph(touchedIds, [f.id() for f in addedFeatures])
 
-        # update the supporting layers
-        self.extractSegmentsVertices()
-        self.polygonizeSegmentsLayer()
-        self.buildVerticesGraph(True)
+        if self.tiledGraph:
+            self.tiledGraph.invalidate((editsExtent.xMinimum(), editsExtent.yMinimum(), editsExtent.xMaximum(), editsExtent.yMaximum()))
+        self.updatePolygonizedLayer(newLines)
 
     def onLayerTreeWillRemoveChildren(self, node: QgsLayerTreeNode, startIndex: int, endIndex: int) -> None:
         # TODO try to fix this...
@@ -376,53 +439,72 @@ class BoundaryDelineation:
     def onClosePlugin(self) -> None:
         self.actions[0].setChecked(False)
 
-    def onExtentsChanged(self) -> None:
+    def processFirstStep(self) -> None:
+        """Prepare the layers and the graph of the selection modes in background tasks.
+
+        The segments in a CRS that is not metric are reprojected once, the reprojected copy is reused by the next
+        runs. The segments are simplified first, then the graph and the polygons are prepared from them in parallel, and
+        the vertices are written from the nodes of the graph. Each task adds its layers or graph when it finishes,
+        and the vertices mode is enabled once all of them have finished. The dock shows the progress of all the tasks,
+        which can be canceled with `cancelFirstStep`.
+        """
         assert self.dockWidget
 
-        if not self.verticesLayer:
-            return
+        self.cancelFirstStep()
+        self.resetVerticesGraph()
 
-        extent = self.canvas.extent()
-        count = len(list(self.verticesLayer.getFeatures(extent)))
+        scheduler = TaskScheduler()
+        segmentsDependencies = []
 
-        self.buildVerticesGraph()
+        if self.getWorkingSegmentsLayer() is None:
+            scheduler.add('working', self.createReprojectSegmentsTask, self.setWorkingSegmentsLayer, weight=2)
+            segmentsDependencies.append('working')
 
-        if count <= MODE_VERTICES_EXTENT_LIMIT:
-            self.verticesLayer.selectByIds([])
-            self.dockWidget.toggleVerticesRadioEnabled(True)
-        else:
-            if self.selectionMode == SelectionModes.NODES:
-                self.setSelectionMode(DEFAULT_SELECTION_MODE)
-                show_info(__('Selection mode change to default'))
+        # the simplification reads the whole segments layer, it takes most of the time
+        scheduler.add('segments', self.createSimplifySegmentsTask, self.onSegmentsLayerSimplified, segmentsDependencies, weight=3)
+        scheduler.add('graph', self.createVerticesGraphTask, self.setVerticesGraph, ['segments'])
+        scheduler.add('vertices', self.createVerticesLayerTask, lambda vertices: self.setVerticesLayer(*vertices), ['segments', 'graph'])
+        scheduler.add('polygons', self.createPolygonizeTask, self.setPolygonizedLayer, ['segments'])
+        scheduler.progressChanged.connect(lambda progress, description: self.onFirstStepProgressChanged(scheduler, progress, description))
+        scheduler.finished.connect(lambda success: self.onFirstStepFinished(scheduler, success))
 
-            self.dockWidget.toggleVerticesRadioEnabled(False)
+        self.firstStepScheduler = scheduler
+        scheduler.start()
 
-    @processing_cursor()
-    def processFirstStep(self) -> None:
-        assert self.dockWidget
-
-        self.dockWidget.step1ProgressBar.setValue(5)
-
-        self.simplifySegmentsLayer()
-
-        self.addLengthAttribute()
+    def cancelFirstStep(self) -> None:
+        if not self.firstStepScheduler:
+            return
 
-        self.createCandidatesLayer()
+        # the results of the canceled tasks are ignored, even if they manage to finish
+        scheduler = self.firstStepScheduler
+        self.firstStepScheduler = None
+        scheduler.cancel()
 
-        self.dockWidget.step1ProgressBar.setValue(25)
+        if self.dockWidget:
+            self.dockWidget.setFirstStepFinished(False)
 
-        self.extractSegmentsVertices()
+    def onFirstStepProgressChanged(self, scheduler: TaskScheduler, progress: float, description: str) -> None:
+        if scheduler is not self.firstStepScheduler or not self.dockWidget:
+            return
 
-        self.dockWidget.step1ProgressBar.setValue(50)
+        self.dockWidget.setFirstStepProgress(progress, description)
 
-        self.polygonizeSegmentsLayer()
+    def onFirstStepFinished(self, scheduler: TaskScheduler, success: bool) -> None:
+        if scheduler is not self.firstStepScheduler or not self.dockWidget:
+            return
 
-        self.dockWidget.step1ProgressBar.setValue(75)
+        self.firstStepScheduler = None
 
-        self.buildVerticesGraph()
+        # one of the tasks failed, or was canceled from the QGIS task manager
+        if not success:
+            if scheduler.error:
+                show_info(__('Unable to process the segments layer: %s' % scheduler.error))
 
-        self.dockWidget.step1ProgressBar.setValue(100)
+            self.dockWidget.setFirstStepFinished(False)
+            return
 
+        self.dockWidget.toggleVerticesRadioEnabled(True)
+        self.dockWidget.setFirstStepFinished(True)
         self.setSelectionMode(DEFAULT_SELECTION_MODE)
 
     @processing_cursor()
@@ -448,6 +530,8 @@ class BoundaryDelineation:
             utils.remove_layer(self.baseRasterLayer)
             self.baseRasterLayer = None
 
+        self.resetWorkingSegmentsLayer()
+
         if not self.wasSegmentsLayerInitiallyInLegend:
             utils.remove_layer(self.segmentsLayer)
             self.segmentsLayer = None
@@ -477,7 +561,13 @@ class BoundaryDelineation:
 
         self.simplifiedSegmentsLayer = None
         self.verticesLayer = None
+        self.verticesFids = None
         self.candidatesLayer = None
+        self.cancelFirstStep()
+        self.resetVerticesGraph()
+
+        if self.dockWidget:
+            self.dockWidget.toggleVerticesRadioEnabled(False)
 
     def setBaseRasterLayer(self, baseRasterLayer: typing.Union[QgsRasterLayer, str], layer_type: str = 'gdal') -> None:
         if self.baseRasterLayer is baseRasterLayer:
@@ -544,28 +634,87 @@ class BoundaryDelineation:
 
         return False
 
-    @processing_cursor()
-    def simplifySegmentsLayer(self) -> None:
+    def getWorkingSegmentsLayer(self) -> Optional[QgsVectorLayer]:
+        """Get the segments layer in the metric working CRS.
+
+        Returns:
+            Optional[QgsVectorLayer]: the segments layer if its CRS is metric, otherwise its reprojected copy, None if it is not reprojected yet
+        """
+        assert self.segmentsLayer
+
+        if not needs_reprojection(self.segmentsLayer.crs()):
+            return self.segmentsLayer
+
+        if self.workingSegmentsSource is self.segmentsLayer:
+            return self.workingSegmentsLayer
+
+        return None
+
+    def setWorkingSegmentsLayer(self, layer: QgsVectorLayer) -> None:
         assert self.segmentsLayer
 
-        segmentsLayer = self.segmentsLayer
+        self.resetWorkingSegmentsLayer()
 
-        if self.segmentsLayer.crs() != QgsUnitTypes.DistanceMeters:
-            segmentsLayer = reproject(segmentsLayer, 'EPSG:3857')
+        self.workingSegmentsLayer = layer
+        self.workingSegmentsSource = self.segmentsLayer
+        self.segmentsLayer.dataChanged.connect(self.resetWorkingSegmentsLayer)
 
-        tolerance = self.dockWidget.getSimplificationValue()
-        result = processing.run('qgis:simplifygeometries', {
-            'INPUT': segmentsLayer,
-            'METHOD': 0,
-            'TOLERANCE': tolerance,
-            'OUTPUT': 'memory:simplifygeometries'
-        })
+    def resetWorkingSegmentsLayer(self) -> None:
+        # the segments layer may be already deleted
+        try:
+            if self.workingSegmentsSource:
+                self.workingSegmentsSource.dataChanged.disconnect(self.resetWorkingSegmentsLayer)
+        except (TypeError, RuntimeError):
+            pass
+
+        self.workingSegmentsLayer = None
+        self.workingSegmentsSource = None
+
+    def createReprojectSegmentsTask(self) -> ProcessingTask:
+        assert self.segmentsLayer
+
+        # the CRS and the features are taken here, the layer itself belongs to the main thread
+        return ProcessingTask(
+            __('Reprojecting the segments'),
+            reproject_segments,
+            SegmentsSource.from_layer(self.segmentsLayer),
+            working_crs(self.segmentsLayer)
+        )
+
+    def createSimplifySegmentsTask(self, workingLayer: QgsVectorLayer = None) -> ProcessingTask:
+        assert self.dockWidget
+
+        workingLayer = workingLayer or self.getWorkingSegmentsLayer()
+        lengthAttributeName = self.lengthAttributeName if self.shouldAddLengthAttribute else None
+
+        # the task reads the features from a source taken here, the layer itself belongs to the main thread
+        return ProcessingTask(
+            __('Simplifying the segments'),
+            stream_segments,
+            SegmentsSource.from_layer(workingLayer),
+            self.dockWidget.getSimplificationValue(),
+            None,
+            lengthAttributeName
+        )
+
+    def createVerticesGraphTask(self, segments: SimplifiedSegments) -> ProcessingTask:
+        return ProcessingTask(__('Building the vertices graph'), build_segments_graphs, segments, VERTICES_NODE_GRID, VERTICES_GRAPH_MEMORY_BYTES)
+
+    def createVerticesLayerTask(self, segments: SimplifiedSegments, graphs: SegmentsGraphs) -> ProcessingTask:
+        return ProcessingTask(__('Creating the vertices'), write_vertices_layer, segments, graphs, VERTICES_NODE_GRID)
+
+    def createPolygonizeTask(self, segments: SimplifiedSegments) -> ProcessingTask:
+        return ProcessingTask(__('Polygonizing the segments'), polygonize_segments, segments)
+
+    def onSegmentsLayerSimplified(self, segments: SimplifiedSegments) -> None:
+        assert self.segmentsLayer
 
         # if self.wasSegmentsLayerInitiallyInLegend:
         if self.layerTree.findLayer(self.segmentsLayer.id()):
             self.layerTree.findLayer(self.segmentsLayer.id()).setItemVisibilityChecked(False)
 
-        self.setSimplifiedSegmentsLayer(result['OUTPUT'])
+        self.setSimplifiedSegmentsLayer(segments.layer)
+        self.createCandidatesLayer()
 
     def setSimplifiedSegmentsLayer(self, layer: QgsVectorLayer) -> None:
         assert self.dockWidget
@@ -575,6 +724,7 @@ class BoundaryDelineation:
 
         self.simplifiedSegmentsLayer = layer
         self.simplifiedSegmentsNumericFields = dict()
+        self.weightExpressions = {}
 
         for field in self.simplifiedSegmentsLayer.fields():
             if not field.isNumeric():
@@ -605,38 +755,27 @@ class BoundaryDelineation:
             index=layerTreeIndex
         )
 
-    def addLengthAttribute(self) -> None:
-        assert self.simplifiedSegmentsLayer
-
-        if self.shouldAddLengthAttribute:
-            assert self.simplifiedSegmentsLayer.fields().indexFromName(self.lengthAttributeName) == -1
-
-            field = QgsField(self.lengthAttributeName, QVariant.Double)
-            field.setDefaultValueDefinition(QgsDefaultValue('$length', True))
-
-            self.simplifiedSegmentsLayer.dataProvider().addAttributes([field])
-            self.simplifiedSegmentsLayer.updateFields()
-            self.simplifiedSegmentsLayer.startEditing()
+    def setWeightField(self, name: str) -> None:
+        self.edgesWeightField = name or DEFAULT_WEIGHT_NAME
+        self.shortestPathTrees.invalidate(self.routingGraph.revision if self.routingGraph else None, self.edgesWeightField)
 
-            for f in self.simplifiedSegmentsLayer.getFeatures():
-                self.simplifiedSegmentsLayer.changeAttributeValue(
-                    f.id(),
-                    self.simplifiedSegmentsLayer.fields().indexFromName(self.lengthAttributeName),
-                    f.geometry().length()
-                )
+        if self.graph and not self.prepareWeights():
+            return
 
-            self.simplifiedSegmentsLayer.commitChanges()
+        self.startMetricClosuresTask()
 
-    def setWeightField(self, name: str) -> None:
-        self.edgesWeightField = name or DEFAULT_WEIGHT_NAME
+    def prepareWeights(self) -> bool:
+        assert self.graph
+        assert self.simplifiedSegmentsLayer
 
-        if PRECALCULATE_METRIC_CLOSURES:
-            if not self.graph:
-                self.buildVerticesGraph()
+        try:
+            prepare_weights(self.graph, self.simplifiedSegmentsLayer, self.edgesWeightField, self.weightExpressions)
+        except WeightExpressionError as err:
+            show_info(__('Invalid weight expression: %s' % err.message))
+            self.edgesWeightField = DEFAULT_WEIGHT_NAME
+            return False
 
-            self.metricClosureGraphs[self.edgesWeightField] = calculate_subgraphs_metric_closures(self.subgraphs, weight=self.edgesWeightField)
-        else:
-            self.metricClosureGraphs[self.edgesWeightField] = None
+        return True
 
     def isPluginLayerTreeNode(self, node: QgsLayerTree) -> bool:
         # for some reason even the normal nodes are behaving like groups...
@@ -708,64 +847,363 @@ class BoundaryDelineation:
         self.candidatesLayer = candidatesLayer
         self.finalLayer = finalLayer
 
-    def extractSegmentsVertices(self) -> QgsVectorLayer:
-        assert self.simplifiedSegmentsLayer
-
+    def setVerticesLayer(self, layer: QgsVectorLayer, fids: np.ndarray = None) -> None:
         # if there is already created vertices layer, remove it
         utils.remove_layer(self.verticesLayer)
 
-        # 0, -1 mean last and first vertex
-        verticesLayer = utils.extract_specific_vertices(self.simplifiedSegmentsLayer, '0, -1')
-        verticesLayer = utils.delete_duplicate_geometries(verticesLayer)
-
-        self.verticesLayer = verticesLayer
+        self.verticesLayer = layer
+        self.verticesFids = fids
+        # the vertices of the tiled graph nodes are looked up by their coordinates
+        self.verticesLayer.dataProvider().createSpatialIndex()
 
         utils.add_layer(self.verticesLayer, self.verticesLayerName, color=(255, 0, 0), size=1.3, parent=get_group(), index=0)
 
-        return self.verticesLayer
-
-    def polygonizeSegmentsLayer(self) -> QgsVectorLayer:
+    def polygonizeSegmentsLayer(self) -> None:
         assert self.simplifiedSegmentsLayer
 
-        self.polygonizedLayer = utils.polyginize_lines(self.simplifiedSegmentsLayer)
+        self.setPolygonizedLayer(utils.polyginize_lines(self.simplifiedSegmentsLayer))
+
+    def setPolygonizedLayer(self, layer: QgsVectorLayer) -> None:
+        self.polygonizedLayer = layer
+
+    def setVerticesGraph(self, graphs: SegmentsGraphs) -> None:
+        (self.tiledGraph, self.graph, self.routingGraph, self.components) = graphs
+
+        if self.graph:
+            self.prepareWeights()
+            self.startMetricClosuresTask()
+
+    def resetVerticesGraph(self) -> None:
+        self.cancelMetricClosuresTask()
+        self.resetAlternativePaths()
+        self.graph = None
+        self.routingGraph = None
+        self.tiledGraph = None
+        self.components = None
+        self.routingCache.clear()
+        self.shortestPathTrees.clear()
+        self.updateRoutingCacheStats()
 
     def buildVerticesGraph(self, force: bool = False) -> None:
+        assert self.simplifiedSegmentsLayer
+
+        if force:
+            self.resetVerticesGraph()
+
+        if self.graph or self.tiledGraph:
+            return
+
+        layer = self.simplifiedSegmentsLayer
+        # the geometries are only needed by the polygonizer
+        segments = SimplifiedSegments(layer, layer.crs(), read_layer_lines(layer, numeric_fields_names(layer)), [])
+
+        self.setVerticesGraph(build_segments_graphs(segments, VERTICES_NODE_GRID, VERTICES_GRAPH_MEMORY_BYTES))
+
+    def loadTiledVerticesGraph(self, rect: QgsRectangle, margin: int = 1) -> None:
+        assert self.tiledGraph
+
+        self.graph = self.tiledGraph.graph((rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()), margin)
+
+        if not self.routingGraph or self.routingGraph.original is not self.graph:
+            self.routingGraph = ContractedGraph.from_graph(self.graph)
+            self.components = prepare_components(self.routingGraph)
+
+    def updateVerticesGraph(self, removedIds: Collection[int], addedIds: Collection[int]) -> None:
         assert self.verticesLayer
         assert self.simplifiedSegmentsLayer
 
-        extent = self.canvas.extent()
-        extent = self.__getCoordinateTransform(self.polygonizedLayer).transform(extent)
+        if not self.graph:
+            return
+
+        # the task reads the graph, it is started again for the missing closures once the graph is updated
+        self.cancelMetricClosuresTask()
+        self.resetAlternativePaths()
 
-        count = len(list(self.verticesLayer.getFeatures(extent)))
+        oldLabels = self.graph.component_labels().copy()
+        change = update_graph_from_lines(self.graph, self.simplifiedSegmentsLayer, removedIds, addedIds)
 
-        if force:
-            self.graph = None
-            self.subgraphs = None
-            self.metricClosureGraphs[self.edgesWeightField] = None
+        if self.routingGraph and self.components:
+            routingChange = self.routingGraph.update_from(change)
+            changedLabels = self.components.apply_change(routingChange)
 
-        if self.verticesLayer.featureCount() <= MODE_VERTICES_LIMIT:
-            if not self.graph:
-                self.graph = prepare_graph_from_lines(self.simplifiedSegmentsLayer)
-                self.subgraphs = prepare_subgraphs(self.graph)
-                self.metricClosureGraphs[self.edgesWeightField] = self.calculateMetricClosure(self.subgraphs) if PRECALCULATE_METRIC_CLOSURES else None
+            self.shortestPathTrees.apply_change(routingChange)
 
-            return None
+            # the closures and hierarchies of the changed components are no longer valid, for all the weights
+            self.routingCache.apply_change(routingChange, changedLabels)
 
-        if count <= MODE_VERTICES_EXTENT_LIMIT:
-            self.graph = prepare_graph_from_lines(self.simplifiedSegmentsLayer, filter_expr=extent)
-            self.subgraphs = prepare_subgraphs(self.graph)
-            self.metricClosureGraphs[self.edgesWeightField] = self.calculateMetricClosure(self.subgraphs) if PRECALCULATE_METRIC_CLOSURES else None
+            # the update has dropped the weights of the expressions, they are evaluated again before the closures are built
+            if self.prepareWeights():
+                self.startMetricClosuresTask()
+
+        # the vertices layer gets the new nodes, loses the ones without any line left,
+        # and the nodes with new lines or in merged or split components get their new attributes
+        provider = self.verticesLayer.dataProvider()
+        fields = self.verticesLayer.fields()
+        degrees = self.graph.degrees()
+        labels = self.graph.component_labels()
+        changedNodes = {node for node in change.touched_nodes if node < len(oldLabels)}
+
+        if not self.tiledGraph:
+            # joining or splitting a component relabels all the nodes on one side
+            changedNodes.update(np.flatnonzero(labels[:len(oldLabels)] != oldLabels).tolist())
+
+        if self.verticesFids is not None:
+            fids = np.concatenate((self.verticesFids, np.full(len(degrees) - len(self.verticesFids), -1, dtype=np.int64)))
+            vertexFids = {node: [fid] if fid >= 0 else [] for node, fid in zip(changedNodes, fids[list(changedNodes)].tolist())}
         else:
-            self.graph = None
-            self.subgraphs = None
-            self.metricClosureGraphs[self.edgesWeightField] = None
+            # the nodes of the tiled graph are not the rows of the vertices layer, they are found by their coordinates
+            fids = None
+            vertexFids = {}
+
+            for node in changedNodes:
+                point = QgsPointXY(*self.graph.node_point(node))
+                vertexFids[node] = [f.id() for f in self.verticesLayer.getFeatures(QgsRectangle(point, point))]
+
+        newNodes = change.added_nodes.tolist()
+        removedVertices = []
+        changedAttributes = {}
+
+        for node, nodeFids in vertexFids.items():
+            if degrees[node] == 0:
+                removedVertices.extend(nodeFids)
+            elif nodeFids:
+                attributes = dict(enumerate(self.getVertexAttributes(node, degrees, labels)))
+                changedAttributes.update((fid, attributes) for fid in nodeFids)
+            elif fids is not None:
+                # the vertex was removed when the node lost its last line
+                newNodes.append(node)
+
+        newVertices = []
+
+        for node in newNodes:
+            f = QgsFeature(fields)
+            f.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(*self.graph.node_point(node))))
+            f.setAttributes(self.getVertexAttributes(node, degrees, labels))
+            newVertices.append(f)
+
+        provider.deleteFeatures(removedVertices)
+        provider.changeAttributeValues(changedAttributes)
+        (ok, addedVertices) = provider.addFeatures(newVertices)
+
+        if not ok:
+            # the new vertices may be missing or without their ids, the vertices are found by their coordinates from now on
+            self.verticesFids = None
+        elif fids is not None:
+            fids[[node for node in changedNodes if degrees[node] == 0]] = -1
+            fids[newNodes] = [f.id() for f in addedVertices]
+            self.verticesFids = fids
+
+        self.verticesLayer.updateExtents()
+        self.verticesLayer.triggerRepaint()
+
+    def updatePolygonizedLayer(self, lines: Collection[QgsFeature]) -> None:
+        assert self.simplifiedSegmentsLayer
 
-    @processing_cursor()
-    def calculateMetricClosure(self, subgraphs: Collection) -> typing.List[typing.Any]:
-        assert self.subgraphs
+        # the polygons crossed by the new lines and the area of the new lines have to be polygonized again.
+        # Polygons from the segments in this region are correct as long as they are fully inside it.
+        region = QgsRectangle()
+        region.setMinimal()
+
+        for line in lines:
+            region.combineExtentWith(line.geometry().boundingBox())
+
+        for line in lines:
+            geom = line.geometry()
+
+            for f in self.polygonizedLayer.getFeatures(QgsFeatureRequest().setFilterRect(geom.boundingBox())):
+                if f.geometry().intersects(geom):
+                    region.combineExtentWith(f.geometry().boundingBox())
+
+        for _i in range(POLYGONIZE_REGION_GROW_LIMIT):
+            segmentsLayer = self.simplifiedSegmentsLayer.materialize(QgsFeatureRequest().setFilterRect(region))
+            polygons = list(utils.polyginize_lines(segmentsLayer).getFeatures())
+            outside = [f.geometry().boundingBox() for f in polygons if not region.contains(f.geometry().boundingBox())]
+
+            if not outside:
+                break
+
+            for rect in outside:
+                region.combineExtentWith(rect)
+        else:
+            self.polygonizeSegmentsLayer()
+            return
 
-        show_info(__('It may take some time to precalculate the most optimal boundaries...'))
-        return calculate_subgraphs_metric_closures(self.subgraphs, weight=self.edgesWeightField)
+        provider = self.polygonizedLayer.dataProvider()
+        removedIds = [f.id() for f in self.polygonizedLayer.getFeatures(region) if region.contains(f.geometry().boundingBox())]
+
+        provider.deleteFeatures(removedIds)
+        provider.addFeatures(polygons)
+
+        self.polygonizedLayer.updateExtents()
+
+    def startMetricClosuresTask(self) -> None:
+        """Calculate the missing contraction hierarchies and metric closures of the current weight in a background task.
+
+        They are used as soon as the task finishes, until then the selections are searched around the selected vertices.
+        Only the components changed since the last task are calculated again.
+        """
+        self.cancelMetricClosuresTask()
+
+        # the tiles around the selection are not worth precalculating
+        if not self.routingGraph or not self.components or self.tiledGraph:
+            return
+
+        componentLabels = self.components.labels(min_size=2)
+        labels = []
+        hierarchyLabels = []
+
+        revision = self.routingGraph.revision
+
+        if PRECALCULATE_METRIC_CLOSURES:
+            labels = self.routingCache.missing(revision, self.edgesWeightField, RoutingCache.CLOSURE, componentLabels)
+            # a closure bigger than the whole cache would be evicted right away
+            labels = [label for label in labels if len(self.components.nodes(label)) ** 2 * 2 <= self.routingCache.max_bytes]
+
+        if PRECALCULATE_CONTRACTION_HIERARCHIES:
+            hierarchyLabels = self.routingCache.missing(revision, self.edgesWeightField, RoutingCache.HIERARCHY, componentLabels)
+
+        if not labels and not hierarchyLabels:
+            return
+
+        task = MetricClosuresTask(self.routingGraph, self.edgesWeightField, labels, hierarchyLabels, PRECALCULATE_PROCESSES)
+        task.progressChanged.connect(self.onMetricClosuresTaskProgressChanged)
+        task.taskCompleted.connect(lambda: self.onMetricClosuresTaskFinished(task))
+        task.taskTerminated.connect(lambda: self.onMetricClosuresTaskFinished(task))
+
+        self.metricClosuresTask = task
+        QgsApplication.taskManager().addTask(task)
+
+        if self.dockWidget:
+            self.dockWidget.setMetricClosuresProgress(0)
+
+    def cancelMetricClosuresTask(self) -> None:
+        if not self.metricClosuresTask:
+            return
+
+        # the results of the canceled task are ignored, even if it manages to finish
+        task = self.metricClosuresTask
+        self.metricClosuresTask = None
+        task.cancel()
+
+        if self.dockWidget:
+            self.dockWidget.setMetricClosuresProgress(None)
+
+    def onMetricClosuresTaskProgressChanged(self, progress: float) -> None:
+        if self.dockWidget and self.metricClosuresTask:
+            self.dockWidget.setMetricClosuresProgress(progress)
+
+    def onMetricClosuresTaskFinished(self, task: MetricClosuresTask) -> None:
+        if task is not self.metricClosuresTask:
+            return
+
+        self.metricClosuresTask = None
+
+        if self.dockWidget:
+            self.dockWidget.setMetricClosuresProgress(None)
+
+        if task.error:
+            show_info(__('Unable to precalculate the vertices mode paths: %s' % task.error))
+
+        # the graph has changed while the task was running
+        if task.components.graph is not self.routingGraph or not self.components or task.revision != self.routingGraph.revision:
+            return
+
+        # even a canceled task has some closures ready
+        self.components.merge(task.components)
+        self.routingCache.update(task.revision, task.weight, RoutingCache.HIERARCHY, task.hierarchies)
+        self.routingCache.update(task.revision, task.weight, RoutingCache.CLOSURE, task.metric_closures)
+        self.updateRoutingCacheStats()
+
+        if task.hierarchies:
+            hierarchies = task.hierarchies.values()
+            show_info(__('Contraction hierarchies of %s components ready: %s shortcuts, %.1f MB, built in %.1f s' % (
+                len(task.hierarchies),
+                sum(hierarchy.shortcuts for hierarchy in hierarchies),
+                sum(hierarchy.nbytes() for hierarchy in hierarchies) / 2**20,
+                sum(hierarchy.build_time for hierarchy in hierarchies),
+            )))
+
+    def startAlternativePathsTask(self, graph: CompactGraph, nodes: typing.List[int], featureIds: typing.List[typing.Any],
+                                  pathTrees: ShortestPathTreeCache = None) -> None:
+        """Search the alternatives of a path between two vertices in a background task, see `showNextAlternativePath`.
+
+        Args:
+            graph (CompactGraph): the graph the nodes belong to
+            nodes (List[int]): the selected nodes, nothing is searched unless there are exactly two
+            featureIds (List): the line keys of the path that is already shown
+            pathTrees (ShortestPathTreeCache, optional): cached shortest path trees of the graph, they are copied for the task
+        """
+        self.resetAlternativePaths()
+
+        nodes = list(dict.fromkeys(nodes))
+
+        if len(nodes) != 2 or ALTERNATIVE_PATHS_COUNT < 2:
+            return
+
+        self.alternativePaths = [list(featureIds)]
+
+        task = AlternativePathsTask(graph, nodes[0], nodes[1], ALTERNATIVE_PATHS_COUNT, self.edgesWeightField, pathTrees)
+        task.taskCompleted.connect(lambda: self.onAlternativePathsTaskFinished(task, pathTrees))
+        task.taskTerminated.connect(lambda: self.onAlternativePathsTaskFinished(task, pathTrees))
+
+        self.alternativePathsTask = task
+        QgsApplication.taskManager().addTask(task)
+
+    def resetAlternativePaths(self) -> None:
+        if self.alternativePathsTask:
+            # the results of the canceled task are ignored, even if it manages to finish
+            task = self.alternativePathsTask
+            self.alternativePathsTask = None
+            task.cancel()
+
+        self.alternativePaths = []
+        self.alternativePathIndex = 0
+
+        if self.dockWidget:
+            self.dockWidget.setAlternativeButtonEnabled(False)
+
+    def onAlternativePathsTaskFinished(self, task: AlternativePathsTask, pathTrees: Optional[ShortestPathTreeCache]) -> None:
+        if task is not self.alternativePathsTask:
+            return
+
+        self.alternativePathsTask = None
+
+        if task.error:
+            show_info(__('Unable to find alternative paths: %s' % task.error))
+
+        # the graph has changed while the task was running
+        if (task.graph is not self.graph and task.graph is not self.routingGraph) or task.revision != task.graph.revision:
+            return
+
+        if pathTrees is not None:
+            pathTrees.merge(task.path_trees)
+
+        # the path that is already shown stays the first one
+        shownPath = sorted(self.alternativePaths[0])
+        self.alternativePaths.extend(path for path in task.paths if sorted(path) != shownPath)
+
+        if len(self.alternativePaths) > 1 and self.dockWidget:
+            self.dockWidget.setAlternativeButtonEnabled(True)
+
+    def showNextAlternativePath(self) -> bool:
+        """Replace the candidates with the next alternative path between the two selected vertices."""
+        if len(self.alternativePaths) < 2:
+            return False
+
+        self.alternativePathIndex = (self.alternativePathIndex + 1) % len(self.alternativePaths)
+        lines = self.getVerticesPathFeatures(self.alternativePaths[self.alternativePathIndex])
+
+        if not lines or not self.addCandidates(lines):
+            show_info(__('Unable to add candidates'))
+            return False
+
+        show_info(__('Path %s of %s' % (self.alternativePathIndex + 1, len(self.alternativePaths))), 2)
+
+        return True
+
+    def updateRoutingCacheStats(self) -> None:
+        if self.dockWidget:
+            self.dockWidget.setRoutingCacheStats(self.routingCache.stats())
 
     def setSelectionMode(self, mode: SelectionModes) -> None:
         assert self.dockWidget
@@ -807,6 +1245,8 @@ class BoundaryDelineation:
 
         assert self.simplifiedSegmentsLayer
 
+        self.resetAlternativePaths()
+
         if self.selectionMode != SelectionModes.LINES:
             self.simplifiedSegmentsLayer.removeSelection()
 
@@ -849,7 +1289,7 @@ class BoundaryDelineation:
             return
 
     def getLinesSelectionModeEnclosing(self, selectBehaviour: SelectBehaviour, rect: QgsRectangle) -> typing.Tuple:
-        rect = self.__getCoordinateTransform(self.polygonizedLayer).transform(rect)
+        rect = self.toWorkingCrs(rect)
 
         self.polygonizedLayer.selectByRect(rect, selectBehaviour)
 
@@ -861,7 +1301,7 @@ class BoundaryDelineation:
     def getLinesSelectionModeLines(self, selectBehaviour: SelectBehaviour, rect: QgsRectangle) -> typing.Tuple:
         assert self.simplifiedSegmentsLayer
 
-        rect = self.__getCoordinateTransform(self.simplifiedSegmentsLayer).transform(rect)
+        rect = self.toWorkingCrs(rect)
 
         self.simplifiedSegmentsLayer.selectByRect(rect, selectBehaviour)
 
@@ -926,66 +1366,175 @@ class BoundaryDelineation:
         assert self.simplifiedSegmentsLayer
         assert self.candidatesLayer
 
-        if not self.graph:
+        if not self.graph and not self.tiledGraph:
             self.buildVerticesGraph()
 
-        assert self.graph
-        assert self.subgraphs
-
-        rect = self.__getCoordinateTransform(self.polygonizedLayer).transform(rect)
+        rect = self.toWorkingCrs(rect)
 
         self.verticesLayer.selectByRect(rect, selectBehaviour)
 
-        selectedPoints = [f.geometry().asPoint() for f in self.verticesLayer.selectedFeatures()]
+        selectedVertices = self.verticesLayer.selectedFeatures()
+        selectedPoints = [f.geometry().asPoint() for f in selectedVertices]
+        selectedExtent = QgsRectangle()
+        selectedExtent.setMinimal()
+
+        for p in selectedPoints:
+            selectedExtent.combineExtentWith(p.x(), p.y())
+
+        # the tiles with the selected vertices and one more tile around them
+        margin = 1
+
+        if self.tiledGraph and selectedPoints:
+            self.loadTiledVerticesGraph(selectedExtent, margin)
 
-        if len(selectedPoints) <= 1:
+        selectedNodes = self.getSelectedNodes(selectedVertices)
+
+        if len(selectedNodes) <= 1:
             neighbors: typing.List[typing.Any] = []
 
-            if len(selectedPoints) == 1:
-                neighbors = list(self.graph.neighbors(selectedPoints[0]))
+            if len(selectedNodes) == 1:
+                assert self.graph
+                neighbors = self.graph.neighbors(selectedNodes[0])
 
             if len(neighbors) == 1:
-                edges = self.graph[selectedPoints[0]][selectedPoints[0]]
-                edgeId = list(edges.keys())[0]
+                edges = self.graph.edges_between(selectedNodes[0], selectedNodes[0])
+
+                if edges:
+                    edgeId = self.graph.edge_key(edges[0])
 
-                return [f for f in self.simplifiedSegmentsLayer.getFeatures([edgeId])]
+                    return [f for f in self.simplifiedSegmentsLayer.getFeatures([edgeId])]
 
             self.candidatesLayer.rollBack()
             # TODO there are self enclosing blocks that can be handled here (one vertex that is conected to itself)
             show_info(__('Please select two or more vertices to be connected'))
             return None
 
-        try:
-            if self.metricClosureGraphs[self.edgesWeightField] is None:
-                self.metricClosureGraphs[self.edgesWeightField] = self.calculateMetricClosure(self.subgraphs)
+        assert self.graph
+        assert self.routingGraph
+
+        while True:
+            if not self.prepareWeights():
+                return None
+
+            routingNodes = self.routingGraph.node_ids_of(selectedNodes)
+
+            try:
+                # the vertices inside the degree-2 chains are not in the contracted graph, search around them in the whole graph
+                if routingNodes is None:
+                    featureIds = find_steiner_tree(self.graph, selectedNodes, weight=self.edgesWeightField, query_log=self.steinerQueries)
+                    self.startAlternativePathsTask(self.graph, selectedNodes, featureIds)
+                else:
+                    featureIds = find_steiner_tree(
+                        self.routingGraph,
+                        routingNodes,
+                        weight=self.edgesWeightField,
+                        components=self.components,
+                        metric_closures=self.routingCache.view(self.routingGraph.revision, self.edgesWeightField, RoutingCache.CLOSURE),
+                        path_trees=self.shortestPathTrees,
+                        hierarchies=self.routingCache.view(self.routingGraph.revision, self.edgesWeightField, RoutingCache.HIERARCHY),
+                        query_log=self.steinerQueries
+                    )
+                    self.startAlternativePathsTask(self.routingGraph, routingNodes, featureIds, self.shortestPathTrees)
+                    self.updateRoutingCacheStats()
+                break
+            except NoSuitableGraphError:
+                # this is hapenning when the user selects vertices from two separate graphs,
+                # or the path between them goes outside the loaded tiles
+                if not self.tiledGraph or margin >= TILED_GRAPH_MAX_MARGIN:
+                    return None
+
+                margin *= 2
+                self.loadTiledVerticesGraph(selectedExtent, margin)
+                selectedNodes = self.getSelectedNodes(selectedVertices)
+
+        return self.getVerticesPathFeatures(featureIds)
+
+    def getVertexAttributes(self, node: int, degrees: np.ndarray, labels: np.ndarray) -> typing.List[typing.Any]:
+        """Get the attributes of the vertex of a node, in the order of the vertices layer fields.
+
+        The node ids of the graphs stitched from tiles only exist until the next tiles are loaded, they are not kept.
+
+        Args:
+            node (int): the node id
+            degrees (np.ndarray): the degree of each node
+            labels (np.ndarray): the component label of each node
+
+        Returns:
+            List[Any]: the node id, degree and component label
+        """
+        attributes = {
+            VERTEX_NODE_FIELD: None if self.tiledGraph else node,
+            VERTEX_DEGREE_FIELD: int(degrees[node]),
+            VERTEX_COMPONENT_FIELD: None if self.tiledGraph else int(labels[node]),
+        }
 
-            T = find_steiner_tree(self.subgraphs, selectedPoints, metric_closures=self.metricClosureGraphs[self.edgesWeightField])
-        except NoSuitableGraphError:
-            # this is hapenning when the user selects vertices from two separate graphs
-            return None
+        return [attributes.get(field.name()) for field in self.verticesLayer.fields()]
+
+    def getSelectedNodes(self, vertices: typing.Iterable[QgsFeature]) -> typing.List[int]:
+        """Get the graph nodes of the selected vertices, vertices in the same grid cell are one node.
+
+        The vertices written from the graph have the node id as attribute, it is used as long as the node
+        is still in the grid cell of the vertex. Otherwise the node is looked up by the vertex coordinates.
+
+        Args:
+            vertices (Iterable[QgsFeature]): the selected vertices
 
-        # edge[2] stays for the line ids
-        featureIds = [edge[2] for edge in T.edges(keys=True)]
+        Returns:
+            List[int]: the distinct node ids, vertices without a node are skipped
+        """
+        if not self.graph:
+            return []
+
+        nodes = []
+
+        for vertex in vertices:
+            point = vertex.geometry().asPoint()
+            node = None if self.tiledGraph else vertex[VERTEX_NODE_FIELD]
+
+            if not isinstance(node, int) or node >= self.graph.number_of_nodes() \
+                    or grid_key(*self.graph.node_point(node), self.graph.grid) != grid_key(point.x(), point.y(), self.graph.grid):
+                node = self.graph.node_id(point)
+
+            if node is not None:
+                nodes.append(node)
+
+        return list(dict.fromkeys(nodes))
+
+    def getVerticesPathFeatures(self, featureIds: typing.List[typing.Any]) -> Optional[Collection]:
+        """Get the lines of a vertices mode selection, closed with the cheapest other line between its ends, if there is one.
+
+        Args:
+            featureIds (List): the line keys of the path or tree
+
+        Returns:
+            Optional[Collection]: the lines, None if the lines do not have exactly two ends
+        """
+        assert self.graph
+        assert self.simplifiedSegmentsLayer
+
+        featureIds = list(featureIds)
         points = utils.lines_unique_vertices(self.simplifiedSegmentsLayer, featureIds)
+        nodes = [self.graph.node_id(p) for p in points]
 
-        if len(points) != 2:
+        if len(points) != 2 or None in nodes:
             show_info(__('Unable to find the shortest path'))
             return None
 
-        if self.graph.has_edge(*points):
-            edgesDict = self.graph[points[0]][points[1]]
-            bestEdgeKey = None
-            bestEdgeValue = None
+        weights = self.graph.weights(self.edgesWeightField)
+        bestEdgeKey = None
+        bestEdgeValue = None
+
+        for edge in self.graph.edges_between(*nodes):
+            k = self.graph.edge_key(edge)
 
-            for k, e in edgesDict.items():
-                # find the cheapest edge that is not already selected (in case there are two vertices
-                # selected and there are more than one edges connecting them)
-                if k not in featureIds and (bestEdgeValue is None or bestEdgeValue > e[self.edgesWeightField]):
-                    bestEdgeKey = k
-                    bestEdgeValue = e[self.edgesWeightField]
+            # find the cheapest edge that is not already selected (in case there are two vertices
+            # selected and there are more than one edges connecting them)
+            if k not in featureIds and (bestEdgeValue is None or bestEdgeValue > weights[edge]):
+                bestEdgeKey = k
+                bestEdgeValue = weights[edge]
 
-            if bestEdgeKey:
-                featureIds.append(bestEdgeKey)
+        if bestEdgeKey:
+            featureIds.append(bestEdgeKey)
 
         return tuple(self.simplifiedSegmentsLayer.getFeatures(featureIds))
 
@@ -1062,6 +1611,8 @@ class BoundaryDelineation:
         assert self.candidatesLayer
         assert self.simplifiedSegmentsLayer
 
+        self.resetAlternativePaths()
+
         self.candidatesLayer.startEditing()
         self.candidatesLayer.selectAll()
 
@@ -1103,12 +1654,30 @@ class BoundaryDelineation:
 
         return self.project.crs()
 
-    def __getCoordinateTransform(self, layer: QgsMapLayer) -> QgsCoordinateTransform:
-        return QgsCoordinateTransform(
-            self.__getCrs(),
-            self.__getCrs(layer),
-            self.project
-        )
+    def toWorkingCrs(self, rect: QgsRectangle) -> QgsRectangle:
+        """Transform a selection rectangle to the working CRS of the simplified segments and the layers derived from them.
+
+        The transform is created once and reused, until the project CRS changes. There is nothing to transform
+        when the project is in the working CRS.
+
+        Args:
+            rect (QgsRectangle): the rectangle in the project CRS
+
+        Returns:
+            QgsRectangle: the rectangle in the working CRS
+        """
+        assert self.simplifiedSegmentsLayer
+
+        source = self.__getCrs()
+        target = self.__getCrs(self.simplifiedSegmentsLayer)
+
+        if source == target:
+            return rect
+
+        if not self.workingTransform or self.workingTransform.sourceCrs() != source or self.workingTransform.destinationCrs() != target:
+            self.workingTransform = QgsCoordinateTransform(source, target, self.project)
+
+        return self.workingTransform.transformBoundingBox(rect)
 
     def __getStylePath(self, file: str) -> str:
         return os.path.join(PLUGIN_DIR, 'styles', file)
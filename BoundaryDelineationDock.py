@@ -2,6 +2,7 @@
 
 Attributes:
     SC_ACCEPT (str): shortcut for accepting candidates
+    SC_ALTERNATIVE (str): shortcut for showing the next alternative path of the candidates
     SC_EDIT (str): shortcut for editing candidates
     SC_MODE_LINES (str): shortcut for toggling lines mode
     SC_MODE_MANUAL (str): shortcut for toggling manual mode
@@ -70,6 +71,7 @@ SC_MODE_VERTICES = 'Ctrl+Alt+3'
 SC_MODE_MANUAL = 'Ctrl+Alt+4'
 SC_ACCEPT = 'Ctrl+Alt+A'
 SC_REJECT = 'Ctrl+Alt+C'
+SC_ALTERNATIVE = 'Ctrl+Alt+N'
 SC_EDIT = 'Ctrl+Alt+E'
 SC_UPDATE = 'Ctrl+Alt+U'
 
@@ -109,6 +111,7 @@ class BoundaryDelineationDock(QDockWidget, FORM_CLASS):
         self.its4landButton.clicked.connect(self.onIts4landButtonClicked)
         self.addLengthAttributeCheckBox.toggled.connect(self.onAddLengthAttributeCheckBoxToggled)
         self.processButton.clicked.connect(self.onProcessButtonClicked)
+        self.step1CancelButton.clicked.connect(self.onStep1CancelButtonClicked)
 
         self.modePolygonsRadio.toggled.connect(self.onModePolygonsRadioToggled)
         self.modeVerticesRadio.toggled.connect(self.onModeVerticesRadioToggled)
@@ -116,9 +119,11 @@ class BoundaryDelineationDock(QDockWidget, FORM_CLASS):
         self.modeManualRadio.toggled.connect(self.onModeManualRadioToggled)
 
         self.weightComboBox.fieldChanged.connect(self.onWeightComboBoxChanged)
+        self.metricClosuresCancelButton.clicked.connect(self.onMetricClosuresCancelButtonClicked)
 
         self.acceptButton.clicked.connect(self.onAcceptButtonClicked)
         self.rejectButton.clicked.connect(self.onRejectButtonClicked)
+        self.alternativeButton.clicked.connect(self.onAlternativeButtonClicked)
         self.editButton.toggled.connect(self.onEditButtonToggled)
         self.updateEditsButton.clicked.connect(self.onUpdateEditsButtonClicked)
         self.finishButton.clicked.connect(self.onFinishButtonClicked)
@@ -154,6 +159,7 @@ class BoundaryDelineationDock(QDockWidget, FORM_CLASS):
         self.createShortcut(SC_MODE_MANUAL, self.modeManualRadio, self.onShortcutModeManual)
         self.createShortcut(SC_ACCEPT, self.acceptButton, self.onShortcutAccept)
         self.createShortcut(SC_REJECT, self.rejectButton, self.onShortcutReject)
+        self.createShortcut(SC_ALTERNATIVE, self.alternativeButton, self.onShortcutAlternative)
         self.createShortcut(SC_EDIT, self.editButton, self.onShortcutEdit)
         self.createShortcut(SC_UPDATE, self.updateEditsButton, self.onShortcutUpdate)
 
@@ -209,6 +215,11 @@ class BoundaryDelineationDock(QDockWidget, FORM_CLASS):
         if self.isAlreadyProcessed:
             self.rejectButton.animateClick()
 
+    def onShortcutAlternative(self) -> None:
+        """Show the next alternative path."""
+        if self.isAlreadyProcessed and self.alternativeButton.isEnabled():
+            self.alternativeButton.animateClick()
+
     def onShortcutEdit(self) -> None:
         """Edit the current candidate."""
         if self.isAlreadyProcessed:
@@ -323,6 +334,9 @@ class BoundaryDelineationDock(QDockWidget, FORM_CLASS):
         self.plugin.refreshSelectionModeBehavior()
         self.editButton.setChecked(False)
 
+    def onAlternativeButtonClicked(self) -> None:
+        self.plugin.showNextAlternativePath()
+
     def onEditButtonToggled(self) -> None:
         self.plugin.toggleEditCandidates()
         # putting here self.plugin.refreshSelectionModeBehavior() causes infinite loop.
@@ -353,19 +367,79 @@ class BoundaryDelineationDock(QDockWidget, FORM_CLASS):
                 self.toggleFirstStepLock(False)
                 return
 
+        # runs in background tasks, which call `setFirstStepFinished` at the end
         self.plugin.processFirstStep()
 
+    def onStep1CancelButtonClicked(self) -> None:
+        self.plugin.cancelFirstStep()
+
+    def setFirstStepProgress(self, progress: float, description: str) -> None:
+        """Show the progress of the first step, while its background tasks are running.
+
+        Args:
+            progress (float): progress of the whole first step in percents
+            description (str): description of the running task
+        """
+        self.step1CancelButton.setVisible(True)
+        self.step1ProgressBar.setFormat('%s %%p%%' % description)
+        self.step1ProgressBar.setValue(int(progress))
+
+    def setFirstStepFinished(self, success: bool) -> None:
+        """Unlock the first step once its background tasks have finished.
+
+        Args:
+            success (bool): whether all the tasks have completed, False if one of them failed or was canceled
+        """
+        self.step1CancelButton.setVisible(False)
+        self.step1ProgressBar.resetFormat()
         self.toggleFirstStepLock(False)
-        self.tabs.setCurrentWidget(self.stepTwoTab)
-        self.updateSelectionModeButtons()
 
-        self.isAlreadyProcessed = True
+        # the layers of the completed tasks are already added, they should be removed before processing again
+        self.isAlreadyProcessed = success or self.plugin.simplifiedSegmentsLayer is not None
+
+        if not success:
+            self.tabs.setTabEnabled(1, False)
+            self.step1ProgressBar.setValue(0)
+            return
 
+        self.tabs.setCurrentWidget(self.stepTwoTab)
+        self.updateSelectionModeButtons()
         self.step1ProgressBar.setValue(100)
 
     def onWeightComboBoxChanged(self, name: str) -> None:
         self.plugin.setWeightField(name)
 
+    def onMetricClosuresCancelButtonClicked(self) -> None:
+        self.plugin.cancelMetricClosuresTask()
+
+    def setMetricClosuresProgress(self, progress: float = None) -> None:
+        """Show the progress of the background precalculation of the vertices mode paths.
+
+        Args:
+            progress (float, optional): progress in percents, None hides the progress bar
+        """
+        self.metricClosuresProgressBar.setVisible(progress is not None)
+        self.metricClosuresCancelButton.setVisible(progress is not None)
+
+        if progress is not None:
+            self.metricClosuresProgressBar.setValue(int(progress))
+
+    def setRoutingCacheStats(self, stats: dict) -> None:
+        """Show the statistics of the cache of the precalculated vertices mode paths.
+
+        Args:
+            stats (dict): the statistics, as returned by `RoutingCache.stats`
+        """
+        self.routingCacheLabel.setText(__('Paths cache: %s entries of %s weights, %.1f / %.0f MB, %s hits, %s misses, %s evicted' % (
+            stats['entries'],
+            stats['weights'],
+            stats['bytes'] / 2**20,
+            stats['max_bytes'] / 2**20,
+            stats['hits'],
+            stats['misses'],
+            stats['evictions'],
+        )))
+
     def toggleFirstStepLock(self, disabled: bool) -> None:
         self.isBeingProcessed = disabled
 
@@ -466,6 +540,9 @@ class BoundaryDelineationDock(QDockWidget, FORM_CLASS):
         self.rejectButton.setEnabled(enable)
         self.editButton.setEnabled(enable)
 
+    def setAlternativeButtonEnabled(self, enable: bool) -> None:
+        self.alternativeButton.setEnabled(enable)
+
     def toggleFinalButtonEnabled(self, enabled: bool = None) -> bool:
         if enabled is None:
             enabled = not self.finishButton.enabled()
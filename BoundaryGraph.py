@@ -3,6 +3,25 @@
 Attributes:
     DEFAULT_WEIGHT_NAME (str): the graph attribute to be used as weight
     DEFAULT_WEIGHT_VALUE (int): the value to be used as weight, in case it's missing
+    DEFAULT_CACHE_BYTES (int): default memory budget of the routing caches
+    DEFAULT_TILE_FEATURES (int): expected number of lines in a tile of the tiled graph
+    DEFAULT_NODE_GRID (float): endpoints are snapped to a grid with this cell size, in layer units, before they are turned into nodes,
+        so endpoints that differ only by floating point noise become the same node
+    PROCESS_POOL_MIN_NODES (int): the components are preprocessed in worker processes only if they have at least this many nodes in total,
+        starting the workers costs more for smaller graphs
+    PROCESS_BATCH_NODES (int): the small components are sent to the worker processes in batches of about this many nodes
+    PROCESS_POLL_SECONDS (float): how often the calling thread checks for cancellation while it waits for the worker processes
+    EXACT_STEINER_MIN_TERMINALS (int): the exact Steiner tree is searched for at least this many terminals, fewer are connected with a shortest path
+    EXACT_STEINER_MAX_TERMINALS (int): the exact Steiner tree is searched for at most this many terminals, it costs 3^t
+    EXACT_STEINER_MAX_WORK (int): the exact Steiner tree is searched only if the terminal-local graph has at most this many nodes
+        times 2^(1 - t), for t terminals
+    EXACT_STEINER_TIME_BUDGET (float): seconds after which the exact search gives up and the approximate tree is used
+    ROUTING_BACKENDS (dict): the routing backend classes, keyed by name (see `routing_backend`)
+    NodeKey (type): node coordinates
+    GridKey (type): node coordinates snapped to the grid, used to find the integer id of a node
+    EdgeKey (type): feature id of a line, or (feature id, part index) tuple for parts of multipart lines
+    TileKey (type): (column, row) of a tile of the tiled graph
+    RoutingStructure (type): a precalculated routing structure of a component, kept in a `RoutingCache`
 
 Notes:
     begin                : 2019-03-03
@@ -35,105 +54,3568 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import csv
+import functools
+import math
+import multiprocessing
 import os
 import sys
+import time
 import typing
 
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from heapq import heapify, heappush, heappop
+from itertools import count
+
 if os.path.join(os.path.dirname(__file__) + '/lib') not in sys.path:
     sys.path.insert(0, os.path.join(os.path.dirname(__file__) + '/lib'))
 
+import numpy as np
 import networkx as nx
-from networkx.algorithms.approximation.steinertree import steiner_tree, metric_closure
-from qgis.core import QgsWkbTypes, QgsExpression, QgsRectangle, QgsVectorLayer
-from typing import Collection, Union, List
+from networkx.algorithms.approximation.steinertree import steiner_tree, MetricClosure
+from qgis.core import QgsWkbTypes, QgsExpression, QgsExpressionContext, QgsExpressionContextUtils, QgsExpressionNode, \
+    QgsExpressionNodeBinaryOperator, QgsExpressionNodeUnaryOperator, QgsRectangle, QgsVectorLayer, QgsFeature, QgsFeatureRequest, \
+    QgsFeedback, QgsProcessingFeedback, QgsProcessingMultiStepFeedback, QgsTask
+from typing import Collection, Union, List, Dict, Iterable, Mapping, Optional, Set, Tuple
+
+try:
+    from scipy.sparse import csr_matrix, csgraph
+except ImportError:
+    csr_matrix = None
+    csgraph = None
+
+try:
+    from .BoundaryComponents import BoundaryDelineationError, NoSuitableGraphError, ComponentArrays, ContractionHierarchy, EdgeKey, \
+        CLOSURE_BLOCK_CELLS, DEFAULT_WEIGHT_NAME, metric_closure, scipy_metric_closure, preprocess_components, _symmetric_matrix
+except ImportError:
+    # imported as a top-level module, by the tests and the benchmarks
+    from BoundaryComponents import BoundaryDelineationError, NoSuitableGraphError, ComponentArrays, ContractionHierarchy, EdgeKey, \
+        CLOSURE_BLOCK_CELLS, DEFAULT_WEIGHT_NAME, metric_closure, scipy_metric_closure, preprocess_components, _symmetric_matrix
 
-DEFAULT_WEIGHT_NAME = 'weight'
 DEFAULT_WEIGHT_VALUE = 1
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_TILE_FEATURES = 20000
+DEFAULT_NODE_GRID = 1e-6
+PROCESS_POOL_MIN_NODES = 20000
+PROCESS_BATCH_NODES = 5000
+PROCESS_POLL_SECONDS = 0.2
+EXACT_STEINER_MIN_TERMINALS = 3
+EXACT_STEINER_MAX_TERMINALS = 6
+EXACT_STEINER_MAX_WORK = 64000
+EXACT_STEINER_TIME_BUDGET = 0.3
 
-class BoundaryDelineationError(Exception):
-    pass
+NodeKey = Tuple[float, float]
+GridKey = Tuple[int, int]
+TileKey = Tuple[int, int]
 
-class NoSuitableGraphError(BoundaryDelineationError):
-    def __init__(self, expression: str = None, message: str = None):
-        self.expression = expression
-        self.message = message
+_revisions = count(1)
 
 
-def prepare_graph_from_lines(layer: QgsVectorLayer, weight_expr_str: str = None, filter_expr: Union[QgsRectangle, str, List] = '1=1') -> nx.MultiGraph:
-    if layer.geometryType() != QgsWkbTypes.LineGeometry:
-        raise Exception('Only line layers are accepted')
+class UnknownWeightError(BoundaryDelineationError):
+    """The weights are neither a field nor set for the current revision of the graph, see `CompactGraph.weights`."""
 
-    G = nx.MultiGraph()
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.name = name
 
-    weight_expr = None
 
-    if weight_expr_str:
-        weight_expr = QgsExpression(weight_expr_str)
+class _DisjointSet:
+    """Union-find over arbitrary hashable items, with path halving and union by size."""
+
+    def __init__(self, items: Iterable = ()) -> None:
+        self.parents: Dict[typing.Any, typing.Any] = {item: item for item in items}
+        self.sizes: Dict[typing.Any, int] = {item: 1 for item in self.parents}
+
+    def find(self, item: typing.Any) -> typing.Any:
+        parents = self.parents
+
+        if item not in parents:
+            parents[item] = item
+            self.sizes[item] = 1
+
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+
+        return item
+
+    def union(self, a: typing.Any, b: typing.Any) -> bool:
+        a = self.find(a)
+        b = self.find(b)
+
+        if a == b:
+            return False
+
+        if self.sizes[a] < self.sizes[b]:
+            a, b = b, a
+
+        self.parents[b] = a
+        self.sizes[a] += self.sizes[b]
+
+        return True
+
+
+class GraphChange:
+    """Edges removed from and added to a `CompactGraph` by one update.
+
+    Attributes:
+        old_revision (int): graph revision before the update
+        revision (int): graph revision after the update
+        removed_edges (np.ndarray): indices of the removed edges
+        added_edges (np.ndarray): indices of the added edges
+        added_nodes (np.ndarray): ids of the nodes created by the update
+        touched_nodes (Set[int]): endpoints of all the removed and added edges
+    """
+
+    def __init__(self, old_revision: int, revision: int, removed_edges: np.ndarray, added_edges: np.ndarray,
+                 added_nodes: np.ndarray, touched_nodes: Set[int]) -> None:
+        self.old_revision = old_revision
+        self.revision = revision
+        self.removed_edges = removed_edges
+        self.added_edges = added_edges
+        self.added_nodes = added_nodes
+        self.touched_nodes = touched_nodes
+
+    def __bool__(self) -> bool:
+        return bool(len(self.removed_edges) or len(self.added_edges))
+
+
+def _connected_component_labels(node_count: int, edge_nodes: np.ndarray) -> np.ndarray:
+    """Label the connected components, each node gets the smallest node id in its component.
+
+    Vectorized min-label hooking with pointer jumping, the number of rounds is logarithmic for
+    practical graphs and does not depend on the length of the chains.
+    """
+    labels = np.arange(node_count, dtype=np.int64)
+
+    if not len(edge_nodes):
+        return labels
+
+    u = edge_nodes[:, 0]
+    v = edge_nodes[:, 1]
+
+    while True:
+        lu = labels[u]
+        lv = labels[v]
+        differ = lu != lv
+
+        if not differ.any():
+            return labels
+
+        np.minimum.at(labels, np.maximum(lu[differ], lv[differ]), np.minimum(lu[differ], lv[differ]))
+
+        while True:
+            jumped = labels[labels]
+
+            if np.array_equal(jumped, labels):
+                break
+
+            labels = jumped
+
+
+def grid_keys(points: np.ndarray, grid: float = DEFAULT_NODE_GRID) -> np.ndarray:
+    """Snap the points to the grid.
+
+    Args:
+        points (np.ndarray): (n, 2) array with coordinates
+        grid (float, optional): the cell size of the grid, in layer units
+
+    Returns:
+        np.ndarray: (n, 2) array with the integer column and row of each point
+    """
+    return np.floor(np.asarray(points, dtype=np.float64).reshape(-1, 2) / grid + 0.5).astype(np.int64)
+
+def grid_key(x: float, y: float, grid: float = DEFAULT_NODE_GRID) -> GridKey:
+    """Snap a single point to the grid, same as `grid_keys`."""
+    return (math.floor(x / grid + 0.5), math.floor(y / grid + 0.5))
+
+def intern_points(points: np.ndarray, grid: float = DEFAULT_NODE_GRID, keep_order: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Turn the points into integer node ids in one vectorized pass, points in the same grid cell get the same id.
+
+    Args:
+        points (np.ndarray): (n, 2) array with coordinates
+        grid (float, optional): the cell size of the grid, in layer units
+        keep_order (bool, optional): number the nodes in order of the first appearance of their point,
+            by default they are numbered in order of their grid key, which keeps nearby nodes close in memory
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the coordinates of each node, taken from its first point,
+            and the node id of each point
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+    if not len(points):
+        return (points, np.empty(0, dtype=np.int64))
+
+    (_keys, first, inverse) = np.unique(grid_keys(points, grid), axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    if keep_order:
+        order = np.argsort(first, kind='stable')
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+
+        return (points[first[order]], ranks[inverse])
+
+    return (points[first], inverse)
+
+
+class CompactGraph:
+    """Undirected multigraph with integer node ids and edges stored in CSR arrays.
+
+    Every line (or part of a multipart line) is an edge between the nodes at its first and last vertex.
+    The adjacency of node `n` are the half-edges `offsets[n]:offsets[n + 1]`, where `targets` holds the
+    node on the other side and `edge_ids` the index of the edge. Per edge data (feature ids and attribute
+    values) are kept in flat arrays indexed by the edge index. Weights are derived from the attributes,
+    or set from weight expressions, and are cached until the next update of the graph.
+
+    The graph can be updated in place (see `update`). Removed edges are only marked in `edge_alive`,
+    added edges are appended to the edge arrays and kept in a small adjacency overlay next to the CSR
+    arrays, until the overlay grows big enough to rebuild the CSR arrays. Edge indices never change.
+
+    Attributes:
+        points (np.ndarray): (n, 2) array with the node coordinates, the node id is the row index
+        edge_nodes (np.ndarray): (m, 2) array with the start and end node of each edge
+        edge_fids (np.ndarray): feature id of each edge
+        edge_parts (np.ndarray): part index of each edge, -1 when the feature is not multipart
+        edge_alive (np.ndarray): False for the edges that were removed
+        offsets (np.ndarray): CSR row offsets
+        targets (np.ndarray): CSR column indices, the node at the other end of each half-edge
+        edge_ids (np.ndarray): the edge index of each half-edge
+        revision (int): unique number of this version of the graph, used as a cache key
+        grid (float): cell size of the grid the endpoints are snapped to, the points of a node are in one cell
+    """
+
+    # rebuild the CSR arrays when the overlay holds more than this share of the edges
+    OVERLAY_MAX_RATIO = 0.1
+    # approximate bytes per edge: edge and CSR arrays, about one node with its entry in the coordinates index
+    EDGE_BYTES = 220
+
+    def __init__(self, points: np.ndarray, edge_nodes: np.ndarray, edge_fids: np.ndarray, edge_parts: np.ndarray = None,
+                 weights: Dict[str, np.ndarray] = None, grid: float = DEFAULT_NODE_GRID) -> None:
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.grid = grid
+        self.edge_nodes = np.asarray(edge_nodes, dtype=np.int32).reshape(-1, 2)
+        self.edge_fids = np.asarray(edge_fids, dtype=np.int64)
+        self.edge_parts = np.asarray(edge_parts, dtype=np.int32) if edge_parts is not None else np.full(len(self.edge_fids), -1, dtype=np.int32)
+        self.edge_alive = np.ones(len(self.edge_fids), dtype=bool)
+        self._attributes: Dict[str, np.ndarray] = {name: np.asarray(values, dtype=np.float64) for name, values in (weights or {}).items()}
+        self._weights: Dict[str, Tuple[int, np.ndarray]] = {}
+        self._weight_scales: Dict[str, Tuple[int, float]] = {}
+        self._node_index: Optional[Dict[GridKey, int]] = None
+        self._components: Optional[np.ndarray] = None
+        self.revision = next(_revisions)
+
+        self._build_adjacency()
+
+    def _build_adjacency(self) -> None:
+        node_count = len(self.points)
+        edges = np.flatnonzero(self.edge_alive).astype(np.int32)
+        edge_nodes = self.edge_nodes[edges]
+
+        sources = np.concatenate((edge_nodes[:, 0], edge_nodes[:, 1]))
+        order = np.argsort(sources, kind='stable')
+
+        self.targets = np.concatenate((edge_nodes[:, 1], edge_nodes[:, 0]))[order]
+        self.edge_ids = np.concatenate((edges, edges))[order]
+        self.offsets = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=node_count), out=self.offsets[1:])
+
+        self._overlay: Dict[int, List[Tuple[int, int]]] = {}
+        self._overlay_edges = 0
+        self._csr_has_removed = False
+
+    @classmethod
+    def from_endpoints(cls, starts: Collection[NodeKey], ends: Collection[NodeKey], edge_fids: Collection[int],
+                       edge_parts: Collection[int] = None, weights: Dict[str, Collection[float]] = None,
+                       grid: float = DEFAULT_NODE_GRID) -> 'CompactGraph':
+        """Build a graph from the endpoints of the lines. Endpoints in the same grid cell become the same node,
+        the nodes are numbered in order of their first appearance.
+
+        Args:
+            starts (Collection[NodeKey]): the (x, y) of the first vertex of each line
+            ends (Collection[NodeKey]): the (x, y) of the last vertex of each line
+            edge_fids (Collection[int]): the feature id of each line
+            edge_parts (Collection[int], optional): the part index of each line, -1 for singlepart features
+            weights (Dict[str, Collection[float]], optional): attribute values for each line, keyed by field name, NaN for NULL
+            grid (float, optional): the cell size of the grid the endpoints are snapped to
+
+        Returns:
+            CompactGraph: the graph
+        """
+        endpoints = np.column_stack((np.asarray(starts, dtype=np.float64).reshape(-1, 2), np.asarray(ends, dtype=np.float64).reshape(-1, 2)))
+        (points, node_ids) = intern_points(endpoints.reshape(-1, 2), grid, keep_order=True)
+
+        return cls(points, node_ids.reshape(-1, 2), edge_fids, edge_parts, weights, grid)
 
-    numeric_fields_names = []
+    @classmethod
+    def from_lines(cls, lines: 'LineArrays', grid: float = DEFAULT_NODE_GRID) -> 'CompactGraph':
+        """Build a graph from the lines read into arrays, the endpoints are turned into node ids in one vectorized pass.
 
-    for field in layer.fields():
-        if field.isNumeric():
-            numeric_fields_names.append(field.name())
+        Args:
+            lines (LineArrays): the lines
+            grid (float, optional): the cell size of the grid the endpoints are snapped to
 
-    for f in layer.getFeatures(filter_expr):
-        geom = f.geometry()
-        is_multipart = geom.isMultipart()
+        Returns:
+            CompactGraph: the graph
+        """
+        (points, node_ids) = intern_points(np.concatenate((lines.starts, lines.ends)), grid)
+        edge_nodes = np.column_stack((node_ids[:len(lines)], node_ids[len(lines):]))
 
-        if is_multipart:
-            lines = geom.asMultiPolyline()
+        return cls(points, edge_nodes, lines.fids, lines.parts, lines.attributes, grid)
+
+    def number_of_nodes(self) -> int:
+        return len(self.points)
+
+    def number_of_edges(self) -> int:
+        return int(np.count_nonzero(self.edge_alive))
+
+    def __len__(self) -> int:
+        return self.number_of_nodes()
+
+    def _get_node_index(self) -> Dict[GridKey, int]:
+        if self._node_index is None:
+            self._node_index = {(x, y): idx for idx, (x, y) in enumerate(grid_keys(self.points, self.grid).tolist())}
+
+        return self._node_index
+
+    def node_id(self, point: typing.Any) -> Optional[int]:
+        """Get the node id at the given coordinates.
+
+        Args:
+            point (typing.Any): QgsPointXY, QgsPoint or a (x, y) tuple
+
+        Returns:
+            Optional[int]: the node id, None if there is no node in the grid cell of these coordinates
+        """
+        if isinstance(point, tuple):
+            (x, y) = point
         else:
-            lines = [geom.asPolyline()]
+            (x, y) = (point.x(), point.y())
 
-        for idx, line in enumerate(lines):
-            startPoint = line[0]
-            endPoint = line[-1]
-            fid = f.id()
+        return self._get_node_index().get(grid_key(x, y, self.grid))
 
-            if is_multipart:
-                fid = (fid, idx)
+    def node_point(self, node: int) -> NodeKey:
+        x, y = self.points[node].tolist()
+        return (x, y)
 
-            # due to buggy behaviour, weight should never be None (for now)
-            data = {DEFAULT_WEIGHT_NAME: DEFAULT_WEIGHT_VALUE}
+    def degree(self, node: int) -> int:
+        return len(self.half_edges(node)[0])
 
-            if weight_expr:
-                weight_expr.evaluate(f)
-                # TODO fix this
-                # data[weight_expr_str] = res if res is not None else DEFAULT_WEIGHT_VALUE
+    def degrees(self) -> np.ndarray:
+        """Get the degree of every node, a loop counts twice like in `degree`.
 
-            for field_name in numeric_fields_names:
-                data[field_name] = f[field_name] if f[field_name] else f[field_name] or DEFAULT_WEIGHT_VALUE
+        Returns:
+            np.ndarray: the degree of each node
+        """
+        return np.bincount(self.edge_nodes[self.edge_alive].ravel(), minlength=len(self.points))
 
-            G.add_edge(startPoint, endPoint, fid, **data)
+    def incident_edges(self, node: int) -> np.ndarray:
+        return np.array(self.half_edges(node)[1], dtype=np.int64)
 
-    return G
+    def neighbors(self, node: int) -> List[int]:
+        return list(dict.fromkeys(self.half_edges(node)[0]))
 
-def prepare_subgraphs(G: nx.MultiGraph) -> Collection[nx.Graph]:
-    return tuple(nx.connected_component_subgraphs(G))
+    def half_edges(self, node: int) -> Tuple[List[int], List[int]]:
+        """Get the adjacency of a node.
 
-def find_steiner_tree(graphs: Collection, terminal_nodes: Collection, metric_closures: typing.List[nx.Graph] = None) -> nx.Graph:
-    terminal_graph = None
-    terminal_metric_closure = None
+        Args:
+            node (int): node id
 
-    for idx, g in enumerate(graphs):
-        if not all(node in g for node in terminal_nodes):
-            continue
+        Returns:
+            Tuple[List[int], List[int]]: the neighbouring node and the edge index of each incident half-edge
+        """
+        if node + 1 < len(self.offsets):
+            start, end = self.offsets[node], self.offsets[node + 1]
+            targets = self.targets[start:end]
+            edges = self.edge_ids[start:end]
 
-        terminal_graph = g
-        terminal_metric_closure = metric_closures[idx] if metric_closures else None
+            if self._csr_has_removed:
+                alive = self.edge_alive[edges]
+                targets = targets[alive]
+                edges = edges[alive]
 
-    if not terminal_graph:
-        raise NoSuitableGraphError()
+            targets = targets.tolist()
+            edges = edges.tolist()
+        else:
+            targets = []
+            edges = []
+
+        overlay = self._overlay.get(node)
+
+        if overlay:
+            for target, edge in overlay:
+                if self.edge_alive[edge]:
+                    targets.append(target)
+                    edges.append(edge)
+
+        return targets, edges
+
+    def edges_between(self, u: int, v: int) -> List[int]:
+        targets, edges = self.half_edges(u)
+
+        return sorted(set(edge for target, edge in zip(targets, edges) if target == v))
+
+    def has_edge(self, u: int, v: int) -> bool:
+        return len(self.edges_between(u, v)) > 0
+
+    def edge_key(self, edge: int) -> EdgeKey:
+        """Get the key that was used for the line in the layer.
+
+        Args:
+            edge (int): edge index
+
+        Returns:
+            EdgeKey: the feature id, or (feature id, part index) for multipart features
+        """
+        fid = int(self.edge_fids[edge])
+        part = int(self.edge_parts[edge])
+
+        return fid if part < 0 else (fid, part)
+
+    def edge_keys(self, edges: Iterable[int]) -> List[EdgeKey]:
+        return [self.edge_key(edge) for edge in edges]
+
+    def line_keys(self, edge_keys: Iterable[EdgeKey]) -> List[EdgeKey]:
+        """Get the keys of the lines behind edge keys, in a graph built from the lines they are the same keys.
+
+        Args:
+            edge_keys (Iterable[EdgeKey]): edge keys, as returned by `edge_key`
+
+        Returns:
+            List[EdgeKey]: the line keys
+        """
+        return list(edge_keys)
+
+    def edges_of_features(self, fids: Collection[int]) -> np.ndarray:
+        """Get the indices of the (not removed) edges created from the given features.
+
+        Args:
+            fids (Collection[int]): feature ids
+
+        Returns:
+            np.ndarray: edge indices
+        """
+        fids = np.fromiter(fids, dtype=np.int64)
+
+        return np.flatnonzero(np.isin(self.edge_fids, fids) & self.edge_alive)
+
+    def attribute_names(self) -> List[str]:
+        return list(self._attributes.keys())
+
+    def attributes(self) -> Dict[str, np.ndarray]:
+        """Get the attribute values of each edge, NaN for NULL.
+
+        Returns:
+            Dict[str, np.ndarray]: the values indexed by the edge index, keyed by field name
+        """
+        return self._attributes
+
+    def weight_names(self) -> List[str]:
+        names = [DEFAULT_WEIGHT_NAME] + list(self._attributes.keys()) + list(self._weights.keys())
+
+        return list(dict.fromkeys(names))
+
+    def has_weights(self, name: str = None) -> bool:
+        """Check if the weights are known without evaluating an expression: default weight, field name or weights set for this revision."""
+        name = name or DEFAULT_WEIGHT_NAME
+
+        if name == DEFAULT_WEIGHT_NAME or name in self._attributes:
+            return True
+
+        cached = self._weights.get(name)
+
+        return cached is not None and cached[0] == self.revision
+
+    def weights(self, name: str = None) -> np.ndarray:
+        """Get the weight of each edge.
+
+        Args:
+            name (str, optional): weight name, the field name or the weight expression set with `set_weights`
+
+        Returns:
+            np.ndarray: the weights, indexed by the edge index. The default weight name without such field is `DEFAULT_WEIGHT_VALUE`
+
+        Raises:
+            UnknownWeightError: the name is neither a field nor the default weight, and its weights are not set for this revision
+        """
+        name = name or DEFAULT_WEIGHT_NAME
+        cached = self._weights.get(name)
+
+        if cached is not None and cached[0] == self.revision:
+            return cached[1]
+
+        values = self._attributes.get(name)
+
+        if values is None:
+            if name != DEFAULT_WEIGHT_NAME:
+                # the weights of an expression are dropped by the updates, they have to be set again
+                raise UnknownWeightError(name)
+
+            return np.full(len(self.edge_nodes), DEFAULT_WEIGHT_VALUE, dtype=np.float64)
+
+        # due to buggy behaviour, weight should never be None (for now)
+        values = np.where(np.isnan(values) | (values == 0), DEFAULT_WEIGHT_VALUE, values)
+        self._weights[name] = (self.revision, values)
+
+        return values
+
+    def set_weights(self, name: str, values: np.ndarray) -> None:
+        """Set the weights of an expression, they are kept until the graph is updated.
+
+        Args:
+            name (str): weight name, usually the expression
+            values (np.ndarray): the weight of each edge, NULL (NaN) values become `DEFAULT_WEIGHT_VALUE`
+        """
+        values = np.asarray(values, dtype=np.float64)
+        self._weights[name] = (self.revision, np.where(np.isnan(values), DEFAULT_WEIGHT_VALUE, values))
+
+    def weight_per_length(self, name: str = None) -> float:
+        """Get the smallest weight per unit of distance between the edge endpoints.
+
+        Any path costs at least this many times the straight distance between its ends, which makes
+        it a lower bound for goal directed searches (see `astar_path`).
+
+        Args:
+            name (str, optional): weight name
+
+        Returns:
+            float: the ratio, 0 if there is an edge with zero (or negative) weight
+        """
+        name = name or DEFAULT_WEIGHT_NAME
+        cached = self._weight_scales.get(name)
+
+        if cached is not None and cached[0] == self.revision:
+            return cached[1]
+
+        edges = np.flatnonzero(self.edge_alive)
+        chords = np.hypot(*(self.points[self.edge_nodes[edges, 0]] - self.points[self.edge_nodes[edges, 1]]).T)
+        weights = self.weights(name)[edges]
+        # closed lines have no distance between the endpoints, they can not make any path shorter
+        ratios = weights[chords > 0] / chords[chords > 0]
+        scale = max(0.0, float(ratios.min())) if len(ratios) else 0.0
+
+        if (weights <= 0).any():
+            scale = 0.0
+
+        if self.has_weights(name):
+            self._weight_scales[name] = (self.revision, scale)
+
+        return scale
+
+    def component_labels(self) -> np.ndarray:
+        """Get the connected component of each node.
+
+        Returns:
+            np.ndarray: for each node, the smallest node id in its connected component
+        """
+        if self._components is None:
+            self._components = routing_backend().component_labels(len(self.points), self.edge_nodes[self.edge_alive])
+
+        return self._components
+
+    def update(self, removed_fids: Collection[int] = (), starts: Collection[NodeKey] = (), ends: Collection[NodeKey] = (),
+               edge_fids: Collection[int] = (), edge_parts: Collection[int] = None, weights: Dict[str, Collection[float]] = None) -> GraphChange:
+        """Remove the edges of some features and add new edges, without rebuilding the graph.
+
+        Splitting a line is removing the edge of the original feature and adding the edges of the pieces.
+
+        Args:
+            removed_fids (Collection[int], optional): features whose edges are removed
+            starts (Collection[NodeKey], optional): the (x, y) of the first vertex of each new line
+            ends (Collection[NodeKey], optional): the (x, y) of the last vertex of each new line
+            edge_fids (Collection[int], optional): the feature id of each new line
+            edge_parts (Collection[int], optional): the part index of each new line, -1 for singlepart features
+            weights (Dict[str, Collection[float]], optional): attribute values for each new line, keyed by field name, NaN for NULL
+
+        Returns:
+            GraphChange: what has been changed
+        """
+        removed_edges = self.edges_of_features(removed_fids) if len(removed_fids) else np.empty(0, dtype=np.int64)
+
+        return self._apply(removed_edges, starts, ends, edge_fids, edge_parts, weights)
+
+    def _apply(self, removed_edges: np.ndarray, starts: Collection[NodeKey], ends: Collection[NodeKey], edge_fids: Collection[int],
+               edge_parts: Collection[int] = None, weights: Dict[str, Collection[float]] = None) -> GraphChange:
+        old_revision = self.revision
+
+        self.edge_alive[removed_edges] = False
+        self._csr_has_removed = self._csr_has_removed or bool(len(removed_edges))
+
+        node_index = self._get_node_index()
+        node_count = len(self.points)
+        new_points: List[NodeKey] = []
+        edge_nodes = np.empty((len(edge_fids), 2), dtype=np.int32)
+
+        for idx, line_ends in enumerate(zip(starts, ends)):
+            for col, point in enumerate(line_ends):
+                key = grid_key(point[0], point[1], self.grid)
+                node = node_index.get(key)
+
+                if node is None:
+                    node = node_count + len(new_points)
+                    node_index[key] = node
+                    new_points.append(point)
+
+                edge_nodes[idx, col] = node
+
+        edge_count = len(self.edge_nodes)
+        added_edges = np.arange(edge_count, edge_count + len(edge_nodes), dtype=np.int64)
+        added_nodes = np.arange(node_count, node_count + len(new_points), dtype=np.int64)
+
+        if new_points:
+            self.points = np.concatenate((self.points, np.array(new_points, dtype=np.float64).reshape(-1, 2)))
+
+        if len(edge_nodes):
+            parts = edge_parts if edge_parts is not None else [-1] * len(edge_nodes)
+
+            self.edge_nodes = np.concatenate((self.edge_nodes, edge_nodes))
+            self.edge_fids = np.concatenate((self.edge_fids, np.asarray(edge_fids, dtype=np.int64)))
+            self.edge_parts = np.concatenate((self.edge_parts, np.asarray(parts, dtype=np.int32)))
+            self.edge_alive = np.concatenate((self.edge_alive, np.ones(len(edge_nodes), dtype=bool)))
+
+            weights = weights or {}
+
+            for name in set(self._attributes) | set(weights):
+                old_values = self._attributes.get(name)
+
+                if old_values is None:
+                    old_values = np.full(edge_count, np.nan, dtype=np.float64)
+
+                new_values = weights.get(name)
+                new_values = np.asarray(new_values, dtype=np.float64) if new_values is not None else np.full(len(edge_nodes), np.nan, dtype=np.float64)
+
+                self._attributes[name] = np.concatenate((old_values, new_values))
+
+            for edge, (u, v) in zip(added_edges.tolist(), edge_nodes.tolist()):
+                self._overlay.setdefault(u, []).append((v, edge))
+                self._overlay.setdefault(v, []).append((u, edge))
+
+            self._overlay_edges += len(edge_nodes)
+
+        touched_nodes = set(self.edge_nodes[removed_edges].ravel().tolist()) | set(edge_nodes.ravel().tolist())
+
+        self._update_components(removed_edges, added_edges)
+        self.revision = next(_revisions)
+
+        if self._overlay_edges > self.OVERLAY_MAX_RATIO * len(self.edge_nodes):
+            self._build_adjacency()
+
+        return GraphChange(old_revision, self.revision, removed_edges, added_edges, added_nodes, touched_nodes)
+
+    def split_edge(self, edge: int, points: Collection[NodeKey], edge_fids: Collection[int], weights: Dict[str, Collection[float]] = None) -> GraphChange:
+        """Split an edge at the given points, the pieces become new edges.
+
+        Args:
+            edge (int): edge index
+            points (Collection[NodeKey]): the split points, ordered from the start to the end of the edge
+            edge_fids (Collection[int]): the feature id of each piece, one more than the number of points
+            weights (Dict[str, Collection[float]], optional): attribute values for each piece, the original edge values if None
+
+        Returns:
+            GraphChange: what has been changed
+        """
+        u, v = self.edge_nodes[edge].tolist()
+        chain = [self.node_point(u)] + list(points) + [self.node_point(v)]
+
+        if weights is None:
+            weights = {name: [float(values[edge])] * len(edge_fids) for name, values in self._attributes.items()}
+
+        return self._apply(np.array([edge], dtype=np.int64), chain[:-1], chain[1:], edge_fids, weights=weights)
+
+    def _update_components(self, removed_edges: np.ndarray, added_edges: np.ndarray) -> None:
+        if self._components is None:
+            return
+
+        labels = np.concatenate((self._components, np.arange(len(self._components), len(self.points), dtype=np.int64)))
+
+        if len(added_edges):
+            merged = _DisjointSet()
+
+            for lu, lv in labels[self.edge_nodes[added_edges]].tolist():
+                merged.union(lu, lv)
+
+            roots = {}
+
+            for label in merged.parents:
+                roots.setdefault(merged.find(label), []).append(label)
+
+            mapping = np.arange(len(labels), dtype=np.int64)
+
+            for group in roots.values():
+                mapping[group] = min(group)
+
+            labels = mapping[labels]
+
+        if len(removed_edges):
+            affected = np.unique(labels[self.edge_nodes[removed_edges]])
+            nodes = np.flatnonzero(np.isin(labels, affected))
+            local = np.full(len(labels), -1, dtype=np.int64)
+            local[nodes] = np.arange(len(nodes))
+
+            edge_nodes = self.edge_nodes[self.edge_alive]
+            edge_nodes = local[edge_nodes[local[edge_nodes[:, 0]] >= 0]]
+
+            labels[nodes] = nodes[_connected_component_labels(len(nodes), edge_nodes)]
+
+        self._components = labels
+
+    @classmethod
+    def estimate_bytes(cls, edge_count: int, weight_count: int = 0) -> int:
+        """Estimate the memory needed for a graph, before reading the lines.
+
+        Args:
+            edge_count (int): number of lines
+            weight_count (int, optional): number of weight fields
+
+        Returns:
+            int: size in bytes, including the coordinates index
+        """
+        return edge_count * (cls.EDGE_BYTES + 8 * weight_count)
+
+    def memory_usage(self) -> int:
+        """Get the approximate number of bytes used by the graph arrays.
+
+        Returns:
+            int: size in bytes
+        """
+        arrays = [self.points, self.edge_nodes, self.edge_fids, self.edge_parts, self.edge_alive, self.offsets, self.targets, self.edge_ids]
+        arrays.extend(self._attributes.values())
+        arrays.extend(values for (_revision, values) in self._weights.values())
+
+        if self._components is not None:
+            arrays.append(self._components)
+
+        return sum(a.nbytes for a in arrays) + self._overlay_edges * 2 * 72
+
+    def to_networkx(self, nodes: Collection[int] = None) -> nx.MultiGraph:
+        """Convert the graph, or the part of it induced by `nodes`, to networkx multigraph keyed by the line keys.
+
+        Args:
+            nodes (Collection[int], optional): restrict the result to these nodes
+
+        Returns:
+            nx.MultiGraph: the graph with the integer node ids as nodes
+        """
+        G = nx.MultiGraph()
+        edges = np.flatnonzero(self.edge_alive)
+
+        if nodes is not None:
+            mask = np.zeros(self.number_of_nodes(), dtype=bool)
+            mask[np.fromiter(nodes, dtype=np.int64)] = True
+            edges = edges[mask[self.edge_nodes[edges, 0]] & mask[self.edge_nodes[edges, 1]]]
+            G.add_nodes_from(np.flatnonzero(mask).tolist())
+        else:
+            G.add_nodes_from(range(self.number_of_nodes()))
+
+        weights = {name: self.weights(name) for name in self.weight_names()}
+
+        for edge in edges.tolist():
+            u, v = self.edge_nodes[edge].tolist()
+            G.add_edge(u, v, self.edge_key(edge), **{name: float(values[edge]) for name, values in weights.items()})
+
+        return G
+
+
+def _chain_labels(edge_nodes: np.ndarray, kept: np.ndarray) -> np.ndarray:
+    """Group the edges into chains that are joined at the nodes that are not kept.
+
+    Each node that is not kept must have exactly two incidences in `edge_nodes`. A closed ring without
+    any kept node gets the start node of one of its edges kept, `kept` is updated in place.
+
+    Args:
+        edge_nodes (np.ndarray): (m, 2) array with the nodes of each edge
+        kept (np.ndarray): mask of the kept nodes, indexed by node id
+
+    Returns:
+        np.ndarray: for each edge (row), the smallest row of the edges in its chain
+    """
+    edge_count = len(edge_nodes)
+    incidence_nodes = edge_nodes.ravel()
+    incidence_edges = np.repeat(np.arange(edge_count, dtype=np.int64), 2)
+
+    while True:
+        interior = ~kept[incidence_nodes]
+        order = np.argsort(incidence_nodes[interior], kind='stable')
+        # the two edges of each interior node are next to each other once sorted by node
+        pairs = incidence_edges[interior][order].reshape(-1, 2)
+        labels = _connected_component_labels(edge_count, pairs)
+
+        has_end = np.zeros(edge_count, dtype=bool)
+        has_end[labels[incidence_edges[~interior]]] = True
+        rings = np.unique(labels[~has_end[labels]])
+
+        if not len(rings):
+            return labels
+
+        kept[edge_nodes[rings, 0]] = True
+
+
+def _chain_ends(edge_nodes: np.ndarray, chains: np.ndarray, kept: np.ndarray, chain_count: int) -> np.ndarray:
+    """Get the two kept nodes at the ends of each chain, as a (chain_count, 2) array of node ids."""
+    incidence_nodes = edge_nodes.ravel()
+    incidence_chains = np.repeat(chains, 2)
+    at_kept = kept[incidence_nodes]
+    order = np.argsort(incidence_chains[at_kept], kind='stable')
+
+    return incidence_nodes[at_kept][order].reshape(chain_count, 2)
+
+
+class ContractedGraph(CompactGraph):
+    """Routing graph where every maximal chain of degree-2 nodes is contracted to a single edge.
+
+    Segments from image based extraction are full of degree-2 nodes, which make the searches and
+    the metric closures expand far more nodes than there are junctions. The nodes of the contracted
+    graph are the nodes of the original graph whose degree is not 2, the edges are the chains between
+    them, weighted by the sum of the weights of their edges. An edge index of the contracted graph
+    is also its key, `line_keys` expands it back to the ordered keys of the original lines.
+
+    Degree-2 nodes have no node in the contracted graph, selections that include them are routed on
+    the original graph (see `node_ids_of`). The contracted graph follows the updates of the original
+    graph with `update_from`, only the chains around the changed edges are rebuilt.
+
+    Attributes:
+        original (CompactGraph): the graph that is contracted
+        node_ids (np.ndarray): the original node id of each node
+    """
+
+    def __init__(self, original: CompactGraph, node_ids: np.ndarray, edge_nodes: np.ndarray, edge_chains: np.ndarray) -> None:
+        super().__init__(original.points[node_ids], edge_nodes, np.arange(len(edge_nodes), dtype=np.int64), grid=original.grid)
+
+        self.original = original
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        # contracted node id of each original node, -1 for the degree-2 nodes
+        self._contracted_nodes = np.full(original.number_of_nodes(), -1, dtype=np.int64)
+        self._contracted_nodes[self.node_ids] = np.arange(len(self.node_ids), dtype=np.int64)
+        # contracted edge of each original edge, -1 for the removed edges
+        self._edge_chains = edge_chains
+
+    @classmethod
+    def from_graph(cls, graph: CompactGraph) -> 'ContractedGraph':
+        """Contract the degree-2 chains of a graph.
+
+        Args:
+            graph (CompactGraph): the original graph
+
+        Returns:
+            ContractedGraph: the contracted graph
+        """
+        alive = np.flatnonzero(graph.edge_alive)
+        edge_nodes = graph.edge_nodes[alive]
+        kept = np.bincount(edge_nodes.ravel(), minlength=graph.number_of_nodes()) != 2
+
+        (_labels, chains) = np.unique(_chain_labels(edge_nodes, kept), return_inverse=True)
+        chains = chains.reshape(-1)
+        chain_count = int(chains.max()) + 1 if len(chains) else 0
+
+        node_ids = np.flatnonzero(kept)
+        contracted_nodes = np.full(graph.number_of_nodes(), -1, dtype=np.int64)
+        contracted_nodes[node_ids] = np.arange(len(node_ids), dtype=np.int64)
+
+        edge_chains = np.full(len(graph.edge_nodes), -1, dtype=np.int64)
+        edge_chains[alive] = chains
+
+        return cls(graph, node_ids, contracted_nodes[_chain_ends(edge_nodes, chains, kept, chain_count)], edge_chains)
+
+    def node_ids_of(self, nodes: Iterable[int]) -> Optional[List[int]]:
+        """Get the contracted node ids of original nodes.
+
+        Args:
+            nodes (Iterable[int]): original node ids
+
+        Returns:
+            Optional[List[int]]: the contracted node ids, None if any of the nodes is inside a chain
+        """
+        nodes = np.fromiter(nodes, dtype=np.int64)
+        contracted = self._contracted_nodes[nodes]
+
+        if (contracted < 0).any():
+            return None
+
+        return contracted.tolist()
+
+    def chain_edges(self, edge: int) -> List[int]:
+        """Get the original edges of a contracted edge, ordered from its first to its last node.
+
+        Args:
+            edge (int): contracted edge index
+
+        Returns:
+            List[int]: original edge indices
+        """
+        original = self.original
+        node = int(self.node_ids[self.edge_nodes[edge, 0]])
+        previous = -1
+        edges: List[int] = []
+
+        while True:
+            # the nodes inside the chain have only the edge we came from and the next one
+            for target, original_edge in zip(*original.half_edges(node)):
+                if original_edge != previous and self._edge_chains[original_edge] == edge:
+                    break
+            else:
+                break
+
+            edges.append(original_edge)
+            previous = original_edge
+            node = target
+
+            if self._contracted_nodes[node] >= 0:
+                break
+
+        return edges
+
+    def line_keys(self, edge_keys: Iterable[EdgeKey]) -> List[EdgeKey]:
+        return [self.original.edge_key(edge) for key in edge_keys for edge in self.chain_edges(key)]
+
+    def weight_names(self) -> List[str]:
+        return self.original.weight_names()
+
+    def has_weights(self, name: str = None) -> bool:
+        return self.original.has_weights(name)
+
+    def weights(self, name: str = None) -> np.ndarray:
+        """Get the weight of each contracted edge, the sum of the original weights along the chain."""
+        name = name or DEFAULT_WEIGHT_NAME
+        cached = self._weights.get(name)
+
+        if cached is not None and cached[0] == self.revision:
+            return cached[1]
+
+        alive = np.flatnonzero(self._edge_chains >= 0)
+        values = np.bincount(self._edge_chains[alive], weights=self.original.weights(name)[alive], minlength=len(self.edge_nodes))
+
+        # the weights of an expression may be set on the original graph later
+        if self.original.has_weights(name):
+            self._weights[name] = (self.revision, values)
+
+        return values
+
+    def update_from(self, change: GraphChange) -> GraphChange:
+        """Follow an update of the original graph, the chains through the changed edges are rebuilt.
+
+        Nodes that are once kept stay in the contracted graph, even if their degree becomes 2.
+
+        Args:
+            change (GraphChange): the change of the original graph
+
+        Returns:
+            GraphChange: the change of the contracted graph
+        """
+        original = self.original
+        node_count = original.number_of_nodes()
+        self._contracted_nodes = np.concatenate((self._contracted_nodes, np.full(node_count - len(self._contracted_nodes), -1, dtype=np.int64)))
+        self._edge_chains = np.concatenate((self._edge_chains, np.full(len(original.edge_nodes) - len(self._edge_chains), -1, dtype=np.int64)))
+
+        # the chains with removed edges and the chains through the changed nodes
+        removed_chains = set(self._edge_chains[change.removed_edges].tolist())
+
+        for node in change.touched_nodes:
+            if self._contracted_nodes[node] < 0:
+                removed_chains.update(self._edge_chains[original.half_edges(node)[1]].tolist())
+
+        removed_chains.discard(-1)
+        removed_edges = np.array(sorted(removed_chains), dtype=np.int64)
+
+        self._edge_chains[change.removed_edges] = -1
+        added = change.added_edges[original.edge_alive[change.added_edges]]
+        free = np.union1d(np.flatnonzero(np.isin(self._edge_chains, removed_edges)), added)
+
+        degree = np.bincount(original.edge_nodes[original.edge_alive].ravel(), minlength=node_count)
+        kept = (self._contracted_nodes >= 0) | (degree != 2)
+        edge_nodes = original.edge_nodes[free]
+
+        (_labels, chains) = np.unique(_chain_labels(edge_nodes, kept), return_inverse=True)
+        chains = chains.reshape(-1)
+        chain_count = int(chains.max()) + 1 if len(chains) else 0
+        ends = _chain_ends(edge_nodes, chains, kept, chain_count)
+
+        edge_count = len(self.edge_nodes)
+        self._edge_chains[free] = edge_count + chains
+        points = [tuple(point) for point in original.points[ends.ravel()].tolist()]
+
+        contracted_change = self._apply(removed_edges, points[0::2], points[1::2], np.arange(edge_count, edge_count + chain_count))
+
+        new_nodes = np.unique(ends[self._contracted_nodes[ends] < 0])
+        self._contracted_nodes[new_nodes] = [self.node_id(point) for point in map(tuple, original.points[new_nodes].tolist())]
+        self.node_ids = np.concatenate((self.node_ids, np.empty(len(contracted_change.added_nodes), dtype=np.int64)))
+        self.node_ids[self._contracted_nodes[new_nodes]] = new_nodes
+
+        return contracted_change
+
+    def memory_usage(self) -> int:
+        return super().memory_usage() + self.node_ids.nbytes + self._contracted_nodes.nbytes + self._edge_chains.nbytes
+
+
+class LineArrays:
+    """Endpoints, ids and numeric attributes of lines, as contiguous arrays with one row per line (or part of a multipart line).
+
+    Attributes:
+        starts (np.ndarray): (n, 2) array with the first vertex of each line
+        ends (np.ndarray): (n, 2) array with the last vertex of each line
+        fids (np.ndarray): feature id of each line
+        parts (np.ndarray): part index of each line, -1 when the feature is not multipart
+        attributes (Dict[str, np.ndarray]): numeric attribute values of each line, keyed by field name, NaN for NULL
+    """
+
+    def __init__(self, starts: np.ndarray, ends: np.ndarray, fids: np.ndarray, parts: np.ndarray = None, attributes: Dict[str, np.ndarray] = None) -> None:
+        self.starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+        self.ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+        self.fids = np.asarray(fids, dtype=np.int64)
+        self.parts = np.asarray(parts, dtype=np.int32) if parts is not None else np.full(len(self.fids), -1, dtype=np.int32)
+        self.attributes: Dict[str, np.ndarray] = {name: np.asarray(values, dtype=np.float64) for name, values in (attributes or {}).items()}
+
+    @classmethod
+    def concatenate(cls, lines: Collection['LineArrays']) -> 'LineArrays':
+        """Join the lines of one or more readings, only the attributes present in all of them are kept."""
+        names = set.intersection(*(set(reading.attributes) for reading in lines))
+
+        return cls(
+            np.concatenate([reading.starts for reading in lines]),
+            np.concatenate([reading.ends for reading in lines]),
+            np.concatenate([reading.fids for reading in lines]),
+            np.concatenate([reading.parts for reading in lines]),
+            {name: np.concatenate([reading.attributes[name] for reading in lines]) for name in names}
+        )
+
+    def __len__(self) -> int:
+        return len(self.fids)
+
+    def take(self, indices: np.ndarray) -> 'LineArrays':
+        return LineArrays(self.starts[indices], self.ends[indices], self.fids[indices], self.parts[indices],
+                          {name: values[indices] for name, values in self.attributes.items()})
+
+    def unique(self) -> 'LineArrays':
+        """Drop the lines that are read more than once, keeping the first occurrence."""
+        (_keys, first) = np.unique(np.column_stack((self.fids, self.parts)), axis=0, return_index=True)
+        first.sort()
+
+        return self.take(first)
+
+    def nbytes(self) -> int:
+        arrays = [self.starts, self.ends, self.fids, self.parts]
+        arrays.extend(self.attributes.values())
+
+        return sum(a.nbytes for a in arrays)
+
+
+def read_lines(features: Iterable[QgsFeature], numeric_fields_names: Collection[str]) -> LineArrays:
+    """Read the endpoints, ids and numeric attributes of line features into arrays.
+
+    Only the first and last vertex of each line are read, the geometries are not copied.
+
+    Args:
+        features (Iterable[QgsFeature]): line features
+        numeric_fields_names (Collection[str]): the numeric fields to be used as weights
+
+    Returns:
+        LineArrays: the lines
+    """
+    coords: List[float] = []
+    fids: List[int] = []
+    parts: List[int] = []
+    values: List[List[float]] = [[] for _name in numeric_fields_names]
+    field_idxs: Optional[List[int]] = None
+
+    for f in features:
+        geom = f.geometry().constGet()
+
+        if geom is None:
+            continue
+
+        if field_idxs is None:
+            field_idxs = [f.fields().lookupField(name) for name in numeric_fields_names]
+
+        if QgsWkbTypes.isMultiType(geom.wkbType()):
+            lines = [geom.geometryN(idx) for idx in range(geom.numGeometries())]
+            is_multipart = True
+        else:
+            lines = [geom]
+            is_multipart = False
+
+        attributes = f.attributes()
+
+        for idx, line in enumerate(lines):
+            startPoint = line.startPoint()
+            endPoint = line.endPoint()
+
+            coords.extend((startPoint.x(), startPoint.y(), endPoint.x(), endPoint.y()))
+            fids.append(f.id())
+            parts.append(idx if is_multipart else -1)
+
+            for field_values, field_idx in zip(values, field_idxs):
+                value = attributes[field_idx]
+                field_values.append(value if value or value == 0 else np.nan)
+
+    endpoints = np.array(coords, dtype=np.float64).reshape(-1, 4)
+
+    return LineArrays(endpoints[:, :2], endpoints[:, 2:], fids, parts, dict(zip(numeric_fields_names, values)))
+
+def read_layer_lines(layer: QgsVectorLayer, numeric_fields_names: Collection[str], request: QgsFeatureRequest = None) -> LineArrays:
+    """Read the lines of a layer into arrays in one pass, requesting only the given attributes.
+
+    Args:
+        layer (QgsVectorLayer): the line layer
+        numeric_fields_names (Collection[str]): the numeric fields to be used as weights
+        request (QgsFeatureRequest, optional): filter of the features to be read, the whole layer if None
+
+    Returns:
+        LineArrays: the lines
+    """
+    if request is None:
+        request = QgsFeatureRequest()
+
+    request.setSubsetOfAttributes(list(numeric_fields_names), layer.fields())
+
+    return read_lines(layer.getFeatures(request), numeric_fields_names)
+
+def numeric_fields_names(layer: QgsVectorLayer) -> List[str]:
+    return [field.name() for field in layer.fields() if field.isNumeric()]
+
+def prepare_graph_from_lines(layer: QgsVectorLayer, weight_expr_str: str = None, filter_expr: Union[QgsRectangle, str, List] = '1=1',
+                             grid: float = DEFAULT_NODE_GRID) -> CompactGraph:
+    if layer.geometryType() != QgsWkbTypes.LineGeometry:
+        raise Exception('Only line layers are accepted')
+
+    if filter_expr == '1=1':
+        lines = read_layer_lines(layer, numeric_fields_names(layer))
+    elif isinstance(filter_expr, QgsRectangle):
+        lines = read_layer_lines(layer, numeric_fields_names(layer), QgsFeatureRequest().setFilterRect(filter_expr))
+    elif isinstance(filter_expr, str):
+        lines = read_layer_lines(layer, numeric_fields_names(layer), QgsFeatureRequest().setFilterExpression(filter_expr))
+    else:
+        lines = read_layer_lines(layer, numeric_fields_names(layer), QgsFeatureRequest().setFilterFids(list(filter_expr)))
+
+    graph = CompactGraph.from_lines(lines, grid)
+
+    if weight_expr_str:
+        prepare_weights(graph, layer, weight_expr_str)
+
+    return graph
+
+def update_graph_from_lines(graph: CompactGraph, layer: QgsVectorLayer, removed_fids: Collection[int], added_fids: Collection[int]) -> GraphChange:
+    """Apply the changes of the line layer to an already built graph.
+
+    Args:
+        graph (CompactGraph): the graph, built from the layer before the changes
+        layer (QgsVectorLayer): the line layer
+        removed_fids (Collection[int]): ids of the deleted features
+        added_fids (Collection[int]): ids of the added features
+
+    Returns:
+        GraphChange: what has been changed in the graph
+    """
+    if added_fids:
+        lines = read_layer_lines(layer, numeric_fields_names(layer), QgsFeatureRequest().setFilterFids(list(added_fids)))
+    else:
+        lines = LineArrays((), (), ())
+
+    return graph.update(
+        removed_fids,
+        [(x, y) for x, y in lines.starts.tolist()],
+        [(x, y) for x, y in lines.ends.tolist()],
+        lines.fids,
+        lines.parts,
+        lines.attributes
+    )
+
+def _float_or_nan(value: typing.Any) -> float:
+    return float(value) if isinstance(value, (int, float)) else np.nan
+
+def _compare(func: typing.Callable) -> typing.Callable:
+    """Comparison returning 1 or 0, and NaN (NULL) when any of the values is NULL, like in QGIS expressions."""
+    def compare(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        return np.where(np.isnan(a) | np.isnan(b), np.nan, func(a, b).astype(np.float64))
+
+    return compare
+
+def _divide(func: typing.Callable) -> typing.Callable:
+    """Division that gives NULL for a zero divisor, like in QGIS expressions."""
+    def divide(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(b == 0, np.nan, func(a, b))
+
+    return divide
+
+def _coalesce(*values: np.ndarray) -> np.ndarray:
+    result = values[0]
+
+    for value in values[1:]:
+        result = np.where(np.isnan(result), value, result)
+
+    return result
+
+
+# numpy counterparts of the expression operators and functions, by QgsExpressionNodeBinaryOperator member name and function name
+_BINARY_OPERATIONS: Dict[str, typing.Callable] = {
+    'boPlus': np.add,
+    'boMinus': np.subtract,
+    'boMul': np.multiply,
+    'boPow': np.power,
+    'boDiv': _divide(np.divide),
+    'boIntDiv': _divide(lambda a, b: np.floor(a / b)),
+    'boMod': _divide(np.fmod),
+    'boEQ': _compare(np.equal),
+    'boNE': _compare(np.not_equal),
+    'boLT': _compare(np.less),
+    'boLE': _compare(np.less_equal),
+    'boGT': _compare(np.greater),
+    'boGE': _compare(np.greater_equal),
+}
+_FUNCTIONS: Dict[str, typing.Callable] = {
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'ln': np.log,
+    'log10': np.log10,
+    'floor': np.floor,
+    'ceil': np.ceil,
+    'min': lambda *values: functools.reduce(np.fmin, values),
+    'max': lambda *values: functools.reduce(np.fmax, values),
+    'coalesce': _coalesce,
+}
+
+ColumnsFunction = typing.Callable[[Dict[str, np.ndarray]], np.ndarray]
+
+def _compile_expression_node(node: QgsExpressionNode, columns: Collection[str]) -> Optional[ColumnsFunction]:
+    """Translate an expression node to a function over the attribute arrays.
+
+    Args:
+        node (QgsExpressionNode): the node
+        columns (Collection[str]): names of the numeric attributes that are available as arrays
+
+    Returns:
+        Optional[ColumnsFunction]: the function, None if some part of the expression has no numpy counterpart
+    """
+    node_type = node.nodeType()
+
+    if node_type == QgsExpressionNode.ntLiteral:
+        value = node.value()
+
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+
+        return lambda arrays: np.float64(value)
+
+    if node_type == QgsExpressionNode.ntColumnRef:
+        name = node.name()
+
+        if name not in columns:
+            return None
+
+        return lambda arrays: arrays[name]
+
+    if node_type == QgsExpressionNode.ntUnaryOperator:
+        operand = _compile_expression_node(node.operand(), columns)
+
+        if operand is None or node.op() != QgsExpressionNodeUnaryOperator.uoMinus:
+            return None
+
+        return lambda arrays: -operand(arrays)
+
+    if node_type == QgsExpressionNode.ntBinaryOperator:
+        operation = next((func for name, func in _BINARY_OPERATIONS.items() if node.op() == getattr(QgsExpressionNodeBinaryOperator, name)), None)
+        left = _compile_expression_node(node.opLeft(), columns)
+        right = _compile_expression_node(node.opRight(), columns)
+
+        if operation is None or left is None or right is None:
+            return None
+
+        return lambda arrays: operation(left(arrays), right(arrays))
+
+    if node_type == QgsExpressionNode.ntFunction:
+        function = _FUNCTIONS.get(QgsExpression.Functions()[node.fnIndex()].name().lower())
+        args = [_compile_expression_node(arg, columns) for arg in (node.args().list() if node.args() else [])]
+
+        if function is None or not args or None in args:
+            return None
+
+        return lambda arrays: function(*(arg(arrays) for arg in args))
+
+    return None
+
+
+class WeightExpressionError(BoundaryDelineationError):
+    def __init__(self, expression: str = None, message: str = None):
+        self.expression = expression
+        self.message = message
+
+
+class WeightExpression:
+    """Weight expression, prepared once against the fields of the line layer.
+
+    Expressions made only of numeric fields, numbers, arithmetic and comparison operators and a few math
+    functions are translated to numpy and evaluated over the attribute arrays of the graph at once.
+    Other expressions (e.g. using the geometry) are evaluated feature by feature.
+
+    Attributes:
+        expression (QgsExpression): the prepared expression
+        context (QgsExpressionContext): the context, with the global, project and layer scopes
+        vectorized (bool): the expression can be evaluated over the attribute arrays
+    """
+
+    def __init__(self, expression: str, layer: QgsVectorLayer) -> None:
+        self.expression = QgsExpression(expression)
+
+        if self.expression.hasParserError():
+            raise WeightExpressionError(expression, self.expression.parserErrorString())
+
+        self.context = QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
+        self.expression.prepare(self.context)
+
+        if self.expression.hasEvalError():
+            raise WeightExpressionError(expression, self.expression.evalErrorString())
+
+        self._function: Optional[ColumnsFunction] = None
+
+        if not self.expression.needsGeometry():
+            self._function = _compile_expression_node(self.expression.rootNode(), numeric_fields_names(layer))
+
+        self.vectorized = self._function is not None
+
+    def evaluate_arrays(self, attributes: Dict[str, np.ndarray], count: int) -> np.ndarray:
+        """Evaluate a vectorized expression over attribute arrays.
+
+        Args:
+            attributes (Dict[str, np.ndarray]): attribute values keyed by field name, NaN for NULL
+            count (int): the length of the arrays, used when the expression is a constant
+
+        Returns:
+            np.ndarray: the values, NaN for NULL
+        """
+        assert self._function
+
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            values = self._function(attributes)
+
+        return np.broadcast_to(np.asarray(values, dtype=np.float64), (count,)).copy()
+
+    def evaluate_features(self, layer: QgsVectorLayer) -> Dict[int, float]:
+        """Evaluate the expression feature by feature, in one pass over the layer.
+
+        Args:
+            layer (QgsVectorLayer): the line layer
+
+        Returns:
+            Dict[int, float]: the value of each feature, NaN for NULL and non numeric values
+        """
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes(self.expression.referencedColumns(), layer.fields())
+
+        if not self.expression.needsGeometry():
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+
+        values: Dict[int, float] = {}
+
+        for f in layer.getFeatures(request):
+            self.context.setFeature(f)
+            values[f.id()] = _float_or_nan(self.expression.evaluate(self.context))
+
+        return values
+
+
+def prepare_weights(graph: CompactGraph, layer: QgsVectorLayer, name: str, expressions: Dict[str, WeightExpression] = None) -> np.ndarray:
+    """Make sure the graph has the weights of a field or an expression for its current revision.
+
+    The weights are kept in the graph until it is updated, so switching back to an already used
+    expression is as cheap as switching to a field.
+
+    Args:
+        graph (CompactGraph): the graph
+        layer (QgsVectorLayer): the line layer of the graph
+        name (str): field name or weight expression
+        expressions (Dict[str, WeightExpression], optional): already prepared expressions, new ones are added
+
+    Raises:
+        WeightExpressionError: the expression is not valid
+
+    Returns:
+        np.ndarray: the weights, indexed by the edge index
+    """
+    if graph.has_weights(name):
+        return graph.weights(name)
+
+    expression = expressions.get(name) if expressions is not None else None
+
+    if expression is None:
+        expression = WeightExpression(name, layer)
+
+        if expressions is not None:
+            expressions[name] = expression
+
+    if expression.vectorized:
+        values = expression.evaluate_arrays(graph.attributes(), len(graph.edge_fids))
+    else:
+        feature_values = expression.evaluate_features(layer)
+        values = np.array([feature_values.get(fid, np.nan) for fid in graph.edge_fids.tolist()], dtype=np.float64)
+
+    graph.set_weights(name, values)
+
+    return graph.weights(name)
+
+
+class TiledGraph:
+    """Graph of a line layer that is too big to be kept in memory, built only around the queries.
+
+    The layer is split into square tiles. The lines of a tile are read when a query first needs it and
+    the tiles are kept in a LRU cache within a memory budget. A line belongs to every tile its bounding
+    box intersects, so all the lines of a node are known once the tile of the node is loaded. The graph
+    for a query is stitched from the tiles around it: lines found in more than one tile are added once,
+    and the nodes on the tile borders join the tiles together.
+
+    Attributes:
+        layer (QgsVectorLayer): the line layer
+        tile_size (float): width and height of a tile, in layer units
+        max_bytes (int): memory budget of the tiles in bytes
+        grid (float): cell size of the grid the endpoints are snapped to
+        hits (int): number of tiles found in the cache
+        misses (int): number of tiles that had to be read from the layer
+        evictions (int): number of tiles dropped to stay within the budget
+    """
+
+    def __init__(self, layer: QgsVectorLayer, tile_size: float, max_bytes: int = DEFAULT_CACHE_BYTES, grid: float = DEFAULT_NODE_GRID,
+                 origin: Tuple[float, float] = None, fields_names: List[str] = None) -> None:
+        if origin is None:
+            extent = layer.extent()
+            origin = (extent.xMinimum(), extent.yMinimum())
+
+        self.layer = layer
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self.grid = grid
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._origin = origin
+        self._fields = fields_names if fields_names is not None else numeric_fields_names(layer)
+        self._tiles: 'OrderedDict[TileKey, LineArrays]' = OrderedDict()
+        self._nbytes = 0
+        self._graph: Optional[CompactGraph] = None
+        self._graph_tiles: Set[TileKey] = set()
+
+    @classmethod
+    def from_layer(cls, layer: QgsVectorLayer, max_bytes: int = DEFAULT_CACHE_BYTES, tile_features: int = DEFAULT_TILE_FEATURES,
+                   grid: float = DEFAULT_NODE_GRID) -> 'TiledGraph':
+        """Create a tiled graph with tiles that hold about `tile_features` lines, if the lines are spread evenly.
+
+        Args:
+            layer (QgsVectorLayer): the line layer
+            max_bytes (int, optional): memory budget of the tiles in bytes
+            tile_features (int, optional): expected number of lines in a tile
+            grid (float, optional): the cell size of the grid the endpoints are snapped to
+
+        Returns:
+            TiledGraph: the tiled graph
+        """
+        extent = layer.extent()
+        tiles_count = max(1.0, layer.featureCount() / tile_features)
+        area = extent.width() * extent.height()
+
+        if area > 0:
+            tile_size = float(np.sqrt(area / tiles_count))
+        else:
+            tile_size = max(extent.width(), extent.height(), 1.0)
+
+        return cls(layer, tile_size, max_bytes, grid)
+
+    @classmethod
+    def from_lines(cls, layer: QgsVectorLayer, lines: LineArrays, max_bytes: int = DEFAULT_CACHE_BYTES, tile_features: int = DEFAULT_TILE_FEATURES,
+                   grid: float = DEFAULT_NODE_GRID) -> 'TiledGraph':
+        """Create a tiled graph like `from_layer`, with the tiles laid out over the endpoints of the lines already read from the layer.
+
+        The layer is not accessed until the first tile is read, so the graph can be created in a background task.
+
+        Args:
+            layer (QgsVectorLayer): the line layer
+            lines (LineArrays): all the lines of the layer
+            max_bytes (int, optional): memory budget of the tiles in bytes
+            tile_features (int, optional): expected number of lines in a tile
+            grid (float, optional): the cell size of the grid the endpoints are snapped to
+
+        Returns:
+            TiledGraph: the tiled graph
+        """
+        points = np.concatenate((lines.starts, lines.ends))
+        (xmin, ymin) = points.min(axis=0).tolist() if len(points) else (0.0, 0.0)
+        (xmax, ymax) = points.max(axis=0).tolist() if len(points) else (0.0, 0.0)
+        tiles_count = max(1.0, len(lines) / tile_features)
+        area = (xmax - xmin) * (ymax - ymin)
+
+        if area > 0:
+            tile_size = float(np.sqrt(area / tiles_count))
+        else:
+            tile_size = max(xmax - xmin, ymax - ymin, 1.0)
+
+        return cls(layer, tile_size, max_bytes, grid, origin=(xmin, ymin), fields_names=list(lines.attributes))
+
+    def tile_keys(self, bounds: Tuple[float, float, float, float], margin: int = 0) -> List[TileKey]:
+        """Get the tiles that cover the bounds.
+
+        Args:
+            bounds (Tuple[float, float, float, float]): xmin, ymin, xmax, ymax in layer units
+            margin (int, optional): number of additional tiles around the bounds, in each direction
+
+        Returns:
+            List[TileKey]: (column, row) of each tile
+        """
+        (xmin, ymin, xmax, ymax) = bounds
+        (x0, y0) = self._origin
+
+        first_col = int(np.floor((xmin - x0) / self.tile_size)) - margin
+        last_col = int(np.floor((xmax - x0) / self.tile_size)) + margin
+        first_row = int(np.floor((ymin - y0) / self.tile_size)) - margin
+        last_row = int(np.floor((ymax - y0) / self.tile_size)) + margin
+
+        return [(col, row) for col in range(first_col, last_col + 1) for row in range(first_row, last_row + 1)]
+
+    def tile_bounds(self, key: TileKey) -> Tuple[float, float, float, float]:
+        (col, row) = key
+        (x0, y0) = self._origin
+
+        return (x0 + col * self.tile_size, y0 + row * self.tile_size, x0 + (col + 1) * self.tile_size, y0 + (row + 1) * self.tile_size)
+
+    def graph(self, bounds: Tuple[float, float, float, float], margin: int = 1) -> CompactGraph:
+        """Get a graph of all the lines in the tiles around the bounds.
+
+        The previous graph is returned as long as it covers the requested tiles, so the graph revision
+        (and the shortest path trees of the graph) survive queries in the same area.
+
+        Args:
+            bounds (Tuple[float, float, float, float]): xmin, ymin, xmax, ymax in layer units
+            margin (int, optional): number of additional tiles around the bounds, in each direction
+
+        Returns:
+            CompactGraph: the graph
+        """
+        keys = self.tile_keys(bounds, margin)
+
+        if self._graph is not None and self._graph_tiles.issuperset(keys):
+            return self._graph
+
+        lines = LineArrays.concatenate([self._tile(key) for key in keys])
+
+        self._graph = CompactGraph.from_lines(lines.unique(), self.grid)
+        self._graph_tiles = set(keys)
+        self._evict(keep=self._graph_tiles)
+
+        return self._graph
+
+    def invalidate(self, bounds: Tuple[float, float, float, float]) -> None:
+        """Drop the tiles around lines that have been changed in the layer.
+
+        The current graph is kept, it is expected to be updated in place (see `update_graph_from_lines`).
+
+        Args:
+            bounds (Tuple[float, float, float, float]): xmin, ymin, xmax, ymax of the changes, in layer units
+        """
+        for key in self.tile_keys(bounds):
+            tile = self._tiles.pop(key, None)
+
+            if tile is not None:
+                self._nbytes -= tile.nbytes()
+
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'tiles': len(self._tiles),
+            'bytes': self._nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'graph_edges': self._graph.number_of_edges() if self._graph is not None else 0,
+        }
+
+    def _tile(self, key: TileKey) -> LineArrays:
+        tile = self._tiles.get(key)
+
+        if tile is not None:
+            self.hits += 1
+            self._tiles.move_to_end(key)
+
+            return tile
+
+        self.misses += 1
+        tile = self._read_tile(self.tile_bounds(key))
+        self._tiles[key] = tile
+        self._nbytes += tile.nbytes()
+
+        return tile
+
+    def _read_tile(self, bounds: Tuple[float, float, float, float]) -> LineArrays:
+        return read_layer_lines(self.layer, self._fields, QgsFeatureRequest().setFilterRect(QgsRectangle(*bounds)))
+
+    def _evict(self, keep: Collection[TileKey] = ()) -> None:
+        for key in list(self._tiles.keys()):
+            if self._nbytes <= self.max_bytes:
+                break
+
+            if key in keep:
+                continue
+
+            self._nbytes -= self._tiles.pop(key).nbytes()
+            self.evictions += 1
+
+
+class ComponentIndex:
+    """Connected components of a `CompactGraph`, looked up by the component label of the nodes.
+
+    The label of a component is the smallest node id in it (see `CompactGraph.component_labels`), the
+    labels are kept up to date by the graph updates. The nodes of each component are a slice of one
+    array of nodes ordered by label, so no component is copied unless its networkx subgraph is asked for.
+
+    Attributes:
+        graph (CompactGraph): the graph
+    """
+
+    def __init__(self, graph: CompactGraph) -> None:
+        self.graph = graph
+        self._revision: Optional[int] = None
+        self._order = np.empty(0, dtype=np.int64)
+        self._sorted_labels = np.empty(0, dtype=np.int64)
+        self._edges_revision: Optional[int] = None
+        self._edge_order = np.empty(0, dtype=np.int64)
+        self._sorted_edge_labels = np.empty(0, dtype=np.int64)
+        self._subgraphs: Dict[int, nx.MultiGraph] = {}
+
+    def _index(self) -> None:
+        if self._revision == self.graph.revision:
+            return
+
+        labels = self.graph.component_labels()
+        self._order = np.argsort(labels, kind='stable')
+        self._sorted_labels = labels[self._order]
+        self._revision = self.graph.revision
+
+    def _index_edges(self) -> None:
+        if self._edges_revision == self.graph.revision:
+            return
+
+        edges = np.flatnonzero(self.graph.edge_alive)
+        labels = self.graph.component_labels()[self.graph.edge_nodes[edges, 0]]
+        order = np.argsort(labels, kind='stable')
+        self._edge_order = edges[order]
+        self._sorted_edge_labels = labels[order]
+        self._edges_revision = self.graph.revision
+
+    def component_of(self, nodes: Collection[int]) -> Optional[int]:
+        """Get the component that holds all the nodes.
+
+        Args:
+            nodes (Collection[int]): node ids
+
+        Returns:
+            Optional[int]: the component label, None if the nodes are in different components
+        """
+        labels = self.graph.component_labels()[np.fromiter(nodes, dtype=np.int64)]
+
+        if not len(labels) or not (labels == labels[0]).all():
+            return None
+
+        return int(labels[0])
+
+    def labels(self, min_size: int = 1) -> List[int]:
+        """Get the labels of the components with at least `min_size` nodes."""
+        self._index()
+        (labels, counts) = np.unique(self._sorted_labels, return_counts=True)
+
+        return labels[counts >= min_size].tolist()
+
+    def nodes(self, label: int) -> np.ndarray:
+        """Get the node ids of a component, as a view of the index array."""
+        self._index()
+        start, end = np.searchsorted(self._sorted_labels, [label, label + 1])
+
+        return self._order[start:end]
+
+    def edges(self, label: int) -> np.ndarray:
+        """Get the indices of the alive edges of a component, as a view of the index array."""
+        self._index_edges()
+        start, end = np.searchsorted(self._sorted_edge_labels, [label, label + 1])
+
+        return self._edge_order[start:end]
+
+    def subgraph(self, label: int, weight: str = None) -> nx.MultiGraph:
+        """Get the networkx graph of a single component, built on the first request and kept until the component changes.
+
+        Args:
+            label (int): component label
+            weight (str, optional): weight name that the edges should have as attribute
+
+        Returns:
+            nx.MultiGraph: the subgraph
+        """
+        subgraph = self._subgraphs.get(label)
+
+        if subgraph is None or (weight or DEFAULT_WEIGHT_NAME) not in subgraph.graph['weights']:
+            subgraph = self.graph.to_networkx(self.nodes(label))
+            subgraph.graph['weights'] = set(self.graph.weight_names())
+            self._subgraphs[label] = subgraph
+
+        return subgraph
+
+    def merge(self, other: 'ComponentIndex') -> None:
+        """Take over the subgraphs built by another index of the same graph, e.g. in a background task.
+
+        Nothing is taken if the graph has changed since, the subgraphs may be outdated.
+
+        Args:
+            other (ComponentIndex): the other index
+        """
+        if other.graph is not self.graph or other._revision != self.graph.revision:
+            return
+
+        for label, subgraph in other._subgraphs.items():
+            self._subgraphs.setdefault(label, subgraph)
+
+    def apply_change(self, change: GraphChange) -> Set[int]:
+        """Drop the subgraphs of the components touched by a graph change.
+
+        Args:
+            change (GraphChange): the change
+
+        Returns:
+            Set[int]: labels of the changed components, before and after the change. Anything kept per component under these labels is no longer valid
+        """
+        touched = change.touched_nodes
+        changed = {label for label, subgraph in self._subgraphs.items() if any(node in subgraph for node in touched)}
+
+        if touched:
+            changed.update(np.unique(self.graph.component_labels()[np.fromiter(touched, dtype=np.int64)]).tolist())
+
+        for label in changed:
+            self._subgraphs.pop(label, None)
+
+        return changed
+
+
+def prepare_components(G: CompactGraph) -> ComponentIndex:
+    return ComponentIndex(G)
+
+def mehlhorn_steiner_tree(graph: CompactGraph, terminal_nodes: Collection[int], weight: str = None) -> List[int]:
+    """Approximate the minimum Steiner tree using only shortest path searches from the terminals.
+
+    Mehlhorn's algorithm: a single multi-source Dijkstra from all terminals splits the graph into
+    Voronoi regions around the terminals. Every edge between two regions is a bridge between their
+    terminals, weighted by the path terminal -> edge -> terminal. The minimum spanning tree of the
+    bridges, expanded back to graph edges, is within (2 - 2 / t) of the optimal tree, the same
+    guarantee as the metric closure approach.
+
+    The Dijkstra runs in increasing distance, so once it has settled all nodes up to distance `r`,
+    every bridge cheaper than `r` is already known. Kruskal is run on these bridges while the search
+    advances, and the search stops as soon as all terminals are connected. The cost of a query
+    depends on the area around the terminals and not on the size of the connected component.
+
+    Args:
+        graph (CompactGraph): the graph
+        terminal_nodes (Collection[int]): node ids that should be connected
+        weight (str, optional): weight name
+
+    Raises:
+        NoSuitableGraphError: the terminals are not in the same connected component
+
+    Returns:
+        List[int]: edge indices of the tree
+    """
+    terminals = list(dict.fromkeys(terminal_nodes))
+
+    if len(terminals) < 2:
+        return []
+
+    weights = graph.weights(weight)
+    dist: Dict[int, float] = {}
+    base: Dict[int, int] = {}
+    pred: Dict[int, Tuple[int, int]] = {}
+    seen: Dict[int, float] = {}
+    seen_base: Dict[int, int] = {}
+    seen_pred: Dict[int, Tuple[int, int]] = {}
+    fringe: List[Tuple[float, int]] = []
+    bridges: List[Tuple[float, int, int, int]] = []
+    chosen_bridges: List[Tuple[float, int, int, int]] = []
+    terminals_set = _DisjointSet(terminals)
+    remaining = len(terminals) - 1
+
+    def connect_bridges(radius: float) -> int:
+        connected = 0
+
+        while bridges and bridges[0][0] <= radius and connected < remaining:
+            bridge = heappop(bridges)
+
+            if terminals_set.union(base[bridge[2]], base[bridge[3]]):
+                chosen_bridges.append(bridge)
+                connected += 1
+
+        return connected
+
+    for terminal in terminals:
+        seen[terminal] = 0.0
+        seen_base[terminal] = terminal
+        seen_pred[terminal] = (-1, -1)
+        heappush(fringe, (0.0, terminal))
+
+    while fringe and remaining:
+        (d, v) = heappop(fringe)
+
+        if v in dist:
+            continue
+
+        dist[v] = d
+        base[v] = seen_base[v]
+        pred[v] = seen_pred[v]
+
+        for u, edge in zip(*graph.half_edges(v)):
+            cost = float(weights[edge])
+
+            if u in dist:
+                if base[u] != base[v]:
+                    heappush(bridges, (dist[u] + cost + d, edge, u, v))
+                continue
+
+            vu_dist = d + cost
+
+            if u not in seen or vu_dist < seen[u]:
+                seen[u] = vu_dist
+                seen_base[u] = base[v]
+                seen_pred[u] = (edge, v)
+                heappush(fringe, (vu_dist, u))
+
+        remaining -= connect_bridges(d)
+
+    if remaining:
+        remaining -= connect_bridges(float('inf'))
+
+    if remaining:
+        raise NoSuitableGraphError()
+
+    tree_edges = set()
+
+    for (_cost, edge, u, v) in chosen_bridges:
+        tree_edges.add(edge)
+
+        for node in (u, v):
+            (pred_edge, pred_node) = pred[node]
+
+            while pred_edge != -1 and pred_edge not in tree_edges:
+                tree_edges.add(pred_edge)
+                (pred_edge, pred_node) = pred[pred_node]
+
+    return sorted(tree_edges)
+
+
+def astar_path(graph: CompactGraph, source: int, target: int, weight: str = None) -> List[int]:
+    """Find the shortest path between two nodes with A* search.
+
+    The straight distance to the target, scaled by the smallest weight per unit of distance (see
+    `CompactGraph.weight_per_length`), never overestimates the remaining cost, so the search goes
+    towards the target and settles far fewer nodes than a Dijkstra search. With weights that are
+    not related to the line lengths the scale is small and the search is close to a Dijkstra one.
+
+    Args:
+        graph (CompactGraph): the graph
+        source (int): source node id
+        target (int): target node id
+        weight (str, optional): weight name
+
+    Raises:
+        NoSuitableGraphError: the target can not be reached from the source
+
+    Returns:
+        List[int]: edge indices of the path, from the target back to the source
+    """
+    weights = graph.weights(weight)
+    scale = graph.weight_per_length(weight)
+    points = graph.points
+    (tx, ty) = points[target].tolist()
+
+    def remaining(node: int) -> float:
+        if not scale:
+            return 0.0
+
+        (x, y) = points[node].tolist()
+        return scale * math.hypot(x - tx, y - ty)
+
+    dist: Dict[int, float] = {source: 0.0}
+    pred: Dict[int, Tuple[int, int]] = {source: (-1, -1)}
+    settled: Set[int] = set()
+    fringe: List[Tuple[float, float, int]] = [(remaining(source), 0.0, source)]
+
+    while fringe:
+        (_estimate, d, v) = heappop(fringe)
+
+        if v == target:
+            break
+
+        if v in settled:
+            continue
+
+        settled.add(v)
+
+        for u, edge in zip(*graph.half_edges(v)):
+            if u in settled:
+                continue
+
+            vu_dist = d + float(weights[edge])
+
+            if vu_dist < dist.get(u, math.inf):
+                dist[u] = vu_dist
+                pred[u] = (edge, v)
+                heappush(fringe, (vu_dist + remaining(u), vu_dist, u))
+    else:
+        raise NoSuitableGraphError()
+
+    edges = []
+    (edge, node) = pred[target]
+
+    while edge != -1:
+        edges.append(edge)
+        (edge, node) = pred[node]
+
+    return edges
+
+
+class ShortestPathTree:
+    """Single-source shortest path tree that is grown only as far as the queries need.
+
+    The Dijkstra fringe is kept, so a later query for a farther node continues the search
+    instead of starting over.
+
+    Attributes:
+        source (int): the source node id
+        dist (Dict[int, float]): distance of each settled node from the source
+        pred (Dict[int, int]): edge index used to reach each settled node, -1 for the source
+        complete (bool): all the nodes reachable from the source are settled
+    """
+
+    # approximate bytes per settled node (dict entries, float and int objects) and per fringe item
+    NODE_BYTES = 200
+    FRINGE_BYTES = 100
+
+    def __init__(self, source: int) -> None:
+        self.source = source
+        self.dist: Dict[int, float] = {}
+        self.pred: Dict[int, int] = {}
+        self.complete = False
+        self._seen: Dict[int, float] = {source: 0.0}
+        self._seen_pred: Dict[int, int] = {source: -1}
+        self._fringe: List[Tuple[float, int]] = [(0.0, source)]
+
+    def grow(self, graph: CompactGraph, weights: np.ndarray, targets: Collection[int] = None) -> bool:
+        """Continue the search until all the targets are settled, or all the reachable nodes if no targets are given.
+
+        Args:
+            graph (CompactGraph): the graph the tree belongs to
+            weights (np.ndarray): edge weights
+            targets (Collection[int], optional): node ids that should be settled
+
+        Returns:
+            bool: all the targets are reachable from the source
+        """
+        dist = self.dist
+        seen = self._seen
+        fringe = self._fringe
+        pending = set(targets) - dist.keys() if targets is not None else None
+
+        while fringe and (pending is None or pending):
+            (d, v) = heappop(fringe)
+
+            if v in dist:
+                continue
+
+            dist[v] = d
+            self.pred[v] = self._seen_pred.pop(v)
+            del seen[v]
+
+            if pending is not None:
+                pending.discard(v)
+
+            for u, edge in zip(*graph.half_edges(v)):
+                if u in dist:
+                    continue
+
+                vu_dist = d + float(weights[edge])
+
+                if u not in seen or vu_dist < seen[u]:
+                    seen[u] = vu_dist
+                    self._seen_pred[u] = edge
+                    heappush(fringe, (vu_dist, u))
+
+        if not fringe:
+            self.complete = True
+
+        return not pending
+
+    def path_edges(self, graph: CompactGraph, target: int) -> List[int]:
+        """Get the edges of the shortest path from the source to an already settled target.
+
+        Args:
+            graph (CompactGraph): the graph the tree belongs to
+            target (int): node id
+
+        Returns:
+            List[int]: edge indices, from the target back to the source
+        """
+        edges = []
+        node = target
+        edge = self.pred[node]
+
+        while edge != -1:
+            edges.append(edge)
+            u, v = graph.edge_nodes[edge].tolist()
+            node = u if v == node else v
+            edge = self.pred[node]
+
+        return edges
+
+    def touches(self, nodes: Iterable[int]) -> bool:
+        """Check if any of the nodes is settled or waiting in the fringe."""
+        return any(node in self.dist or node in self._seen for node in nodes)
+
+    def copy(self) -> 'ShortestPathTree':
+        """Copy the tree, so it can be grown separately, e.g. in another thread."""
+        tree = ShortestPathTree(self.source)
+        tree.dist = self.dist.copy()
+        tree.pred = self.pred.copy()
+        tree.complete = self.complete
+        tree._seen = self._seen.copy()
+        tree._seen_pred = self._seen_pred.copy()
+        tree._fringe = self._fringe.copy()
+
+        return tree
+
+    def nbytes(self) -> int:
+        return len(self.dist) * self.NODE_BYTES + len(self._fringe) * self.FRINGE_BYTES
+
+
+class ShortestPathTreeCache:
+    """LRU cache of shortest path trees, keyed by graph revision, weight name and source node.
+
+    The trees are grown in place, so the size of an entry is updated after each query and the least
+    recently used trees are evicted when the total goes over the budget. A different graph revision
+    drops all the entries, since they can no longer be used.
+
+    Attributes:
+        max_bytes (int): memory budget in bytes
+        hits (int): number of trees found in the cache
+        misses (int): number of trees that had to be created
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._trees: 'OrderedDict[Tuple[int, str, int], ShortestPathTree]' = OrderedDict()
+        self._sizes: Dict[Tuple[int, str, int], int] = {}
+        self._nbytes = 0
+        self._revision: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._trees)
+
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def clear(self) -> None:
+        self._trees.clear()
+        self._sizes.clear()
+        self._nbytes = 0
+        self._revision = None
+
+    def invalidate(self, revision: int = None, weight: str = None) -> None:
+        """Drop the trees that do not belong to the given graph revision and weight.
+
+        Args:
+            revision (int, optional): graph revision to keep, all are dropped if None
+            weight (str, optional): weight name to keep, all are dropped if None
+        """
+        for key in list(self._trees.keys()):
+            if key[0] != revision or key[1] != (weight or DEFAULT_WEIGHT_NAME):
+                self._remove(key)
+
+        self._revision = revision
+
+    def apply_change(self, change: GraphChange) -> None:
+        """Keep the trees that a graph update can not affect and drop the rest.
+
+        A tree stays valid if none of the changed edges touches a node it has reached: any new path
+        through the changed edges is longer than the distances settled so far, and the search reaches
+        the new edges in the normal way when it is continued.
+
+        Args:
+            change (GraphChange): the change
+        """
+        trees = self._trees
+        self._trees = OrderedDict()
+
+        for key, tree in trees.items():
+            size = self._sizes.pop(key)
+
+            if key[0] != change.old_revision or tree.touches(change.touched_nodes):
+                self._nbytes -= size
+                continue
+
+            new_key = (change.revision, key[1], key[2])
+            self._trees[new_key] = tree
+            self._sizes[new_key] = size
+
+        self._revision = change.revision
+
+    def tree(self, graph: CompactGraph, source: int, weight: str = None, targets: Collection[int] = None) -> ShortestPathTree:
+        """Get the shortest path tree from the source, grown until the targets are settled.
+
+        Args:
+            graph (CompactGraph): the graph
+            source (int): source node id
+            weight (str, optional): weight name
+            targets (Collection[int], optional): node ids that should be settled, all the reachable nodes if None
+
+        Returns:
+            ShortestPathTree: the tree
+        """
+        if graph.revision != self._revision:
+            self.clear()
+            self._revision = graph.revision
+
+        key = (graph.revision, weight or DEFAULT_WEIGHT_NAME, source)
+        tree = self._trees.get(key)
+
+        if tree is None:
+            self.misses += 1
+            tree = ShortestPathTree(source)
+            self._trees[key] = tree
+            self._sizes[key] = 0
+        else:
+            self.hits += 1
+            self._trees.move_to_end(key)
+
+        if not tree.complete and (targets is None or not tree.dist.keys() >= set(targets)):
+            tree.grow(graph, graph.weights(weight), targets)
+
+            size = tree.nbytes()
+            self._nbytes += size - self._sizes[key]
+            self._sizes[key] = size
+
+            self._evict(keep=key)
+
+        return tree
+
+    def copy(self, graph: CompactGraph, weight: str = None, sources: Collection[int] = None) -> 'ShortestPathTreeCache':
+        """Copy the trees of some sources into a new cache with the same budget, e.g. for a background task.
+
+        Args:
+            graph (CompactGraph): the graph
+            weight (str, optional): weight name
+            sources (Collection[int], optional): the source nodes of the trees to be copied, all the trees if None
+
+        Returns:
+            ShortestPathTreeCache: the new cache, see `merge` to get the grown trees back
+        """
+        cache = ShortestPathTreeCache(self.max_bytes)
+        cache._revision = graph.revision
+
+        if graph.revision != self._revision:
+            return cache
+
+        for key, tree in self._trees.items():
+            if key[1] == (weight or DEFAULT_WEIGHT_NAME) and (sources is None or key[2] in sources):
+                cache._trees[key] = tree.copy()
+                cache._sizes[key] = self._sizes[key]
+                cache._nbytes += self._sizes[key]
+
+        return cache
+
+    def merge(self, other: 'ShortestPathTreeCache') -> None:
+        """Take the trees of another cache of the same graph revision that are bigger than the own ones.
+
+        Args:
+            other (ShortestPathTreeCache): the other cache, e.g. from `copy`
+        """
+        if other._revision != self._revision:
+            return
+
+        for key, tree in other._trees.items():
+            size = other._sizes[key]
+            own = self._trees.get(key)
+
+            if own is not None and len(own.dist) >= len(tree.dist):
+                continue
+
+            if own is not None:
+                self._remove(key)
+
+            self._trees[key] = tree
+            self._sizes[key] = size
+            self._nbytes += size
+
+        self._evict()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'trees': len(self._trees),
+            'bytes': self._nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _evict(self, keep: Tuple[int, str, int] = None) -> None:
+        for key in list(self._trees.keys()):
+            if self._nbytes <= self.max_bytes:
+                break
+
+            if key == keep:
+                continue
+
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key: Tuple[int, str, int]) -> None:
+        del self._trees[key]
+        self._nbytes -= self._sizes.pop(key)
+
+
+def _prune_steiner_edges(graph: CompactGraph, edges: Iterable[int], weights: np.ndarray, terminals: Collection[int]) -> List[int]:
+    """Reduce a connected set of edges to a tree: minimum spanning tree, then drop the non-terminal leaves."""
+    nodes = _DisjointSet()
+    tree_edges = []
+
+    for edge in sorted(set(edges), key=lambda e: (weights[e], e)):
+        u, v = graph.edge_nodes[edge].tolist()
+
+        if nodes.union(u, v):
+            tree_edges.append(edge)
+
+    incident: Dict[int, List[int]] = {}
+
+    for edge in tree_edges:
+        for node in graph.edge_nodes[edge].tolist():
+            incident.setdefault(node, []).append(edge)
+
+    removed = set()
+    leaves = [node for node, node_edges in incident.items() if len(node_edges) == 1 and node not in terminals]
+
+    while leaves:
+        node = leaves.pop()
+        node_edges = [edge for edge in incident[node] if edge not in removed]
+
+        if len(node_edges) != 1:
+            continue
+
+        edge = node_edges[0]
+        removed.add(edge)
+        u, v = graph.edge_nodes[edge].tolist()
+        other = u if v == node else v
+
+        if other not in terminals and sum(1 for e in incident[other] if e not in removed) == 1:
+            leaves.append(other)
+
+    return sorted(edge for edge in tree_edges if edge not in removed)
+
+
+def kou_steiner_tree(graph: CompactGraph, terminal_nodes: Collection[int], weight: str = None, path_trees: ShortestPathTreeCache = None) -> List[int]:
+    """Approximate the minimum Steiner tree from the shortest path trees of the terminals.
+
+    The distances between the terminals are read from their shortest path trees, which are taken from
+    (and kept in) `path_trees`. Clicking again on the same vertices reuses the already grown trees.
+    The minimum spanning tree of the terminal distances is expanded to the shortest paths, and the
+    result is reduced to a tree like in the Kou, Markowsky and Berman algorithm.
+
+    Args:
+        graph (CompactGraph): the graph
+        terminal_nodes (Collection[int]): node ids that should be connected
+        weight (str, optional): weight name
+        path_trees (ShortestPathTreeCache, optional): cache of shortest path trees
+
+    Raises:
+        NoSuitableGraphError: the terminals are not in the same connected component
+
+    Returns:
+        List[int]: edge indices of the tree
+    """
+    terminals = list(dict.fromkeys(terminal_nodes))
+
+    if len(terminals) < 2:
+        return []
+
+    if path_trees is None:
+        path_trees = ShortestPathTreeCache()
+
+    trees = {}
+    distances = []
+
+    for idx, terminal in enumerate(terminals[:-1]):
+        others = terminals[idx + 1:]
+        tree = path_trees.tree(graph, terminal, weight, others)
+
+        if not tree.dist.keys() >= set(others):
+            raise NoSuitableGraphError()
+
+        trees[terminal] = tree
+        distances.extend((tree.dist[other], terminal, other) for other in others)
+
+    terminals_set = _DisjointSet(terminals)
+    path_edges: List[int] = []
+
+    for (_distance, u, v) in sorted(distances):
+        if terminals_set.union(u, v):
+            path_edges.extend(trees[u].path_edges(graph, v))
+
+    return _prune_steiner_edges(graph, path_edges, graph.weights(weight), set(terminals))
+
+
+def _restricted_astar(graph: CompactGraph, source: int, target: int, weights: np.ndarray, removed_edges: Set[int], removed_nodes: Set[int],
+                      heuristic: typing.Callable[[int], float]) -> Optional[Tuple[float, List[int], List[int]]]:
+    """A* search that avoids some edges and nodes, with a consistent heuristic.
+
+    Returns:
+        Optional[Tuple[float, List[int], List[int]]]: the cost, the edges and the nodes of the path from the source, None if there is no path
+    """
+    dist = {source: 0.0}
+    pred = {source: (-1, -1)}
+    done = set()
+    counter = count()
+    fringe = [(heuristic(source), next(counter), source)]
+
+    while fringe:
+        (_estimate, _idx, v) = heappop(fringe)
+
+        if v in done:
+            continue
+
+        if v == target:
+            edges = []
+            nodes = [v]
+
+            while pred[v][0] != -1:
+                (edge, v) = pred[v]
+                edges.append(edge)
+                nodes.append(v)
+
+            return dist[target], edges[::-1], nodes[::-1]
+
+        done.add(v)
+
+        for u, edge in zip(*graph.half_edges(v)):
+            if u in done or u in removed_nodes or edge in removed_edges:
+                continue
+
+            vu_dist = dist[v] + float(weights[edge])
+
+            if u not in dist or vu_dist < dist[u]:
+                remaining = heuristic(u)
+
+                if remaining == math.inf:
+                    continue
+
+                dist[u] = vu_dist
+                pred[u] = (edge, v)
+                heappush(fringe, (vu_dist + remaining, next(counter), u))
+
+    return None
+
+
+def yen_k_shortest_paths(graph: CompactGraph, source: int, target: int, k: int, weight: str = None, path_trees: ShortestPathTreeCache = None,
+                         feedback: QgsFeedback = None) -> List[List[int]]:
+    """Find the `k` cheapest loopless paths between two nodes, with Yen's algorithm.
+
+    Each next path deviates from one of the found paths at a spur node: the root of the found path up
+    to the spur node is kept, and the rest is the cheapest path from the spur node that avoids the root
+    and the edges through which the found paths with the same root leave the spur node. Parallel lines
+    are different paths.
+
+    The first path is read from the shortest path tree of the source, and the spur paths are searched
+    with A*, using the distances in the shortest path tree of the target as the heuristic. Both trees
+    are taken from `path_trees` and grown only as far as the searches need.
+
+    Args:
+        graph (CompactGraph): the graph
+        source (int): source node id
+        target (int): target node id
+        k (int): the number of paths
+        weight (str, optional): weight name
+        path_trees (ShortestPathTreeCache, optional): cache of shortest path trees, a temporary one if None
+        feedback (QgsFeedback, optional): when canceled, the paths found so far are returned
+
+    Raises:
+        NoSuitableGraphError: there is no path between the nodes
+
+    Returns:
+        List[List[int]]: the edge indices of each path from the source to the target, the cheapest first
+    """
+    if path_trees is None:
+        path_trees = ShortestPathTreeCache()
+
+    weights = graph.weights(weight)
+    source_tree = path_trees.tree(graph, source, weight, [target])
+
+    if target not in source_tree.dist:
+        raise NoSuitableGraphError()
+
+    target_trees = [path_trees.tree(graph, target, weight, [source])]
+
+    def heuristic(node: int) -> float:
+        remaining = target_trees[0].dist.get(node)
+
+        if remaining is None:
+            # the cached tree can be evicted by a bigger one, the cache gives a new tree in that case
+            target_trees[0] = path_trees.tree(graph, target, weight, [node])
+            remaining = target_trees[0].dist.get(node, math.inf)
+
+        return remaining
+
+    first_edges = source_tree.path_edges(graph, target)[::-1]
+    first_nodes = [source]
+
+    for edge in first_edges:
+        u, v = graph.edge_nodes[edge].tolist()
+        first_nodes.append(u if v == first_nodes[-1] else v)
+
+    paths = [(first_edges, first_nodes)]
+    candidates: List[Tuple[float, Tuple[int, ...], List[int]]] = []
+    seen = {tuple(first_edges)}
+
+    while len(paths) < k:
+        (last_edges, last_nodes) = paths[-1]
+
+        for idx in range(len(last_edges)):
+            if feedback and feedback.isCanceled():
+                return [edges for edges, _nodes in paths]
+
+            spur = last_nodes[idx]
+            root_edges = last_edges[:idx]
+            # the root is compared by the edges, the parallel lines make different roots through the same nodes
+            removed_edges = {edges[idx] for edges, _nodes in paths if edges[:idx] == root_edges}
+            spur_path = _restricted_astar(graph, spur, target, weights, removed_edges, set(last_nodes[:idx]), heuristic)
+
+            if spur_path is None:
+                continue
+
+            (spur_cost, spur_edges, spur_nodes) = spur_path
+            edges = root_edges + spur_edges
+            key = tuple(edges)
+
+            if key not in seen:
+                seen.add(key)
+                heappush(candidates, (float(weights[root_edges].sum()) + spur_cost, key, last_nodes[:idx] + spur_nodes))
+
+        if not candidates:
+            break
+
+        (_cost, edges, nodes) = heappop(candidates)
+        paths.append((list(edges), nodes))
+
+    return [edges for edges, _nodes in paths]
+
+
+def hierarchy_steiner_tree(graph: CompactGraph, terminal_nodes: Collection[int], hierarchy: ContractionHierarchy) -> List[int]:
+    """Approximate the minimum Steiner tree like `kou_steiner_tree`, with the distances between the terminals from a contraction hierarchy.
+
+    Args:
+        graph (CompactGraph): the graph
+        terminal_nodes (Collection[int]): node ids that should be connected
+        hierarchy (ContractionHierarchy): hierarchy of the component of the terminals
+
+    Raises:
+        NoSuitableGraphError: the terminals are not connected
+
+    Returns:
+        List[int]: edge indices of the tree
+    """
+    terminals = list(dict.fromkeys(terminal_nodes))
+
+    if len(terminals) < 2:
+        return []
+
+    if len(terminals) == 2:
+        return sorted(hierarchy.path_edges(terminals[0], terminals[1]))
+
+    distances = []
+
+    for idx, u in enumerate(terminals[:-1]):
+        for v in terminals[idx + 1:]:
+            distances.append((hierarchy.distance(u, v)[0], u, v))
+
+    terminals_set = _DisjointSet(terminals)
+    path_edges: List[int] = []
+
+    for (distance, u, v) in sorted(distances):
+        if terminals_set.union(u, v):
+            if distance == math.inf:
+                raise NoSuitableGraphError()
+
+            path_edges.extend(hierarchy.path_edges(u, v))
+
+    return _prune_steiner_edges(graph, path_edges, graph.weights(hierarchy.weight), set(terminals))
+
+
+class RoutingBackend:
+    """The shortest path searches behind the Steiner trees, implemented in pure python and networkx.
+
+    It is the fallback of `SciPyRoutingBackend`, which is used when SciPy is installed (see `routing_backend`).
+    Both backends give the same component labels, and the same trees whenever the shortest paths are unique.
+
+    Attributes:
+        name (str): the backend name
+    """
+
+    name = 'networkx'
+
+    def component_labels(self, node_count: int, edge_nodes: np.ndarray) -> np.ndarray:
+        """Label the connected components, each node gets the smallest node id in its component.
+
+        Args:
+            node_count (int): number of nodes
+            edge_nodes (np.ndarray): (m, 2) array with the node ids of the edges
+
+        Returns:
+            np.ndarray: the label of each node
+        """
+        return _connected_component_labels(node_count, edge_nodes)
+
+    def metric_closure(self, component: ComponentArrays, G: nx.MultiGraph = None) -> MetricClosure:
+        """Calculate the metric closure of a component.
+
+        Args:
+            component (ComponentArrays): the component
+            G (nx.MultiGraph, optional): the networkx graph of the component, built from `component` if None
+
+        Raises:
+            nx.NetworkXError: the component is not connected
+
+        Returns:
+            MetricClosure: the metric closure
+        """
+        return metric_closure(component, G)
+
+    def steiner_tree(self, graph: CompactGraph, terminal_nodes: Collection[int], weight: str = None) -> List[int]:
+        """Approximate the minimum Steiner tree with Mehlhorn's algorithm, see `mehlhorn_steiner_tree`.
+
+        Args:
+            graph (CompactGraph): the graph
+            terminal_nodes (Collection[int]): node ids that should be connected
+            weight (str, optional): weight name
+
+        Raises:
+            NoSuitableGraphError: the terminals are not in the same connected component
+
+        Returns:
+            List[int]: edge indices of the tree
+        """
+        return mehlhorn_steiner_tree(graph, terminal_nodes, weight)
+
+
+class SciPyRoutingBackend(RoutingBackend):
+    """The shortest path searches in compiled code, with `scipy.sparse.csgraph`.
+
+    The graphs are converted with `_symmetric_matrix`. The metric closures are calculated with one
+    Dijkstra per row block, and the Steiner trees with a single multi-source Dijkstra over the whole
+    graph, whose bridges are then sorted and joined at once. Negative weights are left to the
+    networkx backend, csgraph rejects them.
+
+    Attributes:
+        CLOSURE_BLOCK_CELLS (int): size of the distance matrix blocks calculated at once for the metric closures
+    """
+
+    name = 'scipy'
+    CLOSURE_BLOCK_CELLS = CLOSURE_BLOCK_CELLS
+
+    def __init__(self) -> None:
+        self._matrix_key = None
+        self._matrix = None
+        self._matrix_edges = None
+
+    def component_labels(self, node_count: int, edge_nodes: np.ndarray) -> np.ndarray:
+        if not len(edge_nodes):
+            return np.arange(node_count, dtype=np.int64)
+
+        matrix = csr_matrix((np.ones(len(edge_nodes), dtype=np.int8), (edge_nodes[:, 0], edge_nodes[:, 1])), shape=(node_count, node_count))
+        (count, labels) = csgraph.connected_components(matrix, directed=False)
+        smallest = np.full(count, node_count, dtype=np.int64)
+        np.minimum.at(smallest, labels, np.arange(node_count, dtype=np.int64))
+
+        return smallest[labels]
+
+    def metric_closure(self, component: ComponentArrays, G: nx.MultiGraph = None) -> MetricClosure:
+        return scipy_metric_closure(component, G, self.CLOSURE_BLOCK_CELLS)
+
+    def _graph_matrix(self, graph: CompactGraph, weight: str = None) -> Tuple['csr_matrix', np.ndarray]:
+        """Get the matrix of the whole graph, the last one is cached until the graph or the weight changes."""
+        key = (id(graph), graph.revision, weight)
+
+        if self._matrix_key != key:
+            edges = np.flatnonzero(graph.edge_alive)
+            (self._matrix, self._matrix_edges) = _symmetric_matrix(len(graph.points), graph.edge_nodes[edges], edges, graph.weights(weight)[edges])
+            self._matrix_key = key
+
+        return self._matrix, self._matrix_edges
+
+    def steiner_tree(self, graph: CompactGraph, terminal_nodes: Collection[int], weight: str = None) -> List[int]:
+        terminals = list(dict.fromkeys(terminal_nodes))
+
+        if len(terminals) < 2:
+            return []
+
+        weights = graph.weights(weight)
+
+        if np.any(weights[graph.edge_alive] < 0):
+            return super().steiner_tree(graph, terminal_nodes, weight)
+
+        (matrix, matrix_edges) = self._graph_matrix(graph, weight)
+        (dist, pred, base) = csgraph.dijkstra(matrix, indices=terminals, min_only=True, return_predecessors=True)
+
+        # the bridges between the Voronoi regions, with the same cost and order as in `mehlhorn_steiner_tree`
+        edges = np.flatnonzero(graph.edge_alive)
+        (u, v) = graph.edge_nodes[edges].T
+        bridge = (base[u] != base[v]) & (base[u] >= 0) & (base[v] >= 0)
+        (edges, u, v) = (edges[bridge], u[bridge], v[bridge])
+        early = np.where(dist[u] <= dist[v], u, v)
+        late = np.where(dist[u] <= dist[v], v, u)
+        costs = (dist[early] + weights[edges]) + dist[late]
+
+        terminals_set = _DisjointSet(terminals)
+        remaining = len(terminals) - 1
+        chosen_bridges = []
+
+        for idx in np.lexsort((edges, costs)).tolist():
+            if terminals_set.union(int(base[u[idx]]), int(base[v[idx]])):
+                chosen_bridges.append(idx)
+                remaining -= 1
+
+                if not remaining:
+                    break
+
+        if remaining:
+            raise NoSuitableGraphError()
+
+        tree_edges = set()
+
+        for idx in chosen_bridges:
+            tree_edges.add(int(edges[idx]))
+
+            for node in (int(u[idx]), int(v[idx])):
+                while pred[node] >= 0:
+                    pred_node = int(pred[node])
+                    (start, end) = (matrix.indptr[pred_node], matrix.indptr[pred_node + 1])
+                    pred_edge = int(matrix_edges[start + np.searchsorted(matrix.indices[start:end], node)])
+
+                    if pred_edge in tree_edges:
+                        break
+
+                    tree_edges.add(pred_edge)
+                    node = pred_node
+
+        return sorted(tree_edges)
+
+
+ROUTING_BACKENDS = {RoutingBackend.name: RoutingBackend, SciPyRoutingBackend.name: SciPyRoutingBackend}
+_routing_backend = None
+
+
+def routing_backend() -> RoutingBackend:
+    """Get the routing backend, the SciPy one if SciPy is installed, otherwise the networkx one."""
+    global _routing_backend
+
+    if _routing_backend is None:
+        _routing_backend = SciPyRoutingBackend() if csgraph is not None else RoutingBackend()
+
+    return _routing_backend
+
+
+def set_routing_backend(name: str = None) -> RoutingBackend:
+    """Select the routing backend, e.g. to compare the backends.
+
+    Args:
+        name (str, optional): one of `ROUTING_BACKENDS`, the default backend of `routing_backend` if None
+
+    Raises:
+        BoundaryDelineationError: unknown backend, or SciPy is not installed
+
+    Returns:
+        RoutingBackend: the selected backend
+    """
+    global _routing_backend
+
+    if name is None:
+        _routing_backend = None
+        return routing_backend()
+
+    if name not in ROUTING_BACKENDS:
+        raise BoundaryDelineationError('Unknown routing backend: %s' % name)
+
+    if name == SciPyRoutingBackend.name and csgraph is None:
+        raise BoundaryDelineationError('SciPy is not installed')
+
+    _routing_backend = ROUTING_BACKENDS[name]()
+
+    return _routing_backend
+
+
+def exact_steiner_node_limit(terminal_count: int) -> int:
+    """Get the largest terminal-local graph for which the exact Steiner tree is searched.
+
+    The exact search runs one Dijkstra per subset of the terminals, so the limit halves with every
+    additional terminal (see `EXACT_STEINER_MAX_WORK`).
+
+    Args:
+        terminal_count (int): number of terminals
+
+    Returns:
+        int: the node limit, 0 if the exact tree is not searched for this many terminals
+    """
+    if not EXACT_STEINER_MIN_TERMINALS <= terminal_count <= EXACT_STEINER_MAX_TERMINALS:
+        return 0
+
+    return EXACT_STEINER_MAX_WORK // 2 ** (terminal_count - 1)
+
+
+def steiner_local_nodes(graph: CompactGraph, terminals: List[int], weight: str = None, upper_bound: float = math.inf,
+                        max_nodes: int = None, deadline: float = None) -> Optional[List[int]]:
+    """Find the nodes that can be part of a Steiner tree not heavier than `upper_bound`.
+
+    Every node of such a tree is within `upper_bound` of every terminal, so the nodes are the
+    intersection of the balls of that radius around the terminals.
+
+    Args:
+        graph (CompactGraph): the graph
+        terminals (List[int]): the terminal nodes
+        weight (str, optional): weight name
+        upper_bound (float, optional): weight of a known tree, e.g. an approximate one
+        max_nodes (int, optional): give up if a ball has more nodes
+        deadline (float, optional): give up after this `time.perf_counter()` value
+
+    Returns:
+        Optional[List[int]]: the sorted node ids, None if given up
+    """
+    weights = graph.weights(weight)
+    # the sums of the weights along the paths are not exact, the radius is a bit bigger
+    radius = upper_bound * (1 + 1e-9) + 1e-12
+    nodes = None
+
+    for terminal in terminals:
+        dist: Dict[int, float] = {}
+        fringe = [(0.0, terminal)]
+
+        while fringe:
+            (d, v) = heappop(fringe)
+
+            if v in dist:
+                continue
+
+            dist[v] = d
+
+            if max_nodes is not None and len(dist) > max_nodes:
+                return None
+
+            for u, edge in zip(*graph.half_edges(v)):
+                vu_dist = d + float(weights[edge])
+
+                if u not in dist and vu_dist <= radius:
+                    heappush(fringe, (vu_dist, u))
+
+        nodes = set(dist) if nodes is None else nodes.intersection(dist)
+
+        if deadline is not None and time.perf_counter() > deadline:
+            return None
+
+    return sorted(nodes)
+
+
+def dreyfus_wagner_steiner_tree(graph: CompactGraph, terminal_nodes: Collection[int], nodes: Collection[int], weight: str = None,
+                                deadline: float = None) -> Optional[List[int]]:
+    """Find the minimum Steiner tree in the subgraph induced by `nodes`, with the Dreyfus-Wagner dynamic programming.
+
+    `cost[S][v]` is the weight of the lightest tree connecting the terminal subset S and the node v.
+    It is the cheapest merge of two trees of complementary subsets at v, relaxed along the shortest
+    paths with a Dijkstra seeded by the merged costs. The last terminal is the root, the tree is
+    `cost[all the other terminals][root]`. The time is O(3^t n + 2^t (m + n) log n) for t terminals,
+    affordable only for a few terminals and a terminal-local subgraph (see `steiner_local_nodes`).
+
+    Args:
+        graph (CompactGraph): the graph
+        terminal_nodes (Collection[int]): node ids that should be connected, all in `nodes`
+        nodes (Collection[int]): the node ids of the subgraph
+        weight (str, optional): weight name
+        deadline (float, optional): give up after this `time.perf_counter()` value
+
+    Raises:
+        NoSuitableGraphError: the terminals are not connected in the subgraph
+
+    Returns:
+        Optional[List[int]]: edge indices of the tree, None if given up
+    """
+    terminals = list(dict.fromkeys(terminal_nodes))
+
+    if len(terminals) < 2:
+        return []
+
+    weights = graph.weights(weight)
+    nodes = list(nodes)
+    index = {node: idx for idx, node in enumerate(nodes)}
+    adjacency = []
+
+    for node in nodes:
+        adjacency.append([(index[u], edge, float(weights[edge])) for u, edge in zip(*graph.half_edges(node)) if u in index])
+
+    subsets = 2 ** (len(terminals) - 1)
+    root = index[terminals[-1]]
+    cost = np.full((subsets, len(nodes)), np.inf)
+    split = np.zeros((subsets, len(nodes)), dtype=np.int64)
+    pred_edge = np.full((subsets, len(nodes)), -1, dtype=np.int64)
+    pred_node = np.full((subsets, len(nodes)), -1, dtype=np.int64)
+
+    def relax(subset: int) -> None:
+        dist = cost[subset].tolist()
+        subset_pred_edge = pred_edge[subset]
+        subset_pred_node = pred_node[subset]
+        done = set()
+        fringe = [(d, v) for v, d in enumerate(dist) if d < math.inf]
+        heapify(fringe)
+
+        while fringe:
+            (d, v) = heappop(fringe)
+
+            if v in done:
+                continue
+
+            done.add(v)
+
+            for u, edge, edge_cost in adjacency[v]:
+                vu_dist = d + edge_cost
+
+                if vu_dist < dist[u]:
+                    dist[u] = vu_dist
+                    subset_pred_edge[u] = edge
+                    subset_pred_node[u] = v
+                    heappush(fringe, (vu_dist, u))
+
+        cost[subset] = dist
+
+    for subset in range(1, subsets):
+        low = subset & -subset
+
+        if subset == low:
+            cost[subset, index[terminals[low.bit_length() - 1]]] = 0.0
+        else:
+            # the part with the lowest terminal, so each split is tried once
+            part = (subset - 1) & subset
+
+            while part:
+                if part & low:
+                    merged = cost[part] + cost[subset ^ part]
+                    better = merged < cost[subset]
+                    cost[subset, better] = merged[better]
+                    split[subset, better] = part
+
+                part = (part - 1) & subset
+
+        relax(subset)
+
+        if deadline is not None and time.perf_counter() > deadline:
+            return None
+
+    full = subsets - 1
+
+    if cost[full, root] == math.inf:
+        raise NoSuitableGraphError()
+
+    tree_edges = set()
+    stack = [(full, root)]
+
+    while stack:
+        (subset, v) = stack.pop()
+
+        if pred_edge[subset, v] >= 0:
+            tree_edges.add(int(pred_edge[subset, v]))
+            stack.append((subset, int(pred_node[subset, v])))
+        elif split[subset, v]:
+            part = int(split[subset, v])
+            stack.append((part, v))
+            stack.append((subset ^ part, v))
+
+    # the subtrees can share edges on ties, the union is reduced back to a tree
+    return _prune_steiner_edges(graph, tree_edges, weights, set(terminals))
+
+
+class SteinerQueryLog:
+    """Timings of the Steiner tree queries, to tune the selection between the exact and the approximate trees.
+
+    Attributes:
+        FIELDS (Tuple[str]): the fields of a record
+        records (Deque[tuple]): the latest records, in the order of `FIELDS`
+        path (str): CSV file the records are appended to, not written if None
+    """
+
+    FIELDS = ('terminals', 'local_nodes', 'method', 'seconds', 'weight')
+
+    def __init__(self, max_records: int = 1000, path: str = None) -> None:
+        self.records = deque(maxlen=max_records)
+        self.path = path
+
+    def add(self, terminals: int, local_nodes: int, method: str, seconds: float, weight: float) -> None:
+        """Record a query.
+
+        Args:
+            terminals (int): number of terminals
+            local_nodes (int): size of the terminal-local subgraph of the exact search, 0 if there was none
+            method (str): the method that found the tree, e.g. 'exact' or 'closure'
+            seconds (float): the query time, including the failed exact search
+            weight (float): the weight of the tree
+        """
+        record = (terminals, local_nodes, method, seconds, weight)
+        self.records.append(record)
+
+        if self.path:
+            is_new = not os.path.exists(self.path)
+
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.writer(f)
+
+                if is_new:
+                    writer.writerow(self.FIELDS)
+
+                writer.writerow(record)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Get the number of queries and the median and 95th percentile times of each method."""
+        times: Dict[str, List[float]] = {}
+
+        for record in self.records:
+            times.setdefault(record[2], []).append(record[3])
+
+        return {
+            method: {'count': len(values), 'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95))}
+            for method, values in times.items()
+        }
+
+
+def _approximate_steiner_tree(graph: CompactGraph, terminals: List[int], weight: str = None, path_trees: ShortestPathTreeCache = None,
+                              hierarchy: ContractionHierarchy = None) -> Tuple[str, List[int]]:
+    """Approximate the Steiner tree without the metric closure, see `find_steiner_tree`."""
+    if hierarchy is not None:
+        return 'hierarchy', hierarchy_steiner_tree(graph, terminals, hierarchy)
+
+    if path_trees is not None:
+        return 'kou', kou_steiner_tree(graph, terminals, weight, path_trees)
+
+    return 'mehlhorn', routing_backend().steiner_tree(graph, terminals, weight)
+
+
+def _closure_steiner_tree(components: ComponentIndex, label: int, terminals: List[int], weight: str,
+                          metric_closure: MetricClosure) -> Tuple[List[EdgeKey], float]:
+    """Take the tree from the metric closure of the component, see `find_steiner_tree`.
+
+    Returns:
+        Tuple[List[EdgeKey], float]: the edge keys of the tree and its weight
+    """
+    # the weight is the upper bound of the exact search, the edges must have it
+    T = steiner_tree(components.subgraph(label, weight), terminals, metric_closure=metric_closure)
+    # edge[2] stays for the edge keys
+    keys = [edge[2] for edge in T.edges(keys=True)]
+
+    return (keys, float(sum(data.get(weight or DEFAULT_WEIGHT_NAME, DEFAULT_WEIGHT_VALUE) for _u, _v, data in T.edges(data=True))))
+
+
+def find_steiner_tree(graph: CompactGraph, terminal_nodes: Collection[int], weight: str = None,
+                      components: ComponentIndex = None, metric_closures: Mapping[int, MetricClosure] = None,
+                      path_trees: ShortestPathTreeCache = None, hierarchies: Mapping[int, ContractionHierarchy] = None,
+                      query_log: SteinerQueryLog = None) -> List[EdgeKey]:
+    """Find the lines that connect the terminal nodes with (approximately) minimal total weight.
+
+    Terminals in different connected components are detected from the component labels, without any
+    search. Two terminals are simply connected with the shortest path between them, from the contraction
+    hierarchy of the component if there is one, or with `astar_path`.
+
+    For more terminals, a tree is taken from the metric closure of the component if it is already calculated.
+    Otherwise an approximate tree is built from the contraction hierarchy (see `hierarchy_steiner_tree`), from
+    the cached shortest path trees of the terminals if a cache is given (see `kou_steiner_tree`), or found with
+    a terminal-local search (see `mehlhorn_steiner_tree`, run by the `routing_backend`). For a few terminals,
+    the exact tree is searched with `dreyfus_wagner_steiner_tree` in the nodes around the terminals that can be
+    part of a tree lighter than that one, if there are not too many of them (see `exact_steiner_node_limit`)
+    and within `EXACT_STEINER_TIME_BUDGET`, the closure or the approximate tree is used if it is not found.
+
+    Args:
+        graph (CompactGraph): the graph
+        terminal_nodes (Collection[int]): node ids that should be connected
+        weight (str, optional): weight name
+        components (ComponentIndex, optional): connected components, as returned by `prepare_components`
+        metric_closures (Mapping[int, MetricClosure], optional): metric closures of the components, keyed by component label, e.g. a `RoutingCacheView`
+        path_trees (ShortestPathTreeCache, optional): cache of shortest path trees
+        hierarchies (Mapping[int, ContractionHierarchy], optional): contraction hierarchies of the components, keyed by component label
+        query_log (SteinerQueryLog, optional): the time of the query is recorded in it
+
+    Raises:
+        NoSuitableGraphError: the terminals are not in the same connected component
+
+    Returns:
+        List[EdgeKey]: keys of the lines in the tree
+    """
+    started = time.perf_counter()
+
+    if components is None:
+        components = ComponentIndex(graph)
+
+    label = components.component_of(terminal_nodes)
+
+    if label is None:
+        raise NoSuitableGraphError()
+
+    terminals = list(dict.fromkeys(terminal_nodes))
+    hierarchy = hierarchies.get(label) if hierarchies is not None else None
+    weights = graph.weights(weight)
+    local_nodes = 0
+
+    def found(method: str, edges: List[int]) -> List[EdgeKey]:
+        if query_log is not None:
+            query_log.add(len(terminals), local_nodes, method, time.perf_counter() - started, float(weights[edges].sum()))
+
+        return graph.line_keys(graph.edge_keys(edges))
+
+    if len(terminals) == 2:
+        if hierarchy is not None:
+            return found('hierarchy', hierarchy_steiner_tree(graph, terminals, hierarchy))
+
+        return found('astar', sorted(astar_path(graph, terminals[0], terminals[1], weight)))
+
+    terminal_metric_closure = metric_closures.get(label) if metric_closures is not None else None
+    node_limit = exact_steiner_node_limit(len(terminals))
+    closure_tree = None
+    approximate = None
+
+    # the tree of a cached closure bounds the exact search and replaces it when it fails,
+    # the approximate tree is searched only without the closure
+    if terminal_metric_closure is not None:
+        closure_tree = _closure_steiner_tree(components, label, terminals, weight, terminal_metric_closure)
+    elif node_limit:
+        approximate = _approximate_steiner_tree(graph, terminals, weight, path_trees, hierarchy)
+
+    if node_limit:
+        upper_bound = closure_tree[1] if closure_tree is not None else float(weights[approximate[1]].sum())
+        deadline = started + EXACT_STEINER_TIME_BUDGET
+        nodes = steiner_local_nodes(graph, terminals, weight, upper_bound, node_limit, deadline)
+
+        if nodes is not None:
+            local_nodes = len(nodes)
+            edges = dreyfus_wagner_steiner_tree(graph, terminals, nodes, weight, deadline)
+
+            if edges is not None:
+                return found('exact', edges)
+
+    if closure_tree is None:
+        return found(*(approximate or _approximate_steiner_tree(graph, terminals, weight, path_trees, hierarchy)))
+
+    (keys, tree_weight) = closure_tree
+
+    if query_log is not None:
+        query_log.add(len(terminals), local_nodes, 'closure', time.perf_counter() - started, tree_weight)
+
+    return graph.line_keys(keys)
+
+
+def calculate_components_metric_closures(components: ComponentIndex, weight: str = None, labels: Iterable[int] = None,
+                                         feedback: QgsFeedback = None) -> Dict[int, MetricClosure]:
+    """Calculate the metric closures of the components.
+
+    Args:
+        components (ComponentIndex): the components
+        weight (str, optional): weight name
+        labels (Iterable[int], optional): the components to be calculated, all the components with more than one node if None
+        feedback (QgsFeedback, optional): progress reporting, when canceled the closures calculated so far are returned
+
+    Returns:
+        Dict[int, MetricClosure]: the metric closures, keyed by component label
+    """
+    if labels is None:
+        labels = components.labels(min_size=2)
+
+    labels = list(labels)
+    # the closure of a component costs about nodes^2, the progress is weighted the same way
+    costs = np.array([len(components.nodes(label)) for label in labels], dtype=np.float64) ** 2
+    total = costs.sum() or 1
+    done = 0.0
+    closures = {}
+
+    for label, cost in zip(labels, costs.tolist()):
+        if feedback and feedback.isCanceled():
+            break
+
+        closures[label] = routing_backend().metric_closure(ComponentArrays.from_component(components, label, weight), components.subgraph(label, weight))
+        done += cost
+
+        if feedback:
+            feedback.setProgress(100 * done / total)
+
+    return closures
+
+
+def calculate_components_hierarchies(components: ComponentIndex, weight: str = None, labels: Iterable[int] = None,
+                                     feedback: QgsFeedback = None) -> Dict[int, ContractionHierarchy]:
+    """Build the contraction hierarchies of the components.
+
+    Args:
+        components (ComponentIndex): the components
+        weight (str, optional): weight name
+        labels (Iterable[int], optional): the components to be built, all the components with more than one node if None
+        feedback (QgsFeedback, optional): progress reporting, when canceled the hierarchies built so far are returned
+
+    Returns:
+        Dict[int, ContractionHierarchy]: the hierarchies, keyed by component label
+    """
+    if labels is None:
+        labels = components.labels(min_size=2)
+
+    labels = list(labels)
+    costs = np.array([len(components.nodes(label)) for label in labels], dtype=np.float64)
+    total = costs.sum() or 1
+    done = 0.0
+    hierarchies = {}
+
+    for label, cost in zip(labels, costs.tolist()):
+        if feedback and feedback.isCanceled():
+            break
+
+        hierarchy = ContractionHierarchy.build(ComponentArrays.from_component(components, label, weight), feedback)
+
+        if hierarchy is None:
+            break
+
+        hierarchies[label] = hierarchy
+        done += cost
+
+        if feedback:
+            feedback.setProgress(100 * done / total)
+
+    return hierarchies
+
+
+def _process_pool_context() -> Optional[multiprocessing.context.BaseContext]:
+    """Get the multiprocessing context for the worker processes, None if there is no python interpreter to start them with.
+
+    The workers run `BoundaryComponents.preprocess_components`, that module needs only numpy and networkx,
+    so the workers do not load the QGIS bindings. Only the interpreter of the running installation is used,
+    one found on the PATH might not have the plugin dependencies.
+    """
+    # the workers are started fresh, forking the whole QGIS application is not safe
+    context = multiprocessing.get_context('spawn')
+
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return context
+
+    # inside QGIS the executable is the application itself, the workers need the bundled interpreter
+    candidates = [os.path.join(sys.exec_prefix, 'python.exe'), os.path.join(sys.exec_prefix, 'bin', 'python3')]
+
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            context.set_executable(candidate)
+            return context
+
+    return None
+
+
+def calculate_components_routing(components: ComponentIndex, weight: str = None, labels: Iterable[int] = (), hierarchy_labels: Iterable[int] = (),
+                                 feedback: QgsFeedback = None, processes: int = None) -> Tuple[Dict[int, MetricClosure], Dict[int, ContractionHierarchy]]:
+    """Calculate the metric closures and build the contraction hierarchies of the components, spread over worker processes.
+
+    The components are independent, each worker gets them as `ComponentArrays` and sends back the results,
+    the calling thread only waits for them. Graphs smaller than `PROCESS_POOL_MIN_NODES` are processed in the
+    calling thread (see `calculate_components_hierarchies` and `calculate_components_metric_closures`).
+
+    The feedback is checked every `PROCESS_POLL_SECONDS`. On cancel the pending batches are dropped and the
+    function returns at once, the batches already running in the workers can not be interrupted, they finish
+    in the background and their results are discarded.
+
+    Args:
+        components (ComponentIndex): the components
+        weight (str, optional): weight name
+        labels (Iterable[int], optional): the components whose closures should be calculated
+        hierarchy_labels (Iterable[int], optional): the components whose hierarchies should be built
+        feedback (QgsFeedback, optional): progress reporting, when canceled the results received so far are returned
+        processes (int, optional): number of worker processes, the number of CPUs if None
+
+    Returns:
+        Tuple[Dict[int, MetricClosure], Dict[int, ContractionHierarchy]]: the closures and the hierarchies, keyed by component label
+    """
+    labels = set(labels)
+    hierarchy_labels = set(hierarchy_labels)
+    # the biggest components first, so the workers are not left waiting on them at the end
+    job_labels = sorted(labels | hierarchy_labels, key=lambda label: -len(components.nodes(label)))
+    nodes_count = sum(len(components.nodes(label)) for label in job_labels)
+    processes = min(processes or os.cpu_count() or 1, len(job_labels))
+    context = _process_pool_context() if processes > 1 and nodes_count >= PROCESS_POOL_MIN_NODES else None
+
+    if context is None:
+        # the hierarchies first, they are quick to build and already make the searches fast
+        steps = [[label for label in job_labels if label in hierarchy_labels], [label for label in job_labels if label in labels]]
+        feedback = QgsProcessingMultiStepFeedback(len([step for step in steps if step]), feedback) if feedback else None
+        hierarchies = calculate_components_hierarchies(components, weight, steps[0], feedback) if steps[0] else {}
+
+        if feedback and steps[0]:
+            feedback.setCurrentStep(1)
+
+        if not steps[1] or (feedback and feedback.isCanceled()):
+            return ({}, hierarchies)
+
+        return (calculate_components_metric_closures(components, weight, steps[1], feedback), hierarchies)
+
+    batches: List[List[Tuple[ComponentArrays, bool, bool]]] = [[]]
+    costs = [0.0]
+
+    for label in job_labels:
+        if costs[-1] >= PROCESS_BATCH_NODES:
+            batches.append([])
+            costs.append(0.0)
+
+        component = ComponentArrays.from_component(components, label, weight)
+        batches[-1].append((component, label in labels, label in hierarchy_labels))
+        # the closure of a component costs about nodes^2, the hierarchy about nodes
+        costs[-1] += len(component) * (len(component) if label in labels else 1)
+
+    total = sum(costs) or 1
+    done = 0.0
+    closures: Dict[int, MetricClosure] = {}
+    hierarchies: Dict[int, ContractionHierarchy] = {}
+
+    executor = ProcessPoolExecutor(processes, mp_context=context)
+    canceled = False
+
+    # the workers can not tell the routing backends apart, only if they should use scipy
+    use_scipy = isinstance(routing_backend(), SciPyRoutingBackend)
+
+    try:
+        futures = {executor.submit(preprocess_components, batch, use_scipy): cost for batch, cost in zip(batches, costs)}
+        pending = set(futures)
+
+        while pending:
+            if feedback and feedback.isCanceled():
+                canceled = True
+
+                for future in pending:
+                    future.cancel()
+
+                break
+
+            (completed, pending) = wait(pending, timeout=PROCESS_POLL_SECONDS, return_when=FIRST_COMPLETED)
+
+            for future in completed:
+                for (label, closure, hierarchy) in future.result():
+                    if closure is not None:
+                        closures[label] = closure
+
+                    if hierarchy is not None:
+                        hierarchies[label] = hierarchy
+
+                done += futures[future]
+
+            if feedback and completed:
+                feedback.setProgress(100 * done / total)
+    finally:
+        # the running batches can not be interrupted, a canceled task does not wait for them
+        executor.shutdown(wait=not canceled)
+
+    return (closures, hierarchies)
+
+
+RoutingStructure = Union[MetricClosure, ContractionHierarchy]
+
+
+class RoutingCacheView(Mapping[int, RoutingStructure]):
+    """The routing structures of one kind and weight in a `RoutingCache`, keyed by component label.
+
+    Reading a structure marks it as recently used and counts as a hit or a miss of the cache.
+    """
+
+    def __init__(self, cache: 'RoutingCache', key: Tuple[str, str]) -> None:
+        self._cache = cache
+        self._key = key
+
+    def __getitem__(self, label: int) -> RoutingStructure:
+        value = self._cache._index.get(self._key, {}).get(label)
+
+        if value is None:
+            self._cache.misses += 1
+            raise KeyError(label)
+
+        self._cache.hits += 1
+        self._cache._entries.move_to_end(self._key + (label,))
+
+        return value
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(list(self._cache._index.get(self._key, {})))
+
+    def __len__(self) -> int:
+        return len(self._cache._index.get(self._key, {}))
+
+
+class RoutingCache:
+    """LRU cache of the precalculated routing structures of the components, with a memory budget.
+
+    The entries are keyed by graph revision, weight name (a field or an expression), kind (`CLOSURE` or
+    `HIERARCHY`) and component label. A cache holds the structures of a single graph revision: reading
+    another revision drops all the entries, and `apply_change` keeps only the entries of the components
+    that a graph update did not touch. The least recently used entries are evicted when the estimated
+    size goes over the budget.
+
+    Attributes:
+        CLOSURE (str): kind of the metric closures
+        HIERARCHY (str): kind of the contraction hierarchies
+        NX_NODE_BYTES (int): approximate bytes per node of the networkx graph kept by a metric closure
+        NX_EDGE_BYTES (int): approximate bytes per edge of the networkx graph kept by a metric closure
+        max_bytes (int): memory budget in bytes
+        revision (Optional[int]): the graph revision of the entries
+        hits (int): number of structures found in the cache
+        misses (int): number of structures that were not in the cache
+        evictions (int): number of entries evicted to stay within the budget
+    """
+
+    CLOSURE = 'closure'
+    HIERARCHY = 'hierarchy'
+    NX_NODE_BYTES = 300
+    NX_EDGE_BYTES = 500
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.revision: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[Tuple[str, str, int], int]' = OrderedDict()
+        self._index: Dict[Tuple[str, str], Dict[int, RoutingStructure]] = {}
+        self._nbytes = 0
+
+    @classmethod
+    def estimate_bytes(cls, value: RoutingStructure) -> int:
+        """Estimate the memory used by a metric closure or a contraction hierarchy."""
+        if isinstance(value, MetricClosure):
+            return value.nbytes + value.G.number_of_nodes() * cls.NX_NODE_BYTES + value.G.number_of_edges() * cls.NX_EDGE_BYTES
+
+        return value.nbytes()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._index.clear()
+        self._nbytes = 0
+        self.revision = None
+
+    def view(self, revision: int, weight: str, kind: str) -> RoutingCacheView:
+        """Get the structures of a weight and kind, an empty view if the cache has another graph revision.
+
+        Args:
+            revision (int): the graph revision
+            weight (str): weight name
+            kind (str): `CLOSURE` or `HIERARCHY`
+
+        Returns:
+            RoutingCacheView: the structures, keyed by component label
+        """
+        self._check_revision(revision)
+
+        return RoutingCacheView(self, (weight or DEFAULT_WEIGHT_NAME, kind))
+
+    def get(self, revision: int, weight: str, kind: str, label: int) -> Optional[RoutingStructure]:
+        """Get the structure of a component, None if it is not cached."""
+        return self.view(revision, weight, kind).get(label)
+
+    def missing(self, revision: int, weight: str, kind: str, labels: Iterable[int]) -> List[int]:
+        """Get the labels of the components whose structures are not cached."""
+        self._check_revision(revision)
+        cached = self._index.get((weight or DEFAULT_WEIGHT_NAME, kind), {})
+
+        return [label for label in labels if label not in cached]
+
+    def update(self, revision: int, weight: str, kind: str, values: Dict[int, RoutingStructure]) -> None:
+        """Add the structures of some components, evicting the least recently used ones if needed.
+
+        Args:
+            revision (int): the graph revision the structures were calculated for, other revisions are ignored
+            weight (str): weight name
+            kind (str): `CLOSURE` or `HIERARCHY`
+            values (Dict[int, RoutingStructure]): the structures, keyed by component label
+        """
+        if self.revision is None:
+            self.revision = revision
+
+        if revision != self.revision:
+            return
+
+        index_key = (weight or DEFAULT_WEIGHT_NAME, kind)
+        index = self._index.setdefault(index_key, {})
+
+        for label, value in values.items():
+            key = index_key + (label,)
+
+            if key in self._entries:
+                self._remove(key)
+
+            size = self.estimate_bytes(value)
+            index[label] = value
+            self._entries[key] = size
+            self._nbytes += size
+
+        self._evict()
+
+    def invalidate(self, weight: str = None, kind: str = None) -> None:
+        """Drop the structures of a weight and kind, or all the weights or kinds if None."""
+        for key in list(self._entries.keys()):
+            if (weight is None or key[0] == weight) and (kind is None or key[1] == kind):
+                self._remove(key)
+
+    def apply_change(self, change: GraphChange, changed_labels: Iterable[int]) -> None:
+        """Move the entries to the new graph revision, dropping the components changed by the update.
+
+        Args:
+            change (GraphChange): the change of the graph
+            changed_labels (Iterable[int]): the components changed by the update, see `ComponentIndex.apply_change`
+        """
+        if change.old_revision != self.revision:
+            self.clear()
+            self.revision = change.revision
+            return
+
+        changed_labels = set(changed_labels)
+
+        for key in list(self._entries.keys()):
+            if key[2] in changed_labels:
+                self._remove(key)
+
+        self.revision = change.revision
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self._entries),
+            'weights': len({key[0] for key in self._index if self._index[key]}),
+            'bytes': self._nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _check_revision(self, revision: int) -> None:
+        if revision != self.revision:
+            self.clear()
+            self.revision = revision
+
+    def _evict(self) -> None:
+        for key in list(self._entries.keys()):
+            if self._nbytes <= self.max_bytes:
+                break
+
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key: Tuple[str, str, int]) -> None:
+        self._nbytes -= self._entries.pop(key)
+        del self._index[key[:2]][key[2]]
+
+
+class MetricClosuresTask(QgsTask):
+    """Calculate the contraction hierarchies and the metric closures of the components in a background thread.
+
+    The work is spread over worker processes (see `calculate_components_routing`), the task thread only waits for the results.
+    The subgraphs are built in a separate `ComponentIndex`, so nothing shared with the main thread is modified.
+    The graph should not be changed while the task is running, cancel it before changing the graph and check
+    `revision` before using the results (see `ComponentIndex.merge`).
+
+    Attributes:
+        components (ComponentIndex): the components of the task, with the subgraphs built by the task
+        weight (str): weight name
+        labels (List[int]): the components whose closures should be calculated
+        hierarchy_labels (List[int]): the components whose hierarchies should be built
+        revision (int): the graph revision when the task was created
+        metric_closures (Dict[int, MetricClosure]): the calculated closures, keyed by component label
+        hierarchies (Dict[int, ContractionHierarchy]): the built hierarchies, keyed by component label
+        processes (Optional[int]): number of worker processes, the number of CPUs if None
+        error (Optional[Exception]): the error that stopped the task, if any
+    """
+
+    def __init__(self, graph: CompactGraph, weight: str = None, labels: Iterable[int] = None, hierarchy_labels: Iterable[int] = (),
+                 processes: int = None) -> None:
+        super().__init__('Precalculating the vertices mode paths', QgsTask.CanCancel)
+
+        self.components = ComponentIndex(graph)
+        self.weight = weight
+        self.labels = list(labels) if labels is not None else self.components.labels(min_size=2)
+        self.hierarchy_labels = list(hierarchy_labels) if hierarchy_labels is not None else self.components.labels(min_size=2)
+        self.revision = graph.revision
+        self.metric_closures: Dict[int, MetricClosure] = {}
+        self.hierarchies: Dict[int, ContractionHierarchy] = {}
+        self.processes = processes
+        self.error: Optional[Exception] = None
+        self.feedback = QgsProcessingFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+
+    def run(self) -> bool:
+        try:
+            (self.metric_closures, self.hierarchies) = calculate_components_routing(
+                self.components, self.weight, self.labels, self.hierarchy_labels, self.feedback, self.processes)
+        except Exception as err:
+            self.error = err
+            return False
+
+        return not self.isCanceled()
+
+    def cancel(self) -> None:
+        self.feedback.cancel()
+        super().cancel()
+
+
+class AlternativePathsTask(QgsTask):
+    """Find the alternative paths between two vertices in a background thread, see `yen_k_shortest_paths`.
+
+    The task grows copies of the cached shortest path trees of the two vertices, so the cache of the main
+    thread is not modified, merge `path_trees` back into it when the task finishes. Like `MetricClosuresTask`,
+    it should be canceled before the graph is changed, and `revision` checked before using the results.
+
+    Attributes:
+        graph (CompactGraph): the graph
+        source (int): source node id
+        target (int): target node id
+        k (int): the number of paths
+        weight (str): weight name
+        revision (int): the graph revision when the task was created
+        path_trees (ShortestPathTreeCache): the copied shortest path trees, grown by the task
+        paths (List[List[EdgeKey]]): the keys of the lines of each path, the cheapest first
+        error (Optional[Exception]): the error that stopped the task, if any
+    """
+
+    def __init__(self, graph: CompactGraph, source: int, target: int, k: int, weight: str = None, path_trees: ShortestPathTreeCache = None) -> None:
+        super().__init__('Searching the alternative paths', QgsTask.CanCancel)
 
-    T = steiner_tree(terminal_graph, terminal_nodes, metric_closure=terminal_metric_closure)
+        self.graph = graph
+        self.source = source
+        self.target = target
+        self.k = k
+        self.weight = weight
+        self.revision = graph.revision
+        self.path_trees = path_trees.copy(graph, weight, (source, target)) if path_trees is not None else ShortestPathTreeCache()
+        self.paths: List[List[EdgeKey]] = []
+        self.error: Optional[Exception] = None
+        self.feedback = QgsFeedback()
 
-    return T
+        # the weights are prepared in the main thread
+        graph.weights(weight)
 
+    def run(self) -> bool:
+        try:
+            paths = yen_k_shortest_paths(self.graph, self.source, self.target, self.k, self.weight, self.path_trees, self.feedback)
+        except Exception as err:
+            self.error = err
+            return False
 
-def calculate_subgraphs_metric_closures(graphs: Collection, weight: str = None) -> typing.List[nx.Graph]:
-    metric_closures = []
+        self.paths = [self.graph.line_keys(self.graph.edge_keys(sorted(edges))) for edges in paths]
 
-    for g in graphs:
-        metric_closures.append(metric_closure(g, weight=weight))
+        return not self.isCanceled()
 
-    return metric_closures
+    def cancel(self) -> None:
+        self.feedback.cancel()
+        super().cancel()
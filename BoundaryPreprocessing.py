@@ -0,0 +1,412 @@
+"""Fused preprocessing of the segments layer for the first step.
+
+The first step used to chain processing algorithms (simplify, extract the end vertices, delete their duplicates
+and polygonize), each of them reading the whole layer and writing a full memory layer, and then read the simplified
+layer once more to build the vertices graph. `stream_segments` reads the segments only once: every geometry is
+reprojected and simplified, written to the simplified layer in batches, its endpoints are read into arrays and it is
+kept for the polygonizer. The endpoints are interned into the graph nodes (see `intern_points`), which are written as
+the vertices layer. Only the layers that are displayed or queried later are materialized.
+
+The segments are processed in a metric working CRS (see `working_crs`). Layers in a CRS with other units are
+reprojected once with `reproject_segments`, the plugin keeps the copy for the next runs. The working CRS is picked
+in the main thread, the reprojection only reads a `SegmentsSource`.
+
+After the pass over the segments (`stream_segments`), the graph (`build_segments_graphs`) and the polygons
+(`polygonize_segments`) only read the `SimplifiedSegments`, so they can run in parallel. The vertices layer
+(`write_vertices_layer`) is written from the nodes of the graph.
+
+A `QgsVectorLayer` belongs to the main thread, the stages that run in background tasks never call it. The segments
+are read through a `SegmentsSource`, taken in the main thread, and the later stages use only the arrays, geometries
+and CRS kept in the `SimplifiedSegments`.
+
+Attributes:
+    PREPROCESS_BATCH_FEATURES (int): the simplified segments are written to their memory layer in batches of this many features
+    VERTEX_NODE_FIELD (str): the field of the vertices layer with the graph node id of the vertex
+    VERTEX_DEGREE_FIELD (str): the field of the vertices layer with the number of segment ends at the vertex
+    VERTEX_COMPONENT_FIELD (str): the field of the vertices layer with the connected component label of the vertex
+
+Notes:
+    begin                : 2020-06-01
+    git sha              : $Format:%H$
+
+    development          : 2019, Ivan Ivanov @ ITC, University of Twente
+    email                : ivan.ivanov@suricactus.com
+    copyright            : (C) 2019 by Ivan Ivanov
+
+License:
+MIT License
+
+Copyright (c) 2020 "its4land project", "ITC, University of Twente"
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from PyQt5.QtCore import QVariant
+from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsFeature, QgsFeatureRequest, QgsFeedback, QgsField, QgsFields, \
+    QgsGeometry, QgsMemoryProviderUtils, QgsPointXY, QgsProject, QgsUnitTypes, QgsVectorLayer, QgsVectorLayerFeatureSource, QgsWkbTypes
+
+try:
+    from .BoundaryGraph import CompactGraph, ComponentIndex, ContractedGraph, LineArrays, TiledGraph, DEFAULT_CACHE_BYTES, DEFAULT_NODE_GRID, \
+        intern_points, prepare_components, read_lines, routing_backend
+except ImportError:
+    # imported as a top-level module, by the tests
+    from BoundaryGraph import CompactGraph, ComponentIndex, ContractedGraph, LineArrays, TiledGraph, DEFAULT_CACHE_BYTES, DEFAULT_NODE_GRID, \
+        intern_points, prepare_components, read_lines, routing_backend
+
+PREPROCESS_BATCH_FEATURES = 10000
+VERTEX_NODE_FIELD = 'node_id'
+VERTEX_DEGREE_FIELD = 'degree'
+VERTEX_COMPONENT_FIELD = 'component'
+
+
+class SegmentsSource:
+    """The features and properties of a segments layer, taken in the main thread so a background task can read them.
+
+    Create it with `from_layer` in the main thread, the task then reads only the snapshot and never the layer.
+
+    Attributes:
+        source (QgsVectorLayerFeatureSource): the features of the layer
+        crs (QgsCoordinateReferenceSystem): the CRS of the layer
+        fields (QgsFields): the fields of the layer
+        wkb_type (QgsWkbTypes.Type): the geometry type of the layer
+        feature_count (int): the number of features, for the progress
+    """
+
+    def __init__(self, source: QgsVectorLayerFeatureSource, crs: QgsCoordinateReferenceSystem, fields: QgsFields, wkb_type: 'QgsWkbTypes.Type',
+                 feature_count: int) -> None:
+        self.source = source
+        self.crs = crs
+        self.fields = fields
+        self.wkb_type = wkb_type
+        self.feature_count = feature_count
+
+    @classmethod
+    def from_layer(cls, layer: QgsVectorLayer) -> 'SegmentsSource':
+        """Take the features and properties of the layer, must be called in the main thread."""
+        return cls(QgsVectorLayerFeatureSource(layer), layer.crs(), layer.fields(), layer.wkbType(), layer.featureCount())
+
+
+class SimplifiedSegments:
+    """The simplified segments, as written by `stream_segments`. The branches of the preprocessing only read them.
+
+    The layer is added to the project once the segments are simplified, the branches running in background tasks
+    read only the other attributes.
+
+    Attributes:
+        layer (QgsVectorLayer): the simplified segments layer
+        crs (QgsCoordinateReferenceSystem): the CRS of the simplified segments
+        lines (LineArrays): the endpoints, ids and numeric attributes of the simplified segments
+        geometries (List[QgsGeometry]): the simplified geometries that are not empty, for the polygonizer
+    """
+
+    def __init__(self, layer: QgsVectorLayer, crs: QgsCoordinateReferenceSystem, lines: LineArrays, geometries: List[QgsGeometry]) -> None:
+        self.layer = layer
+        self.crs = crs
+        self.lines = lines
+        self.geometries = geometries
+
+    def layers(self) -> List[QgsVectorLayer]:
+        return [self.layer]
+
+
+SegmentsGraphs = Tuple[Optional[TiledGraph], Optional[CompactGraph], Optional[ContractedGraph], Optional[ComponentIndex]]
+
+
+def needs_reprojection(crs: QgsCoordinateReferenceSystem) -> bool:
+    """Check if the segments in this CRS have to be reprojected to a metric working CRS.
+
+    Args:
+        crs (QgsCoordinateReferenceSystem): the CRS of the segments layer
+
+    Returns:
+        bool: True for valid CRSs whose units are not meters
+    """
+    return crs.isValid() and crs.mapUnits() != QgsUnitTypes.DistanceMeters
+
+
+def utm_epsg(lon: float, lat: float) -> int:
+    """Get the EPSG code of the WGS 84 UTM zone of a point.
+
+    Args:
+        lon (float): longitude in degrees, the zones of -180 and 180 are clamped to the first and the last one
+        lat (float): latitude in degrees
+
+    Returns:
+        int: the EPSG code, 326xx on the northern hemisphere and 327xx on the southern one
+    """
+    zone = min(max(int((lon + 180) // 6) + 1, 1), 60)
+
+    return (32600 if lat >= 0 else 32700) + zone
+
+
+def working_crs(layer: QgsVectorLayer) -> QgsCoordinateReferenceSystem:
+    """Get the metric CRS the segments are processed in, must be called in the main thread.
+
+    The layer CRS is kept when its units are meters, otherwise the WGS 84 UTM zone of the center of the layer extent.
+
+    Args:
+        layer (QgsVectorLayer): the segments layer
+
+    Returns:
+        QgsCoordinateReferenceSystem: the working CRS
+    """
+    if not needs_reprojection(layer.crs()):
+        return layer.crs()
+
+    wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+    center = QgsCoordinateTransform(layer.crs(), wgs84, QgsProject.instance()).transform(layer.extent().center())
+
+    return QgsCoordinateReferenceSystem('EPSG:%d' % utm_epsg(center.x(), center.y()))
+
+
+def reproject_segments(source: SegmentsSource, crs: QgsCoordinateReferenceSystem, feedback: QgsFeedback = None) -> Optional[QgsVectorLayer]:
+    """Copy the segments to a memory layer in the working CRS.
+
+    Args:
+        source (SegmentsSource): the segments layer, taken in the main thread
+        crs (QgsCoordinateReferenceSystem): the target CRS, usually the `working_crs` of the layer
+        feedback (QgsFeedback, optional): progress and canceling
+
+    Returns:
+        Optional[QgsVectorLayer]: the reprojected segments, None if canceled
+    """
+    transform = QgsCoordinateTransform(source.crs, crs, QgsProject.instance())
+
+    reprojected_layer = QgsMemoryProviderUtils.createMemoryLayer('Reprojected', source.fields, source.wkb_type, crs)
+    provider = reprojected_layer.dataProvider()
+    feature_count = max(source.feature_count, 1)
+    batch: List[QgsFeature] = []
+
+    for idx, f in enumerate(source.source.getFeatures(QgsFeatureRequest())):
+        geometry = f.geometry()
+        geometry.transform(transform)
+        f.setGeometry(geometry)
+
+        batch.append(f)
+
+        if len(batch) == PREPROCESS_BATCH_FEATURES:
+            provider.addFeatures(batch)
+            batch = []
+
+            if feedback:
+                if feedback.isCanceled():
+                    return None
+
+                feedback.setProgress(idx / feature_count * 100)
+
+    provider.addFeatures(batch)
+    reprojected_layer.updateExtents()
+
+    return reprojected_layer
+
+
+def stream_segments(source: SegmentsSource, tolerance: float, target_crs: QgsCoordinateReferenceSystem = None, length_field_name: str = None,
+                    feedback: QgsFeedback = None) -> Optional[SimplifiedSegments]:
+    """Simplify the segments and read their endpoints, in one pass over the segments layer.
+
+    The geometries are simplified with the distance (Douglas-Peucker) method, like `qgis:simplifygeometries`.
+
+    Args:
+        source (SegmentsSource): the segments layer, taken in the main thread
+        tolerance (float): the simplification tolerance, in units of the target CRS
+        target_crs (QgsCoordinateReferenceSystem, optional): the segments are reprojected to this CRS, kept in the source CRS if None
+        length_field_name (str, optional): name of the length attribute to be added, not added if None
+        feedback (QgsFeedback, optional): progress and canceling
+
+    Returns:
+        Optional[SimplifiedSegments]: the simplified segments, None if canceled
+    """
+    crs = target_crs if target_crs is not None and target_crs.isValid() else source.crs
+    transform = QgsCoordinateTransform(source.crs, crs, QgsProject.instance()) if crs != source.crs else None
+
+    fields = QgsFields(source.fields)
+
+    if length_field_name:
+        fields.append(QgsField(length_field_name, QVariant.Double))
+
+    segments_layer = QgsMemoryProviderUtils.createMemoryLayer('simplifygeometries', fields, source.wkb_type, crs)
+    provider = segments_layer.dataProvider()
+    weight_names = [field.name() for field in fields if field.isNumeric()]
+    feature_count = max(source.feature_count, 1)
+    readings: List[LineArrays] = [read_lines([], weight_names)]
+    geometries: List[QgsGeometry] = []
+    batch: List[QgsFeature] = []
+
+    for idx, f in enumerate(source.source.getFeatures(QgsFeatureRequest())):
+        geometry = f.geometry()
+
+        if transform:
+            geometry.transform(transform)
+
+        geometry = geometry.simplify(tolerance)
+        attributes = f.attributes()
+
+        if length_field_name:
+            attributes.append(geometry.length())
+
+        simplified = QgsFeature(fields)
+        simplified.setAttributes(attributes)
+        simplified.setGeometry(geometry)
+
+        batch.append(simplified)
+
+        if not geometry.isEmpty():
+            geometries.append(geometry)
+
+        if len(batch) == PREPROCESS_BATCH_FEATURES:
+            # the ids of the features are known only once they are added
+            (_ok, added) = provider.addFeatures(batch)
+            readings.append(read_lines(added, weight_names))
+            batch = []
+
+            if feedback:
+                if feedback.isCanceled():
+                    return None
+
+                feedback.setProgress(idx / feature_count * 100)
+
+    (_ok, added) = provider.addFeatures(batch)
+    readings.append(read_lines(added, weight_names))
+    segments_layer.updateExtents()
+
+    return SimplifiedSegments(segments_layer, crs, LineArrays.concatenate(readings), geometries)
+
+
+def build_segments_graphs(segments: SimplifiedSegments, grid: float = DEFAULT_NODE_GRID, graph_max_bytes: int = DEFAULT_CACHE_BYTES,
+                          feedback: QgsFeedback = None) -> SegmentsGraphs:
+    """Build the graph of the simplified segments, with its contracted graph and components.
+
+    Args:
+        segments (SimplifiedSegments): the simplified segments
+        grid (float, optional): the cell size of the grid the endpoints are snapped to
+        graph_max_bytes (int, optional): memory budget of the graph, a tiled graph is created for bigger layers
+        feedback (QgsFeedback, optional): progress
+
+    Returns:
+        SegmentsGraphs: the tiled graph, or the graph with its contracted graph and components
+    """
+    # the graph of the whole layer does not fit the budget, the graph is built only around the selected vertices
+    if CompactGraph.estimate_bytes(len(segments.lines), len(segments.lines.attributes)) > graph_max_bytes:
+        # half of the budget for the cached tiles, the rest for the graph stitched from them
+        return (TiledGraph.from_lines(segments.layer, segments.lines, graph_max_bytes // 2, grid=grid), None, None, None)
+
+    graph = CompactGraph.from_lines(segments.lines, grid)
+
+    if feedback:
+        feedback.setProgress(50)
+
+    routing_graph = ContractedGraph.from_graph(graph)
+
+    return (None, graph, routing_graph, prepare_components(routing_graph))
+
+
+def _vertices_fields() -> QgsFields:
+    """Get the fields of the vertices layer."""
+    fields = QgsFields()
+    fields.append(QgsField(VERTEX_NODE_FIELD, QVariant.Int))
+    fields.append(QgsField(VERTEX_DEGREE_FIELD, QVariant.Int))
+    fields.append(QgsField(VERTEX_COMPONENT_FIELD, QVariant.Int))
+
+    return fields
+
+
+def write_vertices_layer(segments: SimplifiedSegments, graphs: SegmentsGraphs, grid: float = DEFAULT_NODE_GRID,
+                         feedback: QgsFeedback = None) -> Tuple[QgsVectorLayer, Optional[np.ndarray]]:
+    """Write the nodes of the graph as a point layer, with their node id, degree and component label.
+
+    The vertices are the rows of the node array of the graph, so every selected vertex maps to exactly one node,
+    and the feature ids of the vertices are returned in node order, to update the vertices of the edited nodes.
+    The tiled graph has no node ids for the whole layer, then the endpoints are interned the same way as in
+    `CompactGraph.from_lines` and the node id is left NULL.
+
+    Args:
+        segments (SimplifiedSegments): the simplified segments
+        graphs (SegmentsGraphs): the graphs built by `build_segments_graphs`
+        grid (float, optional): the cell size of the grid the endpoints are snapped to
+        feedback (QgsFeedback, optional): progress
+
+    Returns:
+        Tuple[QgsVectorLayer, Optional[np.ndarray]]: the vertices layer and the feature id of the vertex of each node, None for the tiled graph
+    """
+    graph = graphs[1]
+
+    if graph is not None:
+        points = graph.points
+        node_ids = np.arange(len(points)).tolist()
+        degrees = graph.degrees()
+        components = graph.component_labels()
+    else:
+        (points, edge_nodes) = intern_points(np.concatenate((segments.lines.starts, segments.lines.ends)), grid)
+        edge_nodes = edge_nodes.reshape(2, -1).T
+        node_ids = [None] * len(points)
+        degrees = np.bincount(edge_nodes.ravel(), minlength=len(points))
+        components = routing_backend().component_labels(len(points), edge_nodes)
+
+    fields = _vertices_fields()
+    vertices_layer = QgsMemoryProviderUtils.createMemoryLayer('Vertices', fields, QgsWkbTypes.Point, segments.crs)
+    vertices = []
+
+    for (x, y), node, degree, component in zip(points.tolist(), node_ids, degrees.tolist(), components.tolist()):
+        vertex = QgsFeature(fields)
+        vertex.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+        vertex.setAttributes([node, degree, component])
+        vertices.append(vertex)
+
+    if feedback:
+        feedback.setProgress(50)
+
+    (_ok, added) = vertices_layer.dataProvider().addFeatures(vertices)
+    vertices_layer.updateExtents()
+
+    fids = np.array([f.id() for f in added], dtype=np.int64) if graph is not None else None
+
+    return (vertices_layer, fids)
+
+
+def polygonize_segments(segments: SimplifiedSegments, feedback: QgsFeedback = None) -> QgsVectorLayer:
+    """Polygonize the simplified segments like `qgis:polygonize`: node them with a unary union, then polygonize with GEOS.
+
+    Args:
+        segments (SimplifiedSegments): the simplified segments
+        feedback (QgsFeedback, optional): progress
+
+    Returns:
+        QgsVectorLayer: the polygons layer
+    """
+    polygons_layer = QgsMemoryProviderUtils.createMemoryLayer('PolygonizedLines', QgsFields(), QgsWkbTypes.Polygon, segments.crs)
+    polygons = []
+
+    if segments.geometries:
+        noded = QgsGeometry.unaryUnion(segments.geometries)
+
+        if feedback:
+            feedback.setProgress(50)
+
+        for polygon in QgsGeometry.polygonize([noded]).asGeometryCollection():
+            feature = QgsFeature()
+            feature.setGeometry(polygon)
+            polygons.append(feature)
+
+    polygons_layer.dataProvider().addFeatures(polygons)
+    polygons_layer.updateExtents()
+
+    return polygons_layer
@@ -1,9 +1,10 @@
 from itertools import combinations, chain
 
 from networkx.utils import pairwise, not_implemented_for
+from networkx.algorithms.shortest_paths.weighted import _dijkstra, _weight_function
 import networkx as nx
 
-__all__ = ['metric_closure', 'steiner_tree']
+__all__ = ['metric_closure', 'steiner_tree', 'MetricClosure']
 
 
 @not_implemented_for('directed')
@@ -49,6 +50,145 @@ def metric_closure(G, weight='weight'):
     return M
 
 
+class MetricClosure(object):
+    """ Compact metric closure of an undirected graph.
+
+    Instead of a complete graph with the path and keys on every edge, only
+    the predecessor of every node on the shortest path from every source is
+    stored, as a (n, n) array of node indices. The paths, edge keys and
+    distances are reconstructed on request, which is cheap for the few pairs
+    of terminals that `steiner_tree` uses.
+
+    Parameters
+    ----------
+    G : NetworkX graph
+        Connected undirected graph, kept by the closure to reconstruct the
+        keys and distances.
+
+    weight : string
+        Edge attribute with the weight, missing weights are one.
+
+    predecessor : numpy array, optional
+        Already calculated predecessors, in the same layout as the
+        `predecessor` attribute, e.g. from another shortest path
+        implementation. Calculated with Dijkstra's algorithm if None.
+
+    Attributes
+    ----------
+    nodes : list
+        The nodes of `G`, in the order of the array rows and columns.
+
+    predecessor : numpy array
+        ``predecessor[i, j]`` is the index of the node before ``nodes[j]`` on
+        the shortest path from ``nodes[i]``, -1 for ``i == j``.
+
+    """
+
+    def __init__(self, G, weight='weight', predecessor=None):
+        import numpy as np
+
+        if G.is_directed():
+            raise nx.NetworkXNotImplemented('not implemented for directed type')
+
+        self.G = G
+        self.weight = weight
+        self.nodes = list(G)
+        self.index = {node: idx for idx, node in enumerate(self.nodes)}
+
+        n = len(self.nodes)
+
+        if predecessor is not None:
+            if predecessor.shape != (n, n):
+                raise nx.NetworkXError("The predecessors do not match the nodes of G.")
+
+            self.predecessor = predecessor
+            return
+
+        dtype = np.int16 if n < 2 ** 15 else np.int32
+        self.predecessor = np.full((n, n), -1, dtype=dtype)
+        weight_function = _weight_function(G, weight)
+        index = self.index
+
+        for idx, source in enumerate(self.nodes):
+            pred = {}
+            _dijkstra(G, source, weight_function, pred=pred)
+
+            if len(pred) != n - 1:
+                msg = "G is not a connected graph. metric_closure is not defined."
+                raise nx.NetworkXError(msg)
+
+            # the first predecessor is the one on the path found first, the same as the paths of `metric_closure`
+            targets = np.fromiter((index[v] for v in pred), dtype=np.int64, count=len(pred))
+            self.predecessor[idx, targets] = np.fromiter((index[p[0]] for p in pred.values()), dtype=np.int64, count=len(pred))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.index
+
+    @property
+    def nbytes(self):
+        return self.predecessor.nbytes
+
+    def path(self, u, v):
+        """Returns the nodes of the shortest path from `u` to `v`. """
+        row = self.predecessor[self.index[u]]
+        target = self.index[v]
+        path = [target]
+
+        while row[path[-1]] != -1:
+            path.append(int(row[path[-1]]))
+
+        return [self.nodes[idx] for idx in reversed(path)]
+
+    def _edge(self, u, v):
+        """Returns the weight and the key (None for simple graphs) of the cheapest edge between `u` and `v`. """
+        data = self.G[u][v]
+
+        if not self.G.is_multigraph():
+            return (data.get(self.weight, 1), None)
+
+        key = min(data, key=lambda k: data[k].get(self.weight, 1))
+
+        return (data[key].get(self.weight, 1), key)
+
+    def distance(self, u, v):
+        """Returns the shortest path distance between `u` and `v`.
+
+        The weights are summed in the same order as Dijkstra's algorithm
+        does, so the result is exactly the distance of `metric_closure`.
+        """
+        distance = 0
+
+        for (a, b) in pairwise(self.path(u, v)):
+            distance += self._edge(a, b)[0]
+
+        return distance
+
+    def path_edges(self, u, v):
+        """Returns the edges of the shortest path between `u` and `v`, with keys for multigraphs. """
+        # the path from the node that comes first, like the edges of `metric_closure`
+        if self.index[u] > self.index[v]:
+            (u, v) = (v, u)
+
+        if not self.G.is_multigraph():
+            return list(pairwise(self.path(u, v)))
+
+        return [(a, b, self._edge(a, b)[1]) for (a, b) in pairwise(self.path(u, v))]
+
+    def subgraph(self, nodes):
+        """Returns the complete graph of `nodes`, with the shortest path distances as `distance` attribute. """
+        nodes = sorted(set(nodes), key=self.index.__getitem__)
+        H = nx.Graph()
+        H.add_nodes_from(nodes)
+
+        for (u, v) in combinations(nodes, 2):
+            H.add_edge(u, v, distance=self.distance(u, v))
+
+        return H
+
+
 @not_implemented_for('directed')
 def steiner_tree(G, terminal_nodes, weight='weight', metric_closure=None):
     """ Return an approximation to the minimum Steiner tree of a graph.
@@ -65,7 +205,8 @@ def steiner_tree(G, terminal_nodes, weight='weight', metric_closure=None):
          The weight to be used for calculating the shortest path
 
     metric_closure:
-         A precalculated metric_closure of the graph
+         A precalculated metric_closure of the graph, either the complete
+         graph from `metric_closure` or a `MetricClosure`
 
     Returns
     -------
@@ -85,6 +226,14 @@ def steiner_tree(G, terminal_nodes, weight='weight', metric_closure=None):
     terminal nodes.
 
     """
+    # the compact closure reconstructs only the paths of the MST edges
+    if isinstance(metric_closure, MetricClosure):
+        H = metric_closure.subgraph(terminal_nodes)
+        mst_edges = nx.minimum_spanning_edges(H, weight='distance', data=False)
+        edges = chain.from_iterable(metric_closure.path_edges(u, v) for u, v in mst_edges)
+
+        return G.edge_subgraph(edges)
+
     # M is the subgraph of the metric closure induced by the terminal nodes of
     # G.
     M = metric_closure if metric_closure else metric_closure(G, weight=weight)
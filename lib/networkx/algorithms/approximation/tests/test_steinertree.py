@@ -2,6 +2,7 @@ from nose.tools import assert_raises, raises
 import networkx as nx
 from networkx.algorithms.approximation.steinertree import metric_closure
 from networkx.algorithms.approximation.steinertree import steiner_tree
+from networkx.algorithms.approximation.steinertree import MetricClosure
 from networkx.testing.utils import assert_edges_equal
 
 class TestSteinerTree:
@@ -179,4 +180,39 @@ class TestSteinerTree:
         T = steiner_tree(self.M, terminal_nodes)
 
 
-        assert_edges_equal(list(T.edges(keys=True, data=True)), expected_edges)
\ No newline at end of file
+        assert_edges_equal(list(T.edges(keys=True, data=True)), expected_edges)
+
+    def test_compact_metric_closure(self):
+        C = MetricClosure(self.G)
+
+        assert C.distance(1, 4) == 22
+        assert C.path(1, 4) == [1, 2, 7, 5, 4]
+        assert C.path(6, 3) == [6, 5, 7, 2, 3]
+        assert C.path_edges(4, 1) == [(1, 2), (2, 7), (7, 5), (5, 4)]
+        assert C.predecessor.dtype.itemsize == 2
+
+    def test_compact_metric_closure_multigraph(self):
+        C = MetricClosure(self.M)
+
+        assert C.distance('A', 'H') == 10
+        assert C.distance('E', 'F') == 6
+        assert C.path_edges('A', 'F') == [('A', 'B', 'k1'), ('B', 'C', 'k4'), ('C', 'D', 'k6'), ('D', 'F', 'k8')]
+
+    def test_connected_compact_metric_closure(self):
+        G = self.G.copy()
+        G.add_node(100)
+        assert_raises(nx.NetworkXError, MetricClosure, G)
+
+    def test_multigraph_steiner_tree_compact_closure(self):
+        terminal_nodes = ['A', 'C', 'H']
+        expected_edges = [
+            ('A', 'B', 'k1', {'weight': 2}),
+            ('B', 'C', 'k4', {'weight': 2}),
+            ('C', 'D', 'k6', {'weight': 2}),
+            ('D', 'F', 'k8', {'weight': 2}),
+            ('F', 'H', 'k10', {'weight': 2})
+        ]
+
+        T = steiner_tree(self.M, terminal_nodes, metric_closure=MetricClosure(self.M))
+
+        assert_edges_equal(list(T.edges(keys=True, data=True)), expected_edges)
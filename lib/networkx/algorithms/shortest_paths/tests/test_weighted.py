@@ -363,6 +363,19 @@ class TestMultiSourceDijkstra(object):
         paths = nx.multi_source_dijkstra_path(G, [0])
         assert_equal(paths, {n: list(range(n + 1)) for n in G})
 
+    def test_multigraph_keys(self):
+        G = nx.MultiGraph()
+        G.add_edge(0, 1, 'short', weight=1)
+        G.add_edge(0, 1, 'long', weight=5)
+        G.add_edge(1, 2, 'a', weight=2)
+        G.add_edge(1, 2, 'b', weight=1)
+        G.add_edge(3, 2, 'c', weight=1)
+        distances, paths, keys = nx.multi_source_dijkstra(G, {0, 3})
+        assert_equal(paths[1], [0, 1])
+        assert_equal(dict(keys), {0: [], 1: ['short'], 2: ['c'], 3: []})
+        distance, path, keys = nx.multi_source_dijkstra(G, {0}, 3)
+        assert_equal((distance, path, keys), (3, [0, 1, 2, 3], ['short', 'b', 'c']))
+
 
 class TestBellmanFordAndGoldbergRadzik(WeightedTestBase):
 
@@ -15,6 +15,10 @@ Shortest path algorithms for weighed graphs.
 """
 
 from collections import deque
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 from heapq import heappush, heappop
 from itertools import count
 import networkx as nx
@@ -740,7 +744,7 @@ def multi_source_dijkstra(G, sources, target=None, cutoff=None,
         return (0, [target])
     weight = _weight_function(G, weight)
     paths = {source: [source] for source in sources}  # dictionary of paths
-    keys = {source: [] for source in sources} if G.is_multigraph() else None # dictionary of keys
+    keys = _EdgeKeyPaths(sources) if G.is_multigraph() else None  # mapping of keys
     dist = _dijkstra_multisource(G, sources, weight, paths=paths,
                                 keys=keys, cutoff=cutoff, target=target)
     if target is None:
@@ -752,6 +756,45 @@ def multi_source_dijkstra(G, sources, target=None, cutoff=None,
         raise nx.NetworkXNoPath("No path to {}.".format(target))
 
 
+class _EdgeKeyPaths(Mapping):
+    """Read-only mapping from a node to the list of edge keys of the path
+    that reaches it, as filled by :func:`_dijkstra_multisource`.
+
+    Only the last edge of each path is stored, as a (previous node, key)
+    pointer. The key list of a path is rebuilt when it is asked for, so
+    the search does not copy a list on every relaxation.
+
+    Parameters
+    ----------
+    sources : iterable of nodes
+        The sources of the search, their key lists are empty.
+
+    """
+
+    def __init__(self, sources):
+        # None ends a path, either at a source or at an edge without key
+        self.pred = {source: None for source in sources}
+
+    def __getitem__(self, node):
+        keys = []
+        step = self.pred[node]
+        while step is not None:
+            (node, key) = step
+            keys.append(key)
+            step = self.pred[node]
+        keys.reverse()
+        return keys
+
+    def __iter__(self):
+        return iter(self.pred)
+
+    def __len__(self):
+        return len(self.pred)
+
+    def __contains__(self, node):
+        return node in self.pred
+
+
 def _dijkstra(G, source, weight, pred=None, paths=None, keys=None, cutoff=None,
               target=None):
     """Uses Dijkstra's algorithm to find shortest weighted paths from a
@@ -792,9 +835,10 @@ def _dijkstra_multisource(G, sources, weight, pred=None, paths=None,
         dict to store the path list from source to each node, keyed by node.
         If None, paths are not stored.
 
-    keys: dict, optional (default=None)
-        dict to store the keys that are used to build the path, keyed by edge key.
-        If None, keys are not stored.
+    keys: _EdgeKeyPaths, optional (default=None)
+        mapping to store the keys of the edges that are used to build the
+        path, keyed by node. Only a pointer to the last edge is stored for
+        each node. If None, keys are not stored.
 
     target : node label, optional
         Ending node for path. Search is halted when target is found.
@@ -843,7 +887,7 @@ def _dijkstra_multisource(G, sources, weight, pred=None, paths=None,
         if v == target:
             break
         for u, e in G_succ[v].items():
-            least_cost_key = {} if keys else None
+            least_cost_key = {} if keys is not None else None
             cost = weight(v, u, e, least_cost_key)
 
             if cost is None:
@@ -863,9 +907,9 @@ def _dijkstra_multisource(G, sources, weight, pred=None, paths=None,
                     paths[u] = paths[v] + [u]
                 if keys is not None:
                     if 'key' in least_cost_key:
-                        keys[u] = keys[v] + [least_cost_key['key']]
+                        keys.pred[u] = (v, least_cost_key['key'])
                     else:
-                        keys[u] = []
+                        keys.pred[u] = None
                 if pred is not None:
                     pred[u] = [v]
             elif vu_dist == seen[u]:
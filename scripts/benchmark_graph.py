@@ -0,0 +1,522 @@
+"""Benchmarks for the vertices mode graph.
+
+Runs on synthetic segment layers (a jittered grid of lines), so no QGIS project is needed,
+however the QGIS python environment should be available, e.g. run it with the same
+interpreter as QGIS or via `scripts/run-env-linux.sh`.
+
+Usage:
+    python scripts/benchmark_graph.py build --sizes 10000 100000 1000000
+    python scripts/benchmark_graph.py query --sizes 100000 1000000 --queries 50
+    python scripts/benchmark_graph.py dijkstra --lengths 1000 10000 50000
+    python scripts/benchmark_graph.py backend --sizes 10000 100000 --queries 20
+    python scripts/benchmark_graph.py exact --size 100000 --queries 20 --log steiner_queries.csv
+    python scripts/benchmark_graph.py preprocess --size 500000
+
+The `preprocess` benchmark runs QGIS processing algorithms, it starts a headless QGIS application.
+"""
+import argparse
+import gc
+import heapq
+import importlib
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import numpy as np
+import networkx as nx
+
+from BoundaryGraph import CompactGraph, ComponentArrays, ComponentIndex, LineArrays, ShortestPathTreeCache, DEFAULT_WEIGHT_NAME, DEFAULT_WEIGHT_VALUE, \
+    astar_path, calculate_components_hierarchies, hierarchy_steiner_tree, kou_steiner_tree, mehlhorn_steiner_tree, set_routing_backend, \
+    find_steiner_tree, SteinerQueryLog, ContractedGraph, prepare_components, prepare_graph_from_lines
+
+WEIGHT_FIELDS = ('boundary', 'BD_LEN')
+
+
+def synthetic_segments(count: int, seed: int = 0):
+    """Create `count` lines on a square grid, with horizontal and vertical edges between neighbouring points."""
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(count / 2))) + 1
+    xs, ys = np.meshgrid(np.arange(side, dtype=np.float64), np.arange(side, dtype=np.float64))
+    nodes = np.column_stack((xs.ravel(), ys.ravel())) * 10 + rng.random((side * side, 2))
+
+    ids = np.arange(side * side).reshape(side, side)
+    horizontal = np.column_stack((ids[:, :-1].ravel(), ids[:, 1:].ravel()))
+    vertical = np.column_stack((ids[:-1, :].ravel(), ids[1:, :].ravel()))
+    edges = np.concatenate((horizontal, vertical))[:count]
+
+    starts = [tuple(p) for p in nodes[edges[:, 0]].tolist()]
+    ends = [tuple(p) for p in nodes[edges[:, 1]].tolist()]
+    weights = {
+        'boundary': rng.random(len(edges)).tolist(),
+        # the same values as `addLengthAttribute` writes for straight lines
+        'BD_LEN': np.hypot(*(nodes[edges[:, 0]] - nodes[edges[:, 1]]).T).tolist(),
+    }
+
+    return starts, ends, list(range(len(edges))), weights
+
+
+def build_networkx(starts, ends, fids, weights) -> nx.MultiGraph:
+    """The graph building loop as it was in `prepare_graph_from_lines` before the compact graph.
+
+    Coordinate tuples stand in for the `QgsPointXY` node keys, so the real cost of the old graph is even higher.
+    """
+    G = nx.MultiGraph()
+
+    for idx, fid in enumerate(fids):
+        data = {DEFAULT_WEIGHT_NAME: DEFAULT_WEIGHT_VALUE}
+
+        for field_name, values in weights.items():
+            data[field_name] = values[idx]
+
+        G.add_edge(starts[idx], ends[idx], fid, **data)
+
+    return G
+
+
+def build_compact(starts, ends, fids, weights) -> CompactGraph:
+    return CompactGraph.from_endpoints(starts, ends, fids, weights=weights)
+
+
+def build_from_arrays(lines: LineArrays) -> CompactGraph:
+    return CompactGraph.from_lines(lines)
+
+
+def measure(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - started
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak, result
+
+
+def benchmark_build(sizes) -> None:
+    print('%10s %10s %12s %12s %10s %12s %12s %12s' % ('segments', 'nodes', 'nx time', 'nx peak', 'csr time', 'csr peak', 'csr arrays', 'arrays time'))
+
+    for size in sizes:
+        data = synthetic_segments(size)
+
+        nx_time, nx_peak, G = measure(build_networkx, *data)
+        nodes = G.number_of_nodes()
+        del G
+
+        csr_time, csr_peak, graph = measure(build_compact, *data)
+        assert graph.number_of_nodes() == nodes
+
+        (starts, ends, fids, weights) = data
+        lines = LineArrays(starts, ends, fids, attributes=weights)
+        arrays_time, _arrays_peak, arrays_graph = measure(build_from_arrays, lines)
+        assert arrays_graph.number_of_nodes() == nodes
+
+        print('%10d %10d %11.2fs %10.1fMB %9.2fs %10.1fMB %10.1fMB %11.2fs' % (
+            size,
+            nodes,
+            nx_time,
+            nx_peak / 2**20,
+            csr_time,
+            csr_peak / 2**20,
+            graph.memory_usage() / 2**20,
+            arrays_time,
+        ))
+
+
+def timed(func, *args) -> float:
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def measure_time(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+
+    return time.perf_counter() - started, result
+
+
+def benchmark_query(sizes, queries: int, weight: str, seed: int = 0) -> None:
+    """Latency of two vertex selections: the terminal-local searches used before, the A* search and the contraction hierarchy."""
+    names = ('mehlhorn', 'kou', 'astar', 'ch')
+    print('%10s %8s %9s %9s %10s' % ('segments', 'weight', 'ch build', 'ch size', 'shortcuts'),
+          ''.join('%14s %14s' % ('%s p50' % name, '%s p95' % name) for name in names))
+
+    for size in sizes:
+        graph = build_compact(*synthetic_segments(size, seed))
+        rng = np.random.default_rng(seed)
+        pairs = rng.integers(0, graph.number_of_nodes(), (queries, 2)).tolist()
+        graph.weights(weight)
+        graph.weight_per_length(weight)
+
+        components = ComponentIndex(graph)
+        hierarchies = calculate_components_hierarchies(components, weight)
+        times = {name: [] for name in names}
+
+        for (source, target) in pairs:
+            label = components.component_of([source, target])
+
+            if source == target or label is None:
+                continue
+
+            times['mehlhorn'].append(timed(mehlhorn_steiner_tree, graph, [source, target], weight))
+            # a new cache for every query, the first selection of the two vertices
+            times['kou'].append(timed(kou_steiner_tree, graph, [source, target], weight, ShortestPathTreeCache()))
+            times['astar'].append(timed(astar_path, graph, source, target, weight))
+            times['ch'].append(timed(hierarchy_steiner_tree, graph, [source, target], hierarchies[label]))
+
+        row = [
+            size,
+            weight,
+            sum(hierarchy.build_time for hierarchy in hierarchies.values()),
+            sum(hierarchy.nbytes() for hierarchy in hierarchies.values()) / 2**20,
+            sum(hierarchy.shortcuts for hierarchy in hierarchies.values()),
+        ]
+
+        for name in names:
+            row.extend(np.percentile(times[name], [50, 95]) * 1000)
+
+        print(('%10d %8s %8.1fs %7.1fMB %10d' + ' %12.1fms' * len(names) * 2) % tuple(row))
+
+
+def multigraph_chain(length: int) -> nx.MultiGraph:
+    """A long boundary: a chain of `length` nodes, with two parallel lines between the neighbours."""
+    G = nx.MultiGraph()
+
+    for node in range(length - 1):
+        G.add_edge(node, node + 1, 2 * node, weight=1.0)
+        G.add_edge(node, node + 1, 2 * node + 1, weight=2.0)
+
+    return G
+
+
+def dijkstra_copying_keys(G: nx.MultiGraph, source: int, weight: str):
+    """The key tracking of the vendored `_dijkstra_multisource` before the predecessor pointers, the key list is copied on every relaxation."""
+    dist = {}
+    seen = {source: 0}
+    paths = {source: [source]}
+    keys = {source: []}
+    fringe = [(0, source)]
+
+    while fringe:
+        (d, v) = heapq.heappop(fringe)
+
+        if v in dist:
+            continue
+
+        dist[v] = d
+
+        for u, e in G._adj[v].items():
+            key = min(e, key=lambda k: e[k].get(weight, 1))
+            vu_dist = d + e[key].get(weight, 1)
+
+            if u not in dist and (u not in seen or vu_dist < seen[u]):
+                seen[u] = vu_dist
+                heapq.heappush(fringe, (vu_dist, u))
+                paths[u] = paths[v] + [u]
+                keys[u] = keys[v] + [key]
+
+    return (dist, paths, keys)
+
+
+def benchmark_dijkstra(lengths) -> None:
+    """Regression benchmark of the edge keys of the multigraph shortest paths on long chains."""
+    print('%10s %14s %14s %14s %14s' % ('length', 'copying keys', 'no keys', 'key pointers', 'speed-up'))
+
+    for length in lengths:
+        G = multigraph_chain(length)
+        simple = nx.Graph(G)
+
+        copying_time = timed(dijkstra_copying_keys, G, 0, 'weight')
+        # the paths are still built by copying, the simple graph shows the cost without any keys
+        simple_time = timed(nx.single_source_dijkstra, simple, 0)
+        pointers_time = timed(nx.multi_source_dijkstra, G, {0})
+        (_dist, _paths, keys) = nx.multi_source_dijkstra(G, {0})
+        assert keys[length - 1] == dijkstra_copying_keys(G, 0, 'weight')[2][length - 1]
+
+        print('%10d %13.3fs %13.3fs %13.3fs %13.1fx' % (length, copying_time, simple_time, pointers_time, copying_time / pointers_time))
+
+
+def benchmark_backend(sizes, queries: int, weight: str, closure_nodes: int = 2000, seed: int = 0) -> None:
+    """The networkx routing backend vs the SciPy one: component labels, metric closure of a small graph and Steiner trees of 3-5 terminals.
+
+    The results of the backends are compared, the run stops if they differ.
+    """
+    names = ('networkx', 'scipy')
+    print('%10s %8s' % ('segments', 'weight'),
+          ''.join('%14s %14s %14s' % ('%s comp' % name, '%s closure' % name, '%s tree p50' % name) for name in names),
+          '%10s' % 'speed-up')
+
+    for size in sizes:
+        data = synthetic_segments(size, seed)
+        rng = np.random.default_rng(seed)
+        row = [size, weight]
+        results = []
+        tree_times = []
+
+        # the closure costs nodes^2, it is calculated on a smaller graph
+        small = build_compact(*synthetic_segments(min(size, closure_nodes), seed))
+        small_components = ComponentIndex(small)
+        label = max(small_components.labels(min_size=2), key=lambda label: len(small_components.nodes(label)))
+        component = ComponentArrays.from_component(small_components, label, weight)
+
+        for name in names:
+            backend = set_routing_backend(name)
+            graph = build_compact(*data)
+            graph.weights(weight)
+            components_time, labels = measure_time(backend.component_labels, len(graph.points), graph.edge_nodes[graph.edge_alive])
+            closure_time, closure = measure_time(backend.metric_closure, component)
+            components = ComponentIndex(graph)
+            label = max(components.labels(min_size=2), key=lambda label: len(components.nodes(label)))
+            nodes = components.nodes(label)
+            terminals = [rng.choice(nodes, int(rng.integers(3, 6)), replace=False).tolist() for _ in range(queries)]
+            # the first query of the SciPy backend also builds the matrix of the graph
+            backend.steiner_tree(graph, terminals[0], weight)
+            times = []
+            trees = []
+
+            for nodes in terminals:
+                elapsed, tree = measure_time(backend.steiner_tree, graph, nodes, weight)
+                times.append(elapsed)
+                trees.append(tree)
+
+            results.append((labels.tolist(), closure.predecessor.tolist(), trees))
+            tree_times.append(np.percentile(times, 50))
+            row.extend([components_time * 1000, closure_time * 1000, tree_times[-1] * 1000])
+            rng = np.random.default_rng(seed)
+
+        assert results[0] == results[1], 'the backends give different results'
+        row.append(tree_times[0] / tree_times[1])
+
+        print(('%10d %8s' + ' %12.1fms' * len(names) * 3 + ' %9.1fx') % tuple(row))
+
+    set_routing_backend()
+
+
+def nearby_nodes(graph: CompactGraph, node: int, count: int) -> list:
+    """The first `count` nodes of a breadth first search, like the vertices selected around a parcel."""
+    nodes = [node]
+
+    for node in nodes:
+        nodes.extend(u for u in graph.neighbors(node) if u not in nodes)
+
+        if len(nodes) >= count:
+            break
+
+    return nodes[:count]
+
+
+def benchmark_exact(size: int, queries: int, weight: str, log_path: str = None, seed: int = 0) -> None:
+    """Exact vs approximate Steiner trees of 3-6 vertices selected close to each other, grouped by the number of terminals.
+
+    With `--log`, the records of the queries are written to a CSV file, in the same format as the plugin writes them.
+    """
+    graph = build_compact(*synthetic_segments(size, seed))
+    components = ComponentIndex(graph)
+    rng = np.random.default_rng(seed)
+    log = SteinerQueryLog(max_records=None, path=log_path)
+    print('%10s %12s %12s %12s %12s %12s' % ('terminals', 'exact', 'local nodes', 'exact p50', 'approx p50', 'weight gain'))
+
+    for count in range(3, 7):
+        exact_times = []
+        approximate_times = []
+        local_nodes = []
+        gains = []
+
+        for _ in range(queries):
+            area = nearby_nodes(graph, int(rng.integers(0, graph.number_of_nodes())), 40)
+            terminals = rng.choice(area, min(count, len(area)), replace=False).tolist()
+
+            if len(terminals) < count or components.component_of(terminals) is None:
+                continue
+
+            approximate_times.append(timed(mehlhorn_steiner_tree, graph, terminals, weight))
+            approximate = sum(graph.weights(weight)[mehlhorn_steiner_tree(graph, terminals, weight)])
+            find_steiner_tree(graph, terminals, weight, components, query_log=log)
+            record = log.records[-1]
+
+            if record[2] == 'exact':
+                exact_times.append(record[3])
+                local_nodes.append(record[1])
+                gains.append(1 - record[4] / approximate if approximate else 0.0)
+
+        print('%10d %12s %12d %10.1fms %10.1fms %11.2f%%' % (
+            count,
+            '%d/%d' % (len(exact_times), len(approximate_times)),
+            np.median(local_nodes) if local_nodes else 0,
+            np.median(exact_times) * 1000 if exact_times else np.nan,
+            np.median(approximate_times) * 1000,
+            np.mean(gains) * 100 if gains else 0.0,
+        ))
+
+
+def import_plugin_module(name: str):
+    """Import a module of the plugin as part of its package, for the modules with relative imports."""
+    plugin_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    sys.path.insert(0, os.path.dirname(plugin_dir))
+
+    return importlib.import_module('%s.%s' % (os.path.basename(plugin_dir), name))
+
+
+def start_qgis():
+    """Start a headless QGIS application with the processing framework."""
+    from qgis.core import QgsApplication
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), 'python', 'plugins'))
+
+    from processing.core.Processing import Processing
+    Processing.initialize()
+
+    return app
+
+
+def synthetic_segments_layer(count: int, seed: int = 0):
+    """Memory layer with the synthetic segments, each with a jittered middle vertex for the simplification to remove."""
+    from PyQt5.QtCore import QVariant
+    from qgis.core import QgsCoordinateReferenceSystem, QgsFeature, QgsField, QgsFields, QgsGeometry, QgsMemoryProviderUtils, QgsPointXY, QgsWkbTypes
+
+    (starts, ends, _fids, weights) = synthetic_segments(count, seed)
+    rng = np.random.default_rng(seed)
+    middles = (np.array(starts) + np.array(ends)) / 2 + rng.normal(scale=0.01, size=(len(starts), 2))
+
+    fields = QgsFields()
+    fields.append(QgsField('boundary', QVariant.Double))
+
+    layer = QgsMemoryProviderUtils.createMemoryLayer('segments', fields, QgsWkbTypes.LineString, QgsCoordinateReferenceSystem('EPSG:3857'))
+    features = []
+
+    for start, middle, end, boundary in zip(starts, middles.tolist(), ends, weights['boundary']):
+        f = QgsFeature(fields)
+        f.setAttributes([boundary])
+        f.setGeometry(QgsGeometry.fromPolylineXY([QgsPointXY(*start), QgsPointXY(*middle), QgsPointXY(*end)]))
+        features.append(f)
+
+    layer.dataProvider().addFeatures(features)
+
+    return layer
+
+
+def preprocess_chained(layer, tolerance: float) -> dict:
+    """The first step as it was: processing algorithms chained through memory layers, then the graph read from the simplified layer."""
+    import processing
+    from qgis.core import QgsProcessingFeedback
+
+    feedback = QgsProcessingFeedback()
+    timings = {}
+
+    (timings['stream'], simplified) = measure_time(lambda: processing.run('qgis:simplifygeometries', {
+        'INPUT': layer,
+        'METHOD': 0,
+        'TOLERANCE': tolerance,
+        'OUTPUT': 'memory:simplifygeometries',
+    }, feedback=feedback)['OUTPUT'])
+
+    def build_graph():
+        graph = prepare_graph_from_lines(simplified)
+        return prepare_components(ContractedGraph.from_graph(graph))
+
+    def extract_vertices():
+        vertices = processing.run('qgis:extractspecificvertices', {'INPUT': simplified, 'VERTICES': '0, -1', 'OUTPUT': 'memory:Vertices'}, feedback=feedback)
+        return processing.run('qgis:deleteduplicategeometries', {'INPUT': vertices['OUTPUT'], 'OUTPUT': 'memory:Vertices'}, feedback=feedback)
+
+    (timings['graph'], _components) = measure_time(build_graph)
+    (timings['vertices'], _vertices) = measure_time(extract_vertices)
+    (timings['polygonize'], _polygons) = measure_time(
+        lambda: processing.run('qgis:polygonize', {'INPUT': simplified, 'OUTPUT': 'memory:PolygonizedLines'}, feedback=feedback))
+
+    return timings
+
+
+def preprocess_fused(layer, tolerance: float) -> dict:
+    """The first step as the plugin runs it, with the stages one after another instead of in parallel tasks."""
+    preprocessing = import_plugin_module('BoundaryPreprocessing')
+    timings = {}
+
+    (timings['stream'], segments) = measure_time(preprocessing.stream_segments, preprocessing.SegmentsSource.from_layer(layer), tolerance)
+    (timings['graph'], graphs) = measure_time(preprocessing.build_segments_graphs, segments)
+    (timings['vertices'], _vertices) = measure_time(preprocessing.write_vertices_layer, segments, graphs)
+    (timings['polygonize'], _polygons) = measure_time(preprocessing.polygonize_segments, segments)
+
+    return timings
+
+
+def benchmark_preprocess(size: int, tolerance: float) -> None:
+    """Time of the first step preprocessing, the chained processing algorithms vs the fused single pass."""
+    # the application has to stay alive while the layers are processed
+    app = start_qgis()
+
+    try:
+        layer = synthetic_segments_layer(size)
+
+        before = preprocess_chained(layer, tolerance)
+        after = preprocess_fused(layer, tolerance)
+
+        # a markdown table, the rows go to the benchmarks section of the README
+        print('%d segments, tolerance %g\n' % (size, tolerance))
+        print('| stage | chained | fused |')
+        print('| --- | ---: | ---: |')
+
+        for stage in ('stream', 'graph', 'vertices', 'polygonize'):
+            print('| %s | %.2fs | %.2fs |' % (stage, before[stage], after[stage]))
+
+        print('| total | %.2fs | %.2fs |' % (sum(before.values()), sum(after.values())))
+    finally:
+        app.exitQgis()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    build_parser = subparsers.add_parser('build', help='graph build time and memory, networkx vs compact graph')
+    build_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+
+    query_parser = subparsers.add_parser('query', help='two vertex selection latency, terminal-local searches vs A* vs contraction hierarchy')
+    query_parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    query_parser.add_argument('--queries', type=int, default=50)
+    query_parser.add_argument('--weight', default='BD_LEN', choices=WEIGHT_FIELDS)
+
+    dijkstra_parser = subparsers.add_parser('dijkstra', help='edge keys of the multigraph shortest paths on long chains, copied lists vs predecessor pointers')
+    dijkstra_parser.add_argument('--lengths', type=int, nargs='+', default=[1000, 10000, 50000])
+
+    backend_parser = subparsers.add_parser('backend', help='networkx vs SciPy routing backend, components, metric closure and Steiner trees')
+    backend_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    backend_parser.add_argument('--queries', type=int, default=20)
+    backend_parser.add_argument('--weight', default='BD_LEN', choices=WEIGHT_FIELDS)
+
+    exact_parser = subparsers.add_parser('exact', help='exact vs approximate Steiner trees of 3-6 nearby vertices')
+    exact_parser.add_argument('--size', type=int, default=100000)
+    exact_parser.add_argument('--queries', type=int, default=20)
+    exact_parser.add_argument('--weight', default='BD_LEN', choices=WEIGHT_FIELDS)
+    exact_parser.add_argument('--log', help='CSV file for the query records')
+
+    preprocess_parser = subparsers.add_parser('preprocess', help='first step preprocessing, chained processing algorithms vs the fused single pass')
+    preprocess_parser.add_argument('--size', type=int, default=500000)
+    preprocess_parser.add_argument('--tolerance', type=float, default=1.0)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'build':
+        benchmark_build(args.sizes)
+    elif args.benchmark == 'query':
+        benchmark_query(args.sizes, args.queries, args.weight)
+    elif args.benchmark == 'dijkstra':
+        benchmark_dijkstra(args.lengths)
+    elif args.benchmark == 'backend':
+        benchmark_backend(args.sizes, args.queries, args.weight)
+    elif args.benchmark == 'exact':
+        benchmark_exact(args.size, args.queries, args.weight, args.log)
+    elif args.benchmark == 'preprocess':
+        benchmark_preprocess(args.size, args.tolerance)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
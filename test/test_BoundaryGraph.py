@@ -0,0 +1,793 @@
+# coding=utf-8
+"""Tests for the vertices mode graph.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+import os
+import sys
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# the plugin bundles networkx, BoundaryGraph imports it from there too
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import networkx as nx
+import numpy as np
+
+import BoundaryGraph
+from BoundaryGraph import CompactGraph, ComponentIndex, ContractedGraph, TiledGraph, NoSuitableGraphError, DEFAULT_WEIGHT_VALUE, ShortestPathTreeCache, \
+    LineArrays, astar_path, mehlhorn_steiner_tree, kou_steiner_tree, find_steiner_tree, calculate_components_metric_closures, \
+    calculate_components_hierarchies, calculate_components_routing, set_routing_backend, BoundaryDelineationError, \
+    SteinerQueryLog, dreyfus_wagner_steiner_tree, yen_k_shortest_paths, RoutingCache, UnknownWeightError
+
+
+def square_with_tail() -> CompactGraph:
+    """Square 0-1-2-3 with a double edge between 0 and 1 and a tail 2-4.
+
+    (0, 1) --- 3 --- (1, 1) --- 5 --- (2, 1)
+      |                |
+      2                1
+      |                |
+    (0, 0) == 0, 4 == (1, 0)
+    """
+    starts = [(0.0, 0.0), (1.0, 0.0), (0.0, 1.0), (1.0, 1.0), (1.0, 0.0), (1.0, 1.0)]
+    ends = [(1.0, 0.0), (1.0, 1.0), (0.0, 0.0), (0.0, 1.0), (0.0, 0.0), (2.0, 1.0)]
+    fids = [0, 1, 2, 3, 4, 5]
+    weights = {'boundary': [1, 1, 5, 1, 3, 1]}
+
+    return CompactGraph.from_endpoints(starts, ends, fids, weights=weights)
+
+
+class CompactGraphTest(unittest.TestCase):
+    """Test the CSR graph."""
+
+    def setUp(self):
+        self.graph = square_with_tail()
+
+    def test_nodes_are_interned(self):
+        self.assertEqual(self.graph.number_of_nodes(), 5)
+        self.assertEqual(self.graph.number_of_edges(), 6)
+        self.assertEqual(self.graph.node_id((1.0, 0.0)), 1)
+        self.assertIsNone(self.graph.node_id((5.0, 5.0)))
+
+    def test_adjacency(self):
+        a = self.graph.node_id((0.0, 0.0))
+        b = self.graph.node_id((1.0, 0.0))
+
+        self.assertEqual(self.graph.degree(a), 3)
+        self.assertEqual(sorted(self.graph.neighbors(a)), sorted([b, self.graph.node_id((0.0, 1.0))]))
+        self.assertEqual(self.graph.edge_keys(self.graph.edges_between(a, b)), [0, 4])
+
+    def test_degrees(self):
+        self.assertEqual(self.graph.degrees().tolist(), [self.graph.degree(node) for node in range(5)])
+
+        self.graph.update([5], [(2.0, 1.0)], [(2.0, 1.0)], [6])
+        self.assertEqual(self.graph.degrees().tolist(), [self.graph.degree(node) for node in range(5)])
+
+    def test_weights(self):
+        self.assertEqual(self.graph.weights('boundary').tolist(), [1, 1, 5, 1, 3, 1])
+        self.assertEqual(self.graph.weights().tolist(), [DEFAULT_WEIGHT_VALUE] * 6)
+
+        with self.assertRaises(UnknownWeightError):
+            self.graph.weights('missing')
+
+    def test_expression_weights(self):
+        graph = CompactGraph.from_endpoints([(0.0, 0.0), (1.0, 0.0)], [(1.0, 0.0), (2.0, 0.0)], [0, 1], weights={'boundary': [0.0, np.nan]})
+
+        # NULL and 0 attribute values fall back to the default weight
+        self.assertEqual(graph.weights('boundary').tolist(), [DEFAULT_WEIGHT_VALUE] * 2)
+        self.assertFalse(graph.has_weights('1 - boundary'))
+
+        graph.set_weights('1 - boundary', 1 - graph.attributes()['boundary'])
+
+        self.assertTrue(graph.has_weights('1 - boundary'))
+        self.assertEqual(graph.weights('1 - boundary').tolist(), [1.0, DEFAULT_WEIGHT_VALUE])
+
+        graph.update([1])
+        self.assertFalse(graph.has_weights('1 - boundary'))
+
+    def test_multipart_keys(self):
+        graph = CompactGraph.from_endpoints([(0.0, 0.0), (1.0, 1.0)], [(1.0, 1.0), (2.0, 2.0)], [7, 7], [0, 1])
+
+        self.assertEqual(graph.edge_keys(range(2)), [(7, 0), (7, 1)])
+
+    def test_endpoints_are_snapped_to_grid(self):
+        # the ends of the second line are off by floating point noise, they should not split the graph
+        starts = [(0.0, 0.0), (1.0 + 1e-10, 0.0), (2.0, 1e-9)]
+        ends = [(1.0, 0.0), (2.0 - 1e-10, 0.0), (3.0, 0.0)]
+        lines = LineArrays(np.array(starts), np.array(ends), np.arange(3))
+
+        for graph in (CompactGraph.from_endpoints(starts, ends, [0, 1, 2]), CompactGraph.from_lines(lines)):
+            self.assertEqual(graph.number_of_nodes(), 4)
+            self.assertEqual(graph.node_id((2.0, 0.0)), graph.node_id((2.0, 1e-9)))
+            self.assertEqual(len(set(graph.component_labels().tolist())), 1)
+
+            graph.update([], [(3.0 + 1e-9, 0.0)], [(4.0, 0.0)], [3])
+            self.assertEqual(graph.number_of_nodes(), 5)
+
+        self.assertEqual(CompactGraph.from_lines(lines, grid=1e-12).number_of_nodes(), 6)
+
+    def test_from_lines(self):
+        expected = square_with_tail()
+        lines = LineArrays(
+            expected.points[expected.edge_nodes[:, 0]],
+            expected.points[expected.edge_nodes[:, 1]],
+            expected.edge_fids,
+            attributes={'boundary': expected.weights('boundary')}
+        )
+        graph = CompactGraph.from_lines(lines)
+
+        self.assertEqual(graph.number_of_nodes(), expected.number_of_nodes())
+        self.assertEqual(graph.weights('boundary').tolist(), [1, 1, 5, 1, 3, 1])
+
+        for edge in range(6):
+            u, v = graph.edge_nodes[edge].tolist()
+            self.assertEqual((graph.node_point(u), graph.node_point(v)), tuple(expected.node_point(n) for n in expected.edge_nodes[edge].tolist()))
+
+
+class ContractedGraphTest(unittest.TestCase):
+    """Test the contraction of the degree-2 chains."""
+
+    def setUp(self):
+        self.graph = square_with_tail()
+        self.contracted = ContractedGraph.from_graph(self.graph)
+
+    def test_chains(self):
+        # (0, 1) is the only degree-2 node, the lines 2 and 3 become one edge
+        self.assertEqual(self.contracted.number_of_nodes(), 4)
+        self.assertEqual(self.contracted.number_of_edges(), 5)
+        self.assertIsNone(self.contracted.node_ids_of([self.graph.node_id((0.0, 1.0))]))
+
+        chain = self.contracted.edges_between(*self.contracted.node_ids_of([0, 2]))[0]
+
+        self.assertEqual(self.contracted.line_keys([chain]), [2, 3])
+        self.assertEqual(self.contracted.weights('boundary')[chain], 6)
+
+    def test_update_from(self):
+        change = self.graph.update([1])
+        self.contracted.update_from(change)
+
+        terminals = self.contracted.node_ids_of([self.graph.node_id((1.0, 1.0)), self.graph.node_id((0.0, 0.0))])
+
+        self.assertEqual(sorted(find_steiner_tree(self.contracted, terminals, weight='boundary')), [2, 3])
+
+        # splitting the chain in the middle turns the new junction into a node
+        change = self.graph.update([], [(0.0, 1.0)], [(-1.0, 1.0)], [6])
+        self.contracted.update_from(change)
+
+        self.assertEqual(self.contracted.node_ids_of([self.graph.node_id((0.0, 1.0))]), [4])
+        self.assertEqual(self.contracted.number_of_edges(), 6)
+        self.assertEqual(sorted(self.contracted.line_keys(np.flatnonzero(self.contracted.edge_alive).tolist())), [0, 2, 3, 4, 5, 6])
+
+
+class GraphUpdateTest(unittest.TestCase):
+    """Test the updates of the graph in place, against graphs built from scratch."""
+
+    @staticmethod
+    def component_points(graph):
+        labels = graph.component_labels()
+        nodes = np.unique(graph.edge_nodes[graph.edge_alive])
+        components = {}
+
+        for node in nodes.tolist():
+            components.setdefault(int(labels[node]), set()).add(graph.node_point(node))
+
+        return sorted(sorted(points) for points in components.values())
+
+    def test_expression_weights_after_update(self):
+        graph = square_with_tail()
+        expression = 'boundary * 2'
+        source = graph.node_id((0.0, 0.0))
+        target = graph.node_id((0.0, 1.0))
+
+        graph.set_weights(expression, graph.attributes()['boundary'] * 2)
+        graph.update([5])
+        components = ComponentIndex(graph)
+        labels = components.labels(min_size=2)
+
+        # the update drops the weights of the expression, they are not silently replaced by the default weights
+        with self.assertRaises(UnknownWeightError):
+            calculate_components_metric_closures(components, expression, labels)
+
+        with self.assertRaises(UnknownWeightError):
+            calculate_components_hierarchies(components, expression, labels)
+
+        graph.set_weights(expression, graph.attributes()['boundary'] * 2)
+        label = components.component_of([source, target])
+
+        self.assertEqual(calculate_components_metric_closures(components, expression, labels)[label].distance(source, target), 6.0)
+        self.assertEqual(calculate_components_hierarchies(components, expression, labels)[label].distance(source, target)[0], 6.0)
+
+    def test_components_follow_updates(self):
+        rng = np.random.RandomState(42)
+        points = [(float(x), float(y)) for x, y in rng.randint(0, 8, size=(30, 2))]
+        edges = rng.randint(0, len(points), size=(25, 2)).tolist()
+        graph = CompactGraph.from_endpoints([points[u] for u, _v in edges], [points[v] for _u, v in edges], range(len(edges)))
+        fids = list(range(len(edges)))
+        next_fid = len(edges)
+
+        # the labels are computed before the updates, so they are updated in place
+        graph.component_labels()
+
+        for _round in range(6):
+            removed = rng.choice(fids, size=4, replace=False).tolist()
+            added = rng.randint(0, len(points), size=(3, 2)).tolist()
+            added_fids = list(range(next_fid, next_fid + len(added)))
+            next_fid += len(added)
+
+            graph.update(removed, [points[u] for u, _v in added], [points[v] for _u, v in added], added_fids)
+            fids = [fid for fid in fids if fid not in removed] + added_fids
+
+            alive = np.flatnonzero(graph.edge_alive)
+            expected = CompactGraph.from_endpoints(
+                [graph.node_point(u) for u in graph.edge_nodes[alive, 0].tolist()],
+                [graph.node_point(v) for v in graph.edge_nodes[alive, 1].tolist()],
+                graph.edge_fids[alive]
+            )
+
+            self.assertEqual(graph.number_of_edges(), expected.number_of_edges())
+            self.assertEqual(self.component_points(graph), self.component_points(expected))
+
+    def test_split_edge(self):
+        graph = square_with_tail()
+        (u, v) = graph.edge_nodes[5].tolist()
+
+        change = graph.split_edge(5, [(1.5, 1.0)], [6, 7])
+        middle = graph.node_id((1.5, 1.0))
+
+        self.assertEqual(change.removed_edges.tolist(), [5])
+        self.assertEqual(change.added_nodes.tolist(), [middle])
+        self.assertFalse(graph.edge_alive[5])
+        self.assertEqual(graph.edge_keys(graph.edges_between(u, middle)), [6])
+        self.assertEqual(graph.edge_keys(graph.edges_between(middle, v)), [7])
+        self.assertEqual(graph.edges_between(u, v), [])
+        self.assertEqual(graph.weights('boundary')[change.added_edges].tolist(), [1, 1])
+
+    def test_overlay_is_rebuilt(self):
+        graph = CompactGraph.from_endpoints([(float(x), 0.0) for x in range(30)], [(float(x + 1), 0.0) for x in range(30)], range(30))
+
+        # 2 new edges stay in the overlay, with 4 more they go over the ratio and the CSR arrays are rebuilt
+        graph.update([], [(0.0, 0.0), (5.0, 0.0)], [(0.0, 1.0), (5.0, 1.0)], [30, 31])
+
+        self.assertEqual(graph._overlay_edges, 2)
+        self.assertEqual(sorted(graph.neighbors(graph.node_id((0.0, 0.0)))), sorted([graph.node_id((1.0, 0.0)), graph.node_id((0.0, 1.0))]))
+
+        graph.update([0], [(float(x), 1.0) for x in range(1, 5)], [(float(x), 2.0) for x in range(1, 5)], range(32, 36))
+
+        self.assertEqual(graph._overlay_edges, 0)
+        self.assertEqual(graph.neighbors(graph.node_id((0.0, 0.0))), [graph.node_id((0.0, 1.0))])
+        self.assertEqual(graph.neighbors(graph.node_id((3.0, 1.0))), [graph.node_id((3.0, 2.0))])
+        self.assertEqual(graph.degrees().tolist(), [graph.degree(node) for node in range(graph.number_of_nodes())])
+
+    def test_trees_follow_updates(self):
+        graph = square_with_tail()
+        graph.update([], [(10.0, 10.0)], [(11.0, 10.0)], [6])
+        cache = ShortestPathTreeCache()
+        tree = cache.tree(graph, graph.node_id((0.0, 0.0)), 'boundary')
+
+        # the other component is not reached by the tree, it is kept for the new revision
+        change = graph.update([], [(11.0, 10.0)], [(12.0, 10.0)], [7])
+        cache.apply_change(change)
+
+        self.assertEqual(len(cache), 1)
+        self.assertIs(cache.tree(graph, graph.node_id((0.0, 0.0)), 'boundary'), tree)
+        self.assertEqual(cache.hits, 1)
+
+        # the tail is reached by the tree, its removal drops it
+        change = graph.update([5])
+        cache.apply_change(change)
+
+        self.assertEqual(len(cache), 0)
+        self.assertIsNot(cache.tree(graph, graph.node_id((0.0, 0.0)), 'boundary'), tree)
+
+
+class ComponentIndexTest(unittest.TestCase):
+    """Test the connected components lookup."""
+
+    def setUp(self):
+        starts = [(0.0, 0.0), (1.0, 0.0), (5.0, 5.0), (9.0, 9.0)]
+        ends = [(1.0, 0.0), (2.0, 0.0), (6.0, 5.0), (9.0, 9.0)]
+        self.graph = CompactGraph.from_endpoints(starts, ends, [0, 1, 2, 3])
+        self.components = ComponentIndex(self.graph)
+
+    def test_component_of(self):
+        self.assertEqual(self.components.component_of([0, 2]), 0)
+        self.assertEqual(self.components.component_of([4, 3]), 3)
+        self.assertIsNone(self.components.component_of([0, 3]))
+        self.assertEqual(self.components.labels(min_size=2), [0, 3])
+        self.assertEqual(self.components.nodes(0).tolist(), [0, 1, 2])
+
+    def test_subgraph_is_dropped_on_change(self):
+        subgraph = self.components.subgraph(3)
+
+        self.assertEqual(sorted(subgraph.nodes()), [3, 4])
+        self.assertIs(self.components.subgraph(3), subgraph)
+
+        change = self.graph.update([], [(2.0, 0.0)], [(5.0, 5.0)], [4])
+
+        self.assertEqual(self.components.apply_change(change), {0, 3})
+        self.assertEqual(self.components.nodes(0).tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(self.components.nodes(3).tolist(), [])
+
+    def test_separate_components(self):
+        with self.assertRaises(NoSuitableGraphError):
+            find_steiner_tree(self.graph, [0, 5], components=self.components)
+
+    def test_canceled_metric_closures(self):
+        class Feedback:
+            """Cancels after the first component, like `QgsFeedback.cancel` called from the main thread."""
+            def __init__(self):
+                self.progress = []
+
+            def isCanceled(self):
+                return len(self.progress) > 0
+
+            def setProgress(self, progress):
+                self.progress.append(progress)
+
+        feedback = Feedback()
+        closures = calculate_components_metric_closures(self.components, feedback=feedback)
+
+        self.assertEqual(list(closures.keys()), [0])
+        self.assertEqual(len(feedback.progress), 1)
+        self.assertLess(feedback.progress[0], 100)
+
+
+class SteinerTreeTest(unittest.TestCase):
+    """Test the Steiner tree search."""
+
+    def setUp(self):
+        self.graph = square_with_tail()
+        self.nodes = {point: self.graph.node_id(point) for point in [(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0), (2.0, 1.0)]}
+
+    def test_two_terminals_cheapest_path(self):
+        terminals = [self.nodes[(0.0, 0.0)], self.nodes[(0.0, 1.0)]]
+
+        self.assertEqual(find_steiner_tree(self.graph, terminals), [2])
+        self.assertEqual(find_steiner_tree(self.graph, terminals, weight='boundary'), [0, 1, 3])
+
+    def test_astar_path(self):
+        # the straight distance to the target is a lower bound of the lengths of (0, 0) - (1, 0) - (1, 1) - (0, 1)
+        graph = square_with_tail()
+        graph.set_weights('length', np.hypot(*(graph.points[graph.edge_nodes[:, 0]] - graph.points[graph.edge_nodes[:, 1]]).T))
+
+        self.assertEqual(graph.weight_per_length('length'), 1.0)
+        self.assertEqual(graph.weight_per_length('boundary'), 1.0)
+        self.assertEqual(astar_path(graph, self.nodes[(0.0, 0.0)], self.nodes[(1.0, 1.0)], 'length'), [1, 0])
+        self.assertEqual(astar_path(graph, self.nodes[(0.0, 0.0)], self.nodes[(2.0, 1.0)], 'boundary'), [5, 1, 0])
+
+        graph.update([5])
+
+        with self.assertRaises(NoSuitableGraphError):
+            astar_path(graph, self.nodes[(0.0, 0.0)], self.nodes[(2.0, 1.0)])
+
+    def test_tree_spans_terminals(self):
+        terminals = [self.nodes[(0.0, 0.0)], self.nodes[(2.0, 1.0)], self.nodes[(0.0, 1.0)]]
+        edges = mehlhorn_steiner_tree(self.graph, terminals, weight='boundary')
+
+        self.assertEqual(self.graph.edge_keys(edges), [0, 1, 3, 5])
+
+    def test_cached_shortest_path_trees(self):
+        cache = ShortestPathTreeCache()
+        terminals = [self.nodes[(0.0, 0.0)], self.nodes[(2.0, 1.0)], self.nodes[(0.0, 1.0)]]
+
+        self.assertEqual(find_steiner_tree(self.graph, terminals, 'boundary', path_trees=cache), [0, 1, 3, 5])
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(kou_steiner_tree(self.graph, terminals, 'boundary', cache), [0, 1, 3, 5])
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        kou_steiner_tree(square_with_tail(), terminals, 'boundary', cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.misses, 4)
+
+    def test_separate_components(self):
+        graph = CompactGraph.from_endpoints([(0.0, 0.0), (5.0, 5.0)], [(1.0, 0.0), (6.0, 5.0)], [0, 1])
+
+        with self.assertRaises(NoSuitableGraphError):
+            mehlhorn_steiner_tree(graph, [0, 2])
+
+    def test_alternative_paths(self):
+        source = self.nodes[(0.0, 0.0)]
+        target = self.nodes[(0.0, 1.0)]
+        path_trees = ShortestPathTreeCache()
+
+        self.assertEqual(yen_k_shortest_paths(self.graph, source, target, 5, 'boundary', path_trees), [[0, 1, 3], [2], [4, 1, 3]])
+        self.assertEqual(yen_k_shortest_paths(self.graph, source, target, 2, 'boundary'), [[0, 1, 3], [2]])
+
+        # the trees are copied for the background task and taken back when they are bigger
+        copied = path_trees.copy(self.graph, 'boundary', [source])
+        copied.tree(self.graph, source, 'boundary')
+        path_trees.merge(copied)
+
+        self.assertTrue(path_trees.tree(self.graph, source, 'boundary').complete)
+        self.assertEqual(path_trees.hits, 1)
+
+    def test_alternative_paths_order(self):
+        rng = np.random.default_rng(3)
+
+        for graph in random_graphs(count=5):
+            weights = graph.weights('boundary')
+            components = ComponentIndex(graph)
+            nodes = components.nodes(max(components.labels(min_size=2), key=lambda label: len(components.nodes(label))))
+            (source, target) = rng.choice(nodes, 2, replace=False).tolist()
+            paths = yen_k_shortest_paths(graph, source, target, 6, 'boundary')
+            # brute force: all the loopless paths
+            costs = []
+            stack = [(source, [source], 0.0)]
+
+            while stack and len(costs) <= 20000:
+                (node, visited, cost) = stack.pop()
+
+                if node == target:
+                    costs.append(cost)
+                    continue
+
+                for u, edge in zip(*graph.half_edges(node)):
+                    if u not in visited:
+                        stack.append((u, visited + [u], cost + weights[edge]))
+
+            if stack:
+                continue
+
+            self.assertEqual(len(set(map(tuple, paths))), len(paths))
+            np.testing.assert_allclose([sum(weights[path]) for path in paths], sorted(costs)[:6])
+
+    def test_metric_closures(self):
+        components = ComponentIndex(self.graph)
+        closures = calculate_components_metric_closures(components, 'boundary')
+        terminals = [self.nodes[(0.0, 0.0)], self.nodes[(2.0, 1.0)], self.nodes[(0.0, 1.0)]]
+
+        self.assertEqual(closures[0].nbytes, 5 * 5 * 2)
+        self.assertEqual(find_steiner_tree(self.graph, terminals, 'boundary', components, metric_closures=closures), [0, 1, 3, 5])
+
+    def test_exact_tree(self):
+        graph = star_with_triangle()
+        terminals = [graph.node_id(p) for p in [(0.0, 0.0), (2.0, 0.0), (1.0, 1.7)]]
+        log = SteinerQueryLog()
+
+        self.assertEqual(mehlhorn_steiner_tree(graph, terminals, 'boundary'), [0, 1])
+        self.assertEqual(find_steiner_tree(graph, terminals, 'boundary', query_log=log), [3, 4, 5])
+        self.assertEqual(log.records[-1][:3], (3, 4, 'exact'))
+        self.assertAlmostEqual(log.records[-1][4], 3.3)
+
+        budget = BoundaryGraph.EXACT_STEINER_TIME_BUDGET
+        BoundaryGraph.EXACT_STEINER_TIME_BUDGET = 0
+
+        try:
+            self.assertEqual(find_steiner_tree(graph, terminals, 'boundary', query_log=log), [0, 1])
+        finally:
+            BoundaryGraph.EXACT_STEINER_TIME_BUDGET = budget
+
+        self.assertEqual(log.records[-1][2], 'mehlhorn')
+        self.assertEqual(log.summary()['exact']['count'], 1)
+
+    def test_exact_tree_with_closure(self):
+        graph = star_with_triangle()
+        terminals = [graph.node_id(p) for p in [(0.0, 0.0), (2.0, 0.0), (1.0, 1.7)]]
+        components = ComponentIndex(graph)
+        closures = calculate_components_metric_closures(components, 'boundary')
+        log = SteinerQueryLog()
+
+        # the cached closure bounds the exact search, no approximate tree is searched
+        with mock.patch.object(BoundaryGraph, '_approximate_steiner_tree', side_effect=AssertionError):
+            self.assertEqual(find_steiner_tree(graph, terminals, 'boundary', components, metric_closures=closures, query_log=log), [3, 4, 5])
+
+            self.assertEqual(log.records[-1][2], 'exact')
+
+            budget = BoundaryGraph.EXACT_STEINER_TIME_BUDGET
+            BoundaryGraph.EXACT_STEINER_TIME_BUDGET = 0
+
+            try:
+                find_steiner_tree(graph, terminals, 'boundary', components, metric_closures=closures, query_log=log)
+            finally:
+                BoundaryGraph.EXACT_STEINER_TIME_BUDGET = budget
+
+        self.assertEqual(log.records[-1][2], 'closure')
+        self.assertAlmostEqual(log.records[-1][4], 4.0)
+
+    def test_exact_tree_is_minimal(self):
+        rng = np.random.default_rng(2)
+
+        for graph in random_graphs(count=10):
+            # a connected neighbourhood of up to 9 nodes in the largest component
+            components = ComponentIndex(graph)
+            nodes = [max(components.labels(min_size=2), key=lambda label: len(components.nodes(label)))]
+
+            for node in nodes:
+                nodes.extend(u for u in graph.neighbors(node) if u not in nodes)
+
+            nodes = nodes[:9]
+            terminals = rng.choice(nodes, 3, replace=False).tolist()
+            weights = graph.weights('boundary')
+            best = np.inf
+
+            # brute force: the minimum spanning trees of the terminals with every subset of the other nodes
+            for mask in range(2 ** len(nodes)):
+                subset = set(terminals) | {node for idx, node in enumerate(nodes) if mask >> idx & 1}
+                G = graph.to_networkx(sorted(subset))
+
+                if nx.is_connected(G):
+                    best = min(best, nx.minimum_spanning_tree(G, weight='boundary').size(weight='boundary'))
+
+            try:
+                edges = dreyfus_wagner_steiner_tree(graph, terminals, nodes, 'boundary')
+            except NoSuitableGraphError:
+                self.assertEqual(best, np.inf)
+                continue
+
+            self.assertAlmostEqual(sum(weights[edges]), best)
+
+    def test_contraction_hierarchy(self):
+        components = ComponentIndex(self.graph)
+        hierarchies = calculate_components_hierarchies(components, 'boundary')
+        terminals = [self.nodes[(0.0, 0.0)], self.nodes[(2.0, 1.0)], self.nodes[(0.0, 1.0)]]
+
+        self.assertEqual(list(hierarchies.keys()), [0])
+        self.assertEqual(hierarchies[0].distance(self.nodes[(0.0, 0.0)], self.nodes[(0.0, 1.0)])[0], 3.0)
+        self.assertEqual(find_steiner_tree(self.graph, terminals[::2], 'boundary', components, hierarchies=hierarchies), [0, 1, 3])
+        self.assertEqual(find_steiner_tree(self.graph, terminals, 'boundary', components, hierarchies=hierarchies), [0, 1, 3, 5])
+
+    def test_contraction_hierarchy_distances(self):
+        rng = np.random.default_rng(0)
+        points = rng.integers(0, 8, (120, 2)).astype(np.float64)
+        starts = [tuple(p) for p in points[:60].tolist()]
+        ends = [tuple(p) for p in points[60:].tolist()]
+        graph = CompactGraph.from_endpoints(starts, ends, list(range(60)), weights={'boundary': rng.random(60).tolist()})
+        components = ComponentIndex(graph)
+        hierarchies = calculate_components_hierarchies(components, 'boundary')
+        weights = graph.weights('boundary')
+
+        for _ in range(30):
+            (source, target) = rng.integers(0, graph.number_of_nodes(), 2).tolist()
+            label = components.component_of([source, target])
+
+            if label is None or source == target:
+                continue
+
+            expected = sum(weights[astar_path(graph, source, target, 'boundary')])
+
+            self.assertAlmostEqual(hierarchies[label].distance(source, target)[0], expected)
+            self.assertAlmostEqual(sum(weights[hierarchies[label].path_edges(source, target)]), expected)
+
+    def test_worker_processes(self):
+        graph = square_with_tail()
+        graph.update(starts=[(5.0, 5.0), (6.0, 5.0)], ends=[(6.0, 5.0), (6.0, 6.0)], edge_fids=[6, 7], weights={'boundary': [2, 2]})
+        components = ComponentIndex(graph)
+        labels = components.labels(min_size=2)
+        min_nodes = BoundaryGraph.PROCESS_POOL_MIN_NODES
+        BoundaryGraph.PROCESS_POOL_MIN_NODES = 0
+
+        try:
+            (closures, hierarchies) = calculate_components_routing(components, 'boundary', labels, labels, processes=2)
+        finally:
+            BoundaryGraph.PROCESS_POOL_MIN_NODES = min_nodes
+
+        self.assertEqual(sorted(closures.keys()), labels)
+        self.assertEqual(sorted(hierarchies.keys()), labels)
+
+        terminals = [self.nodes[(0.0, 0.0)], self.nodes[(2.0, 1.0)]]
+
+        self.assertEqual(closures[0].distance(self.nodes[(0.0, 0.0)], self.nodes[(2.0, 1.0)]), 3.0)
+        self.assertEqual(find_steiner_tree(graph, terminals, 'boundary', components, hierarchies=hierarchies), [0, 1, 5])
+
+
+def star_with_triangle() -> CompactGraph:
+    """Three terminals pairwise connected with weight 2, and with weight 1.1 to a center.
+
+    The approximations connect the terminals directly (4), the minimum tree is the star (3.3).
+    """
+    terminals = [(0.0, 0.0), (2.0, 0.0), (1.0, 1.7)]
+    center = (1.0, 0.6)
+    starts = terminals + terminals
+    ends = [terminals[1], terminals[2], terminals[0], center, center, center]
+    weights = {'boundary': [2, 2, 2, 1.1, 1.1, 1.1]}
+
+    return CompactGraph.from_endpoints(starts, ends, list(range(6)), weights=weights)
+
+
+def random_graphs(count: int = 8, seed: int = 0) -> list:
+    """The test corpus of the routing backends: random multigraphs with a few components, parallel and closed lines."""
+    rng = np.random.default_rng(seed)
+    graphs = []
+
+    for _ in range(count):
+        size = int(rng.integers(20, 80))
+        points = rng.integers(0, 7, (2 * size, 2)).astype(np.float64)
+        starts = [tuple(p) for p in points[:size].tolist()]
+        ends = [tuple(p) for p in points[size:].tolist()]
+        graphs.append(CompactGraph.from_endpoints(starts, ends, list(range(size)), weights={'boundary': rng.random(size).tolist()}))
+
+    return graphs
+
+
+@unittest.skipUnless(BoundaryGraph.csgraph is not None, 'SciPy is not installed')
+class RoutingBackendTest(unittest.TestCase):
+    """Test that the SciPy routing backend gives the same results as the networkx one."""
+
+    def tearDown(self):
+        set_routing_backend()
+
+    def run_backend(self, name: str, graph: CompactGraph, terminals: list) -> tuple:
+        backend = set_routing_backend(name)
+        graph._components = None
+        components = ComponentIndex(graph)
+        closures = calculate_components_metric_closures(components, 'boundary')
+        trees = []
+
+        for nodes in terminals:
+            try:
+                trees.append(backend.steiner_tree(graph, nodes, 'boundary'))
+            except NoSuitableGraphError:
+                trees.append(None)
+
+        return graph.component_labels().tolist(), {label: closure.predecessor.tolist() for label, closure in closures.items()}, trees
+
+    def test_same_results(self):
+        rng = np.random.default_rng(1)
+
+        for graph in random_graphs():
+            terminals = [rng.integers(0, graph.number_of_nodes(), int(rng.integers(3, 6))).tolist() for _ in range(10)]
+
+            self.assertEqual(self.run_backend('scipy', graph, terminals), self.run_backend('networkx', graph, terminals))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(BoundaryDelineationError):
+            set_routing_backend('igraph')
+
+
+class RoutingCacheTest(unittest.TestCase):
+    """Test the cache of the metric closures and contraction hierarchies."""
+
+    def setUp(self):
+        self.graph = square_with_tail()
+        self.graph.update(starts=[(5.0, 5.0), (6.0, 5.0)], ends=[(6.0, 5.0), (6.0, 6.0)], edge_fids=[6, 7], weights={'boundary': [2, 2]})
+        self.components = ComponentIndex(self.graph)
+        self.closures = calculate_components_metric_closures(self.components, 'boundary')
+
+    def test_views(self):
+        cache = RoutingCache()
+        cache.update(self.graph.revision, 'boundary', RoutingCache.CLOSURE, self.closures)
+        view = cache.view(self.graph.revision, 'boundary', RoutingCache.CLOSURE)
+
+        self.assertEqual(sorted(view), sorted(self.closures))
+        self.assertIsNone(view.get(3))
+        self.assertEqual(cache.missing(self.graph.revision, 'boundary', RoutingCache.CLOSURE, [0, 5, 8]), [8])
+        self.assertEqual(cache.missing(self.graph.revision, 'weight', RoutingCache.CLOSURE, [0]), [0])
+        self.assertEqual(len(cache.view(self.graph.revision, 'boundary', RoutingCache.HIERARCHY)), 0)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.nbytes(), sum(RoutingCache.estimate_bytes(closure) for closure in self.closures.values()))
+
+        # another revision drops everything
+        self.assertEqual(len(cache.view(self.graph.revision + 1, 'boundary', RoutingCache.CLOSURE)), 0)
+        self.assertEqual(cache.nbytes(), 0)
+
+    def test_eviction(self):
+        sizes = {label: RoutingCache.estimate_bytes(closure) for label, closure in self.closures.items()}
+        cache = RoutingCache(max_bytes=max(sizes.values()))
+        cache.update(self.graph.revision, 'boundary', RoutingCache.CLOSURE, self.closures)
+        cache.update(self.graph.revision, 'weight', RoutingCache.CLOSURE, {0: self.closures[0]})
+
+        # the least recently used entries are evicted first
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertEqual(list(cache.view(self.graph.revision, 'weight', RoutingCache.CLOSURE)), [0])
+
+    def test_apply_change(self):
+        cache = RoutingCache()
+        cache.update(self.graph.revision, 'boundary', RoutingCache.CLOSURE, self.closures)
+        change = self.graph.update([7])
+        changed_labels = self.components.apply_change(change)
+        cache.apply_change(change, changed_labels)
+
+        self.assertEqual(changed_labels, {5, 7})
+        self.assertEqual(list(cache.view(self.graph.revision, 'boundary', RoutingCache.CLOSURE)), [0])
+
+
+class GridLayer:
+    """Stand-in for a line layer with a `size` x `size` grid of unit lines, read by `GridTiledGraph`."""
+
+    class Extent:
+        def __init__(self, size):
+            self.size = size
+
+        def xMinimum(self):
+            return 0.0
+
+        def yMinimum(self):
+            return 0.0
+
+        def width(self):
+            return float(self.size)
+
+        def height(self):
+            return float(self.size)
+
+    def __init__(self, size):
+        self.lines = []
+
+        for i in range(size + 1):
+            for j in range(size):
+                self.lines.append(((float(i), float(j)), (float(i), float(j + 1))))
+                self.lines.append(((float(j), float(i)), (float(j + 1), float(i))))
+
+        self._extent = self.Extent(size)
+
+    def extent(self):
+        return self._extent
+
+    def featureCount(self):
+        return len(self.lines)
+
+    def fields(self):
+        return []
+
+
+class GridTiledGraph(TiledGraph):
+    def _read_tile(self, bounds):
+        (xmin, ymin, xmax, ymax) = bounds
+        fids = [fid for fid, (s, e) in enumerate(self.layer.lines)
+                if min(s[0], e[0]) <= xmax and max(s[0], e[0]) >= xmin and min(s[1], e[1]) <= ymax and max(s[1], e[1]) >= ymin]
+
+        return LineArrays([self.layer.lines[fid][0] for fid in fids], [self.layer.lines[fid][1] for fid in fids], fids)
+
+
+class TiledGraphTest(unittest.TestCase):
+    """Test the graph loaded in tiles."""
+
+    def setUp(self):
+        self.layer = GridLayer(20)
+        self.tiled = GridTiledGraph(self.layer, 4.0)
+
+    def test_tiles_are_stitched(self):
+        graph = self.tiled.graph((1.0, 1.0, 6.0, 1.0), margin=0)
+
+        # two tiles, the lines on their common border are added once
+        self.assertEqual(self.tiled.misses, 2)
+        self.assertEqual(graph.number_of_edges(), len(set(graph.edge_fids.tolist())))
+
+        terminals = [graph.node_id((1.0, 1.0)), graph.node_id((6.0, 1.0))]
+        self.assertEqual(len(find_steiner_tree(graph, terminals)), 5)
+
+    def test_graph_is_reused(self):
+        graph = self.tiled.graph((5.0, 5.0, 6.0, 6.0))
+
+        self.assertIs(self.tiled.graph((5.5, 5.5, 5.5, 5.5), margin=0), graph)
+        self.assertIsNot(self.tiled.graph((18.0, 18.0, 19.0, 19.0)), graph)
+        self.assertEqual(self.tiled.hits, 0)
+
+    def test_memory_budget(self):
+        tiled = GridTiledGraph(self.layer, 4.0, max_bytes=1)
+
+        tiled.graph((1.0, 1.0, 1.0, 1.0), margin=0)
+        tiled.graph((9.0, 9.0, 9.0, 9.0), margin=0)
+
+        self.assertEqual(tiled.stats()['tiles'], 1)
+        self.assertEqual(tiled.evictions, 1)
+
+    def test_invalidate(self):
+        self.tiled.graph((1.0, 1.0, 1.0, 1.0), margin=1)
+        tiles = self.tiled.stats()['tiles']
+
+        self.tiled.invalidate((1.0, 1.0, 1.0, 1.0))
+
+        self.assertEqual(self.tiled.stats()['tiles'], tiles - 1)
+
+    def test_from_lines(self):
+        lines = LineArrays([s for s, _e in self.layer.lines], [e for _s, e in self.layer.lines], range(len(self.layer.lines)))
+        # the layer is not accessed, the tiles are laid out over the lines
+        tiled = GridTiledGraph.from_lines(None, lines, tile_features=len(lines) // 25)
+        expected = GridTiledGraph.from_layer(self.layer, tile_features=len(lines) // 25)
+
+        self.assertEqual(tiled.tile_size, expected.tile_size)
+        self.assertEqual(tiled.tile_keys((1.0, 1.0, 6.0, 1.0)), expected.tile_keys((1.0, 1.0, 6.0, 1.0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
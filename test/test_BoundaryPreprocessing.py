@@ -0,0 +1,45 @@
+# coding=utf-8
+"""Tests for the preprocessing of the segments layer.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# the plugin bundles networkx, BoundaryGraph imports it from there too
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from BoundaryPreprocessing import utm_epsg
+
+
+class WorkingCrsTest(unittest.TestCase):
+    """Test picking the UTM zone of the working CRS."""
+
+    def test_hemispheres(self):
+        # Enschede
+        self.assertEqual(utm_epsg(6.89, 52.22), 32632)
+        # Kigali
+        self.assertEqual(utm_epsg(30.06, -1.94), 32736)
+        self.assertEqual(utm_epsg(30.06, 0.0), 32636)
+
+    def test_zone_borders(self):
+        self.assertEqual(utm_epsg(-180.0, 10.0), 32601)
+        self.assertEqual(utm_epsg(-174.0, 10.0), 32602)
+        self.assertEqual(utm_epsg(-0.01, 10.0), 32630)
+        self.assertEqual(utm_epsg(0.0, 10.0), 32631)
+        self.assertEqual(utm_epsg(179.99, -10.0), 32760)
+
+    def test_antimeridian_is_clamped(self):
+        self.assertEqual(utm_epsg(180.0, 10.0), 32660)
+        self.assertEqual(utm_epsg(-185.0, 10.0), 32601)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# coding=utf-8
+"""Tests for the background task helpers.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+import os
+import sys
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from .utilities import get_qgis_app
+# utils creates its cursors when imported, that needs the application
+QGIS_APP = get_qgis_app()
+
+import utils
+from utils import TaskScheduler
+
+
+class FakeSignal:
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
+
+
+class FakeTask:
+    """Stand-in for a `ProcessingTask`, completed or stopped by the test instead of the task manager."""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.result = None
+        self.error = None
+        self.seconds = 0.0
+        self.canceled = False
+        self.progressChanged = FakeSignal()
+        self.taskCompleted = FakeSignal()
+        self.taskTerminated = FakeSignal()
+
+    def description(self):
+        return self.name
+
+    def cancel(self):
+        self.canceled = True
+
+    def complete(self, result):
+        self.result = result
+        self.taskCompleted.emit()
+
+    def fail(self, error=None):
+        self.error = error
+        self.taskTerminated.emit()
+
+
+class TaskSchedulerTest(unittest.TestCase):
+    """Test running the tasks in the order of their dependencies."""
+
+    def setUp(self):
+        patchers = [mock.patch.object(utils, 'QgsApplication'), mock.patch.object(utils, 'log_info')]
+
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.scheduler = TaskScheduler()
+        self.tasks = {}
+        self.completed = []
+        self.finished = []
+        self.scheduler.finished.connect(self.finished.append)
+
+    def add(self, name, dependencies=()):
+        def create_task(*args):
+            self.tasks[name] = FakeTask(name, args)
+            return self.tasks[name]
+
+        self.scheduler.add(name, create_task, lambda result: self.completed.append((name, result)), dependencies)
+
+    def test_dependency_order(self):
+        self.add('a')
+        self.add('b', ['a'])
+        self.add('c', ['a', 'b'])
+        self.scheduler.start()
+
+        self.assertEqual(list(self.tasks), ['a'])
+
+        self.tasks['a'].complete(1)
+
+        self.assertEqual(list(self.tasks), ['a', 'b'])
+        self.assertEqual(self.tasks['b'].args, (1,))
+
+        self.tasks['b'].complete(2)
+
+        self.assertEqual(self.tasks['c'].args, (1, 2))
+        self.assertEqual(self.finished, [])
+
+        self.tasks['c'].complete(3)
+
+        self.assertEqual(self.completed, [('a', 1), ('b', 2), ('c', 3)])
+        self.assertEqual(self.scheduler.results, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(self.finished, [True])
+        self.assertFalse(self.scheduler.is_running())
+
+    def test_independent_tasks_run_together(self):
+        self.add('a')
+        self.add('b')
+        self.add('c', ['a'])
+        self.scheduler.start()
+
+        self.assertEqual(sorted(self.tasks), ['a', 'b'])
+
+    def test_failure_propagation(self):
+        self.add('a')
+        self.add('b')
+        self.add('c', ['a'])
+        self.scheduler.start()
+
+        error = ValueError('failed')
+        self.tasks['a'].fail(error)
+
+        self.assertEqual(self.finished, [False])
+        self.assertIs(self.scheduler.error, error)
+        self.assertTrue(self.tasks['b'].canceled)
+        self.assertNotIn('c', self.tasks)
+        self.assertFalse(self.scheduler.is_running())
+
+        # the results of the canceled tasks are ignored
+        self.tasks['b'].complete(2)
+
+        self.assertEqual(self.completed, [])
+        self.assertEqual(self.finished, [False])
+
+    def test_cancel(self):
+        self.add('a')
+        self.add('b', ['a'])
+        self.scheduler.start()
+        self.scheduler.cancel()
+
+        self.assertTrue(self.tasks['a'].canceled)
+        self.assertFalse(self.scheduler.is_running())
+
+        self.tasks['a'].fail()
+        self.tasks['a'].complete(1)
+
+        self.assertEqual(self.finished, [])
+        self.assertEqual(self.completed, [])
+        self.assertNotIn('b', self.tasks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -43,17 +43,19 @@ import collections.abc
 import typing
 import os
 import json
+import time
 
 from enum import Enum
 from collections import defaultdict
 
-from PyQt5.QtCore import Qt, QDir, QCoreApplication
+from PyQt5.QtCore import Qt, QDir, QCoreApplication, QObject, pyqtSignal
 from PyQt5.QtGui import QCursor, QColor, QIcon, QPixmap
 from PyQt5.QtWidgets import QApplication, QPushButton, QLabel
 
 import processing
 
-from qgis.core import Qgis, QgsProject, QgsMarkerSymbol, QgsLineSymbol, QgsSingleSymbolRenderer, QgsGraduatedSymbolRenderer, QgsLayerTreeNode, QgsLayerTreeLayer, QgsVectorLayer, QgsRasterLayer, QgsMapLayer, QgsPoint, QgsVectorFileWriter, QgsCoordinateReferenceSystem, QgsLayerTreeGroup
+from qgis.core import Qgis, QgsProject, QgsMarkerSymbol, QgsLineSymbol, QgsSingleSymbolRenderer, QgsGraduatedSymbolRenderer, QgsLayerTreeNode, QgsLayerTreeLayer, QgsVectorLayer, QgsRasterLayer, QgsMapLayer, QgsPoint, QgsVectorFileWriter, QgsCoordinateReferenceSystem, QgsLayerTreeGroup, \
+    QgsProcessingFeedback, QgsTask, QgsApplication, QgsMessageLog
 from qgis.utils import iface
 
 PLUGIN_DIR = os.path.dirname(__file__)
@@ -91,6 +93,14 @@ def show_error(msg: str, duration: int = 5) -> None:
     """
     iface.messageBar().pushMessage(APP_NAME, msg, Qgis.Error, duration)
 
+def log_info(msg: str) -> None:
+    """Write an info message to the plugin tab of the QGIS log.
+
+    Args:
+        msg (str): Message to be logged
+    """
+    QgsMessageLog.logMessage(msg, APP_NAME, Qgis.Info)
+
 def create_icon(icon: str) -> QIcon:
     """Create icon object with icon image.
 
@@ -389,24 +399,6 @@ def polyginize_lines(vector_layer: QgsVectorLayer, name: str = None) -> QgsVecto
 
     return polygonizedResult['OUTPUT']
 
-
-def delete_duplicate_geometries(vector_layer: QgsVectorLayer, name: str = 'PolygonizedLines') -> QgsVectorLayer:
-    result = processing.run('qgis:deleteduplicategeometries', {
-        'INPUT': vector_layer,
-        'OUTPUT': 'memory:%s' % name,
-    })
-
-    return result['OUTPUT']
-
-def extract_specific_vertices(vector_layer: QgsVectorLayer, vertices: str = '0', name: str = 'Vertices') -> QgsVectorLayer:
-    verticesResult = processing.run('qgis:extractspecificvertices', {
-        'INPUT': vector_layer,
-        'VERTICES': vertices,
-        'OUTPUT': 'memory:%s' % name,
-    })
-
-    return verticesResult['OUTPUT']
-
 def lines_unique_vertices(vector_layer: QgsVectorLayer, feature_ids: typing.List[int] = None) -> typing.List[QgsPoint]:
     points: typing.Dict[QgsPoint, int] = defaultdict(int)
     features = vector_layer.getFeatures(feature_ids) if feature_ids else vector_layer.getFeatures()
@@ -475,3 +467,188 @@ class SelectionModes(Enum):
     ENCLOSING = 2
     NODES = 3
     LINES = 4
+
+
+class ProcessingTask(QgsTask):
+    """Run a function in a background thread, its progress and canceling go through a processing feedback.
+
+    The function is called with the feedback of the task as `feedback` keyword argument. The layers it returns,
+    alone, in a tuple or list, or from the `layers()` method of the result, belong to the task thread, so they are
+    moved to the main thread before the task finishes. Add them to the project only once the task has completed.
+
+    Attributes:
+        func (typing.Callable): the function to be run
+        args (tuple): positional arguments of the function
+        result (typing.Any): the value returned by the function
+        error (Optional[Exception]): the error that stopped the task, if any
+        seconds (float): how long the function has run
+        feedback (QgsProcessingFeedback): the feedback passed to the function
+    """
+
+    def __init__(self, description: str, func: typing.Callable, *args: typing.Any) -> None:
+        super().__init__(description, QgsTask.CanCancel)
+
+        self.func = func
+        self.args = args
+        self.result: typing.Any = None
+        self.error: typing.Optional[Exception] = None
+        self.seconds = 0.0
+        self.feedback = QgsProcessingFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+
+    def run(self) -> bool:
+        started = time.perf_counter()
+
+        try:
+            self.result = self.func(*self.args, feedback=self.feedback)
+        except Exception as err:
+            self.error = err
+            return False
+        finally:
+            self.seconds = time.perf_counter() - started
+
+        if isinstance(self.result, (tuple, list)):
+            values = self.result
+        elif hasattr(self.result, 'layers'):
+            values = self.result.layers()
+        else:
+            values = (self.result,)
+
+        for value in values:
+            if isinstance(value, QgsMapLayer):
+                value.moveToThread(QCoreApplication.instance().thread())
+
+        return not self.isCanceled()
+
+    def cancel(self) -> None:
+        self.feedback.cancel()
+        super().cancel()
+
+
+class TaskScheduler(QObject):
+    """Run `ProcessingTask`s as soon as the tasks they depend on have completed, so the independent ones run in parallel.
+
+    Each task is added with a function creating it from the results of its dependencies, and a function using its
+    result, both called in the main thread. Once all the tasks have completed, or one of them has failed, `finished`
+    is emitted. The time of each task is written to the QGIS log.
+
+    Attributes:
+        progressChanged (pyqtSignal): emitted with the progress of all the tasks in percents and the descriptions of the running ones
+        finished (pyqtSignal): emitted with True when all the tasks have completed, False when one of them has failed
+        results (Dict[str, typing.Any]): the results of the completed tasks, keyed by name
+        timings (Dict[str, float]): seconds each completed task has run, keyed by name
+        error (Optional[Exception]): the error of the failed task, if any
+    """
+
+    progressChanged = pyqtSignal(float, str)
+    finished = pyqtSignal(bool)
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.results: typing.Dict[str, typing.Any] = {}
+        self.timings: typing.Dict[str, float] = {}
+        self.error: typing.Optional[Exception] = None
+        self._steps: typing.Dict[str, typing.Tuple[typing.Callable, typing.Optional[typing.Callable], typing.List[str], float]] = {}
+        self._pending: typing.List[str] = []
+        self._running: typing.Dict[str, ProcessingTask] = {}
+        self._progress: typing.Dict[str, float] = {}
+        self._started = 0.0
+
+    def add(self, name: str, create_task: typing.Callable[..., ProcessingTask], on_completed: typing.Callable[[typing.Any], None] = None,
+            dependencies: typing.Collection[str] = (), weight: float = 1) -> None:
+        """Add a task, before starting the scheduler.
+
+        Args:
+            name (str): name of the task, used for the dependencies and the results
+            create_task (Callable[..., ProcessingTask]): called with the results of the dependencies, in their order
+            on_completed (Callable[[Any], None], optional): called with the result of the task when it completes
+            dependencies (Collection[str], optional): names of the tasks that should complete before this one starts
+            weight (float, optional): share of the task in the total progress, relative to the other tasks
+        """
+        self._steps[name] = (create_task, on_completed, list(dependencies), weight)
+        self._pending.append(name)
+        self._progress[name] = 0
+
+    def start(self) -> None:
+        self._started = time.perf_counter()
+        self._start_ready()
+
+    def cancel(self) -> None:
+        """Cancel the running tasks and drop the pending ones, `finished` is not emitted."""
+        running = list(self._running.values())
+
+        self._pending = []
+        self._running = {}
+
+        for task in running:
+            task.cancel()
+
+    def is_running(self) -> bool:
+        return bool(self._pending or self._running)
+
+    def _start_ready(self) -> None:
+        for name in list(self._pending):
+            (create_task, on_completed, dependencies, _weight) = self._steps[name]
+
+            if not all(dependency in self.results for dependency in dependencies):
+                continue
+
+            self._pending.remove(name)
+
+            task = create_task(*[self.results[dependency] for dependency in dependencies])
+            task.progressChanged.connect(functools.partial(self._on_progress_changed, name, task))
+            task.taskCompleted.connect(functools.partial(self._on_task_completed, name, task))
+            task.taskTerminated.connect(functools.partial(self._on_task_terminated, name, task))
+
+            self._running[name] = task
+            QgsApplication.taskManager().addTask(task)
+
+        if not self._running and not self._pending:
+            log_info('All tasks finished in %.2f s' % (time.perf_counter() - self._started))
+            self.finished.emit(True)
+        else:
+            self._emit_progress()
+
+    def _emit_progress(self) -> None:
+        total_weight = sum(step[3] for step in self._steps.values())
+        progress = sum(self._progress[name] * step[3] for name, step in self._steps.items()) / total_weight
+
+        self.progressChanged.emit(progress, ', '.join(task.description() for task in self._running.values()))
+
+    def _on_progress_changed(self, name: str, task: ProcessingTask, progress: float) -> None:
+        if self._running.get(name) is not task:
+            return
+
+        self._progress[name] = progress
+        self._emit_progress()
+
+    def _on_task_completed(self, name: str, task: ProcessingTask) -> None:
+        if self._running.get(name) is not task:
+            return
+
+        del self._running[name]
+
+        self.results[name] = task.result
+        self.timings[name] = task.seconds
+        self._progress[name] = 100
+
+        log_info('%s finished in %.2f s' % (task.description(), task.seconds))
+
+        on_completed = self._steps[name][1]
+
+        if on_completed:
+            on_completed(task.result)
+
+        self._start_ready()
+
+    def _on_task_terminated(self, name: str, task: ProcessingTask) -> None:
+        if self._running.get(name) is not task:
+            return
+
+        self.error = task.error
+
+        log_info('%s stopped after %.2f s: %s' % (task.description(), task.seconds, task.error or 'canceled'))
+
+        self.cancel()
+        self.finished.emit(False)